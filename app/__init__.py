@@ -11,7 +11,10 @@ from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
+from kombu import Queue
 
+from app.utils.metrics import init_celery_metrics
+from app.utils.profiling import init_celery_profiling
 from config import Config
 
 
@@ -26,6 +29,8 @@ def celery_init_app(app: Flask) -> Celery:
     celery_app.config_from_object(app.config["CELERY"])
     celery_app.set_default()
     celery_app.autodiscover_tasks(["app.tasks"])
+    init_celery_metrics()
+    init_celery_profiling(app)
     app.extensions["celery"] = celery_app
     return celery_app
 
@@ -57,16 +62,31 @@ def create_app(config_class=Config):
                     "schedule": crontab(minute="*"),
                 },
             },
+            # Latency-critical executions and bulk analytics each get their own
+            # queue so they never wait on each other. Stream consumers run in
+            # their own supervised process (see stream_worker.py).
+            task_queues=(
+                Queue("execution"),
+                Queue("analytics"),
+                Queue("offbit"),
+            ),
+            task_default_queue="offbit",
+            # Workers listening on several queues drain them in the order above
+            broker_transport_options={"queue_order_strategy": "priority"},
+            # Don't let one worker reserve executions another idle worker could run
+            worker_prefetch_multiplier=1,
             task_routes=[
-                {"app.tasks.update_and_execute": {"queue": "offbit"}},
-                {"app.tasks.execute_strategies": {"queue": "offbit"}},
-                {"app.tasks.execute_user_strategy": {"queue": "offbit"}},
-                {"app.tasks.update_coins_historical_data": {"queue": "offbit"}},
-                {"app.tasks.update_strategies_performance": {"queue": "offbit"}},
-                {"app.tasks.update_coins_performance": {"queue": "offbit"}},
+                {"app.tasks.update_and_execute": {"queue": "execution"}},
+                {"app.tasks.execute_strategies": {"queue": "execution"}},
+                {"app.tasks.execute_user_strategy": {"queue": "execution"}},
+                {"app.tasks.prefetch_balances": {"queue": "execution"}},
+                {"app.tasks.apply_order_fill": {"queue": "execution"}},
+                {"app.tasks.update_coins_historical_data": {"queue": "execution"}},
+                {"app.tasks.rebuild_schedule_index": {"queue": "analytics"}},
+                {"app.tasks.recount_site_stats": {"queue": "analytics"}},
+                {"app.tasks.update_strategies_performance": {"queue": "analytics"}},
+                {"app.tasks.update_coins_performance": {"queue": "analytics"}},
                 {"app.tasks.send_async_email": {"queue": "offbit"}},
-                {"app.tasks.start_redis_listener": {"queue": "offbit"}},
-                {"app.tasks.start_websocket_client": {"queue": "offbit"}},
             ],
         ),
     )
@@ -89,6 +109,14 @@ def create_app(config_class=Config):
 
     app.register_blueprint(user_bp, url_prefix="/my")
 
+    from app.metrics import bp as metrics_bp
+
+    app.register_blueprint(metrics_bp)
+
+    from app.admin import bp as admin_bp
+
+    app.register_blueprint(admin_bp, url_prefix="/admin")
+
     if not app.debug and not app.testing:
         if app.config["MAIL_SERVER"]:
             auth = None
@@ -131,10 +159,6 @@ def create_app(config_class=Config):
         app.logger.setLevel(logging.INFO)
         app.logger.info("Offbit startup")
 
-    # # Start the Redis listener using a Celery task
-    # app.extensions["celery"].send_task("app.tasks.start_redis_listener")
-    # app.extensions["celery"].send_task("app.tasks.start_websocket_client")
-
     return app
 
 
@@ -0,0 +1,12 @@
+from flask_wtf import FlaskForm
+from wtforms import SelectField, StringField, SubmitField
+from wtforms.validators import DataRequired
+
+
+class ProfileTargetForm(FlaskForm):
+    kind = SelectField("종류", choices=[("route", "route"), ("task", "task")])
+    name = StringField(
+        "이름 (endpoint 또는 task)",
+        validators=[DataRequired(message="이름을 입력해 주세요.")],
+    )
+    submit = SubmitField("프로파일링 켜기")
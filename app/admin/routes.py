@@ -0,0 +1,121 @@
+import redis
+from flask import (
+    abort,
+    current_app,
+    flash,
+    g,
+    redirect,
+    render_template,
+    request,
+    url_for,
+)
+from flask_login import current_user, login_required
+
+from app.admin import bp
+from app.admin.forms import ProfileTargetForm
+from app.main.forms import EmptyForm
+from app.utils.profiling import (
+    PROFILE_HEADER,
+    Profiler,
+    get_profile,
+    get_targets,
+    list_profiles,
+    save_profile,
+    set_target,
+    target_cache,
+)
+from app.utils.redis_utils import get_redis_client
+
+
+def should_profile_request(redis_client) -> bool:
+    if request.headers.get(PROFILE_HEADER):
+        # Only admins may profile a single request on demand
+        return current_user.is_authenticated and current_user.admin
+    return target_cache.is_profiled(redis_client, "route", request.endpoint)
+
+
+@bp.before_app_request
+def start_request_profile():
+    redis_client = get_redis_client(current_app)
+    if redis_client is None or request.endpoint is None:
+        return
+    try:
+        if not should_profile_request(redis_client):
+            return
+    except redis.RedisError:
+        return
+    g.profiler = Profiler("route", request.endpoint)
+    g.profiler.start()
+
+
+@bp.after_app_request
+def save_request_profile(response):
+    profiler = g.pop("profiler", None)
+    if profiler is None:
+        return response
+    profiler.stop()
+    try:
+        save_profile(
+            get_redis_client(current_app),
+            profiler,
+            details=f"{request.method} {request.full_path} {response.status_code}",
+        )
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Could not save profile of {profiler.name}: {e}")
+    return response
+
+
+@bp.before_request
+@login_required
+def require_admin():
+    if not current_user.admin:
+        flash("관리자 권한이 필요합니다.", "danger")
+        return redirect(url_for("main.index"))
+
+
+@bp.route("/profiles", methods=["GET", "POST"])
+def profiles():
+    redis_client = get_redis_client(current_app)
+    form = ProfileTargetForm()
+    if form.validate_on_submit():
+        set_target(redis_client, f"{form.kind.data}:{form.name.data.strip()}", True)
+        return redirect(url_for("admin.profiles"))
+    return render_template(
+        "admin/profiles.html",
+        title="프로파일",
+        form=form,
+        disable_form=EmptyForm(),
+        targets=sorted(get_targets(redis_client)),
+        profiles=list_profiles(redis_client),
+    )
+
+
+@bp.route("/profiles/targets/<path:target>/disable", methods=["POST"])
+def disable_profile_target(target):
+    form = EmptyForm()
+    if form.validate_on_submit():
+        set_target(get_redis_client(current_app), target, False)
+    return redirect(url_for("admin.profiles"))
+
+
+@bp.route("/profiles/<profile_id>")
+def profile(profile_id):
+    stored = get_profile(get_redis_client(current_app), profile_id)
+    if stored is None:
+        abort(404)
+    return render_template("admin/profile.html", title="프로파일", profile=stored)
+
+
+@bp.route("/profiles/<profile_id>.prof")
+def download_profile(profile_id):
+    stored = get_profile(get_redis_client(current_app), profile_id)
+    if stored is None:
+        abort(404)
+    return (
+        stored["stats"],
+        200,
+        {
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": f"attachment; filename={profile_id}.prof",
+        },
+    )
@@ -3,7 +3,15 @@ from datetime import datetime, timedelta, timezone
 from urllib.parse import urlsplit
 
 import sqlalchemy as sa
-from flask import flash, redirect, render_template, request, session, url_for
+from flask import (
+    current_app,
+    flash,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from flask_login import current_user, login_user, logout_user
 
 from app import db
@@ -17,6 +25,8 @@ from app.auth.forms import (
     VerificationCodeForm,
 )
 from app.models import User
+from app.utils.redis_utils import get_redis_client
+from app.utils.site_stats import add_user
 
 
 @bp.route("/login", methods=["GET", "POST"])
@@ -194,6 +204,7 @@ def verify_email():
             user.set_password(session["password"])
             db.session.add(user)
             db.session.commit()
+            add_user(get_redis_client(current_app))
 
             flash("이메일 인증에 성공했습니다! 가입이 완료되었습니다.", "success")
             # Clear the session variables
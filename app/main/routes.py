@@ -1,14 +1,15 @@
 from datetime import datetime, timedelta, timezone
 
-import pandas as pd
 import pytz
 import redis
 import sqlalchemy as sa
 import sqlalchemy.orm as so
 from flask import (
+    Response,
     abort,
     current_app,
     flash,
+    jsonify,
     redirect,
     render_template,
     request,
@@ -27,26 +28,49 @@ from app.main.forms import (
     SetBacktestTwoParamsForm,
 )
 from app.models import Coin, Strategy, User, UserStrategy
-from app.utils.performance_utils import get_backtest, get_performance
+from app.utils.chart_utils import (
+    downsample,
+    encode_chart,
+    epoch_ms,
+    json_safe,
+    normalize,
+)
+from app.utils.performance_utils import (
+    get_cached_backtest,
+    get_performance,
+    get_performance_data,
+)
+from app.utils.redis_utils import get_redis_client
+from app.utils.site_stats import get_site_stats, whole_won
 
 
 @bp.route("/")
 @bp.route("/index")
 def index():
-    # Get total number of users
-    total_users = User.query.count()
-
-    # Calculate total active investment amount
-    total_investment = (
-        db.session.query(func.sum(UserStrategy._investing_limit))
-        .filter(UserStrategy.active == True)
-        .scalar()
-        or 0
-    )
+    # The totals are kept in Redis as users register and strategies change
+    redis_client = get_redis_client(current_app)
+    stats = None
+    if redis_client is not None:
+        try:
+            stats = get_site_stats(redis_client)
+            if stats is None:
+                current_app.extensions["celery"].send_task(
+                    "app.tasks.recount_site_stats"
+                )
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Failed to read the site totals: {e}")
+
+    if stats is None:
+        # Not built yet, or Redis is down: count them from the database
+        total_users = User.query.count()
+        total_investment = whole_won(
+            db.session.query(func.sum(UserStrategy._investing_limit))
+            .filter(UserStrategy.active == True)
+            .scalar()
+        )
+        stats = {"total_users": total_users, "total_investment": total_investment}
 
-    return render_template(
-        "index.html", total_users=total_users, total_investment=total_investment
-    )
+    return render_template("index.html", **stats)
 
 
 @bp.route("/explain")
@@ -58,73 +82,20 @@ def explain():
 def strategies():
 
     coins = db.session.scalars(sa.select(Coin)).all()
-    coin_performance_data = {}
-    REDIS_URL = current_app.config["REDIS_URL"]
-    redis_client = redis.StrictRedis.from_url(REDIS_URL)
-
+    redis_client = get_redis_client(current_app)
+    # Performance metrics are computed hourly and stored in Redis
+    coin_performance_data = get_performance_data(
+        redis_client, "coin", [coin.id for coin in coins]
+    )
     for coin in coins:
-        # Fetch performance metrics from Redis
-        performance_24h = redis_client.hget(f"coin:{coin.id}:performance", "24h")
-        performance_30d = redis_client.hget(f"coin:{coin.id}:performance", "30d")
-        performance_1y = redis_client.hget(f"coin:{coin.id}:performance", "1y")
-
-        last_update_str = redis_client.hget(f"coin:{coin.id}:update", "last_update")
-
-        if last_update_str:
-            last_update_str = last_update_str.decode()
-            last_update_datetime = datetime.strptime(
-                last_update_str, "%Y-%m-%d %H:%M:%S"
-            )
-            last_update_datetime = last_update_datetime.replace(tzinfo=timezone.utc)
-
-        coin_performance_data[coin.id] = {
-            "name": coin.name,
-            "last_update": last_update_datetime if last_update_str else "N/A",
-            "24h": (
-                f"{float(performance_24h.decode()):.2f}" if performance_24h else "N/A"
-            ),
-            "30d": (
-                f"{float(performance_30d.decode()):.2f}" if performance_30d else "N/A"
-            ),
-            "1y": f"{float(performance_1y.decode()):.2f}" if performance_1y else "N/A",
-        }
+        coin_performance_data[coin.id]["name"] = coin.name
 
     strategies = db.session.scalars(sa.select(Strategy)).all()
-    strategy_performance_data = {}
+    strategy_performance_data = get_performance_data(
+        redis_client, "strategy", [strategy.id for strategy in strategies]
+    )
     for strategy in strategies:
-        # Fetch performance metrics from Redis
-        performance_24h = redis_client.hget(
-            f"strategy:{strategy.id}:performance", "24h"
-        )
-        performance_30d = redis_client.hget(
-            f"strategy:{strategy.id}:performance", "30d"
-        )
-        performance_1y = redis_client.hget(f"strategy:{strategy.id}:performance", "1y")
-
-        last_update_str = redis_client.hget(
-            f"strategy:{strategy.id}:update", "last_update"
-        )
-
-        if last_update_str:
-            last_update_str = last_update_str.decode()
-            last_update_datetime = datetime.strptime(
-                last_update_str, "%Y-%m-%d %H:%M:%S"
-            )
-            last_update_datetime = last_update_datetime.replace(tzinfo=timezone.utc)
-
-        strategy_performance_data[strategy.id] = {
-            "name": strategy.name,
-            "last_update": last_update_datetime if last_update_str else "N/A",
-            "24h": (
-                f"{float(performance_24h.decode()):.2f}" if performance_24h else "N/A"
-            ),
-            "30d": (
-                f"{float(performance_30d.decode()):.2f}" if performance_30d else "N/A"
-            ),
-            "1y": f"{float(performance_1y.decode()):.2f}" if performance_1y else "N/A",
-        }
-        # print(strategy.id)
-        # print(type(float(strategy_performance_data[strategy.id]["24h"])))
+        strategy_performance_data[strategy.id]["name"] = strategy.name
 
     form = EmptyForm()
 
@@ -136,28 +107,53 @@ def strategies():
         strategy_performance_data=strategy_performance_data,
         coin_performance_data=coin_performance_data,
         coins=coins,
+        push_url=current_app.config["PUSH_WEBSOCKET_URL"],
     )
 
 
+def get_backtest_params(strategy: Strategy) -> dict:
+    """The backtest settings last submitted on the strategy page, or the strategy's defaults."""
+    return {
+        # UTC
+        "execution_time": (
+            datetime.strptime(session.get("execution_time"), "%H:%M:%S").time()
+            if session.get("execution_time")
+            else datetime.now(timezone.utc)
+            .replace(minute=0, second=0, microsecond=0)
+            .time()
+        ),
+        "param1": (
+            int(session.get("param1"))
+            if session.get("param1")
+            else strategy.base_param1
+        ),
+        "param2": (
+            int(session.get("param2"))
+            if session.get("param2")
+            else strategy.base_param2
+        ),
+        "stop_loss": (
+            int(session.get("stop_loss")) if session.get("stop_loss") else None
+        ),
+    }
+
+
+def get_selected_coin(strategy: Strategy) -> str:
+    """The coin chosen with ?coin=, by default the strategy's first coin."""
+    selected_coin = request.args.get("coin")  # No need for a default value here
+    sorted_coins = sorted(strategy.coins, key=lambda coin: coin.id)
+    # Check if the selected coin is provided or if it's not in the strategy's coins
+    if selected_coin is None:
+        selected_coin = sorted_coins[0].name  # Set to the first coin if not provided
+    elif selected_coin not in [coin.name for coin in sorted_coins]:
+        abort(404)  # Abort if the selected coin is not in the strategy's coins
+    return selected_coin
+
+
 @bp.route("/strategy/<strategy_id>", methods=["GET", "POST"])
 def strategy(strategy_id):
-
+    """The strategy page; its chart and metrics load from strategy_backtest."""
     strategy = db.first_or_404(sa.select(Strategy).where(Strategy.id == strategy_id))
-    # Get parameters from session if they exist, otherwise use defaults
-    execution_time = (
-        datetime.strptime(session.get("execution_time"), "%H:%M:%S").time()
-        if session.get("execution_time")
-        else datetime.now(timezone.utc)
-        .replace(minute=0, second=0, microsecond=0)
-        .time()
-    )
-    param1 = (
-        int(session.get("param1")) if session.get("param1") else strategy.base_param1
-    )
-    param2 = (
-        int(session.get("param2")) if session.get("param2") else strategy.base_param2
-    )
-    stop_loss = int(session.get("stop_loss")) if session.get("stop_loss") else None
 
     # Clear session if this is a fresh page load (no query parameters)
     if not request.args and not request.form:
@@ -165,84 +161,44 @@ def strategy(strategy_id):
         session.pop("param1", None)
         session.pop("param2", None)
         session.pop("stop_loss", None)
-        # Reset to default values
-        execution_time = (
-            datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0).time()
-        )
-        param1 = strategy.base_param1
-        param2 = strategy.base_param2
-        stop_loss = None
-
-    if execution_time:
-        # Get user's timezone from session and convert to pytz timezone
-        user_timezone = pytz.timezone(session.get("timezone", "UTC"))
-
-        # Create UTC datetime from execution time
-        utc_datetime = datetime.now(timezone.utc).replace(
-            hour=execution_time.hour,
-            minute=execution_time.minute,
-            second=0,
-            microsecond=0,
-        )
-        # Convert UTC to user's local timezone
-        local_datetime = utc_datetime.astimezone(user_timezone).replace(tzinfo=None)
-        # Localize and get final execution time
-        execution_time = user_timezone.localize(local_datetime).time()
-
-    if param1:
-        param1 = int(param1)
-    if param2:
-        param2 = int(param2)
-
-    pre_data = {
-        "execution_time": execution_time,
-        "param1": param1,
-        "param2": param2,
-        "stop_loss": stop_loss,
-    }
+    params = get_backtest_params(strategy)
+
+    # Get user's timezone from session and convert to pytz timezone
+    user_timezone = pytz.timezone(session.get("timezone", "UTC"))
+    # Create UTC datetime from execution time
+    utc_datetime = datetime.now(timezone.utc).replace(
+        hour=params["execution_time"].hour,
+        minute=params["execution_time"].minute,
+        second=0,
+        microsecond=0,
+    )
+    # Convert UTC to user's local timezone
+    local_datetime = utc_datetime.astimezone(user_timezone).replace(tzinfo=None)
+    # Localize and get final execution time
+    pre_data = {**params, "execution_time": local_datetime.time()}
 
     if strategy.base_param2:
         form = SetBacktestTwoParamsForm(data=pre_data)
     else:
         form = SetBacktestOneParamForm(data=pre_data)
 
-    # get selected_coin
-    selected_coin = request.args.get("coin")  # No need for a default value here
     sorted_coins = sorted(strategy.coins, key=lambda coin: coin.id)
-    # Check if the selected coin is provided or if it's not in the strategy's coins
-    if selected_coin is None:
-        selected_coin = sorted_coins[0].name  # Set to the first coin if not provided
-    elif selected_coin not in [coin.name for coin in sorted_coins]:
-        abort(404)  # Abort if the selected coin is not in the strategy's coins
-
-    df = get_backtest(
-        strategy=strategy,
-        selected_coin=selected_coin,
-        param1=param1,
-        param2=param2,
-        stop_loss=int(stop_loss) if stop_loss is not None else None,
-        execution_time=datetime(1970, 1, 1, utc_datetime.hour, utc_datetime.minute),
-    )
+    selected_coin = get_selected_coin(strategy)
 
-    # If the form is submitted and valid, pass the execution time as an argument
+    # If the form is submitted and valid, the chart is loaded with its settings
     if form.validate_on_submit():
         execution_time = form.execution_time.data
-        param1 = form.param1.data
         stop_loss = form.stop_loss.data
         if strategy.base_param2:
-            param2 = form.param2.data
             session["param2"] = str(
                 form.param2.data
             )  # Convert int to string for session storage
         if stop_loss:
             session["stop_loss"] = str(stop_loss)
 
-        # session["execution_time"] = str(form.execution_time.data)
         session["param1"] = str(form.param1.data)
 
         # change execution_time to utc #
-        user_timezone = session.get("timezone", "UTC")
-        user_timezone = pytz.timezone(user_timezone)
         # Create a datetime object for today with the given time
         local_datetime = datetime.combine(datetime.today(), execution_time)
 
@@ -250,74 +206,98 @@ def strategy(strategy_id):
         localized_time = user_timezone.localize(local_datetime)
         # Convert to UTC
         utc_time = localized_time.astimezone(pytz.utc)
-        # print(f"{utc_time.hour}:{utc_time.minute}:{utc_time.second}")
         session["execution_time"] = (
             f"{utc_time.hour}:{utc_time.minute}:{utc_time.second}"
         )
-        df = get_backtest(
-            strategy=strategy,
-            selected_coin=selected_coin,
-            param1=param1,
-            param2=param2,
-            stop_loss=stop_loss,
-            execution_time=datetime(1970, 1, 1, utc_time.hour, utc_time.minute),
-        )
 
-    # Convert the time_utc column from string to datetime (assumed to be in UTC)
-    df["time_utc"] = pd.to_datetime(df["time_utc"], utc=True)  # Ensure it's tz-aware
+    return render_template(
+        "strategy.html",
+        strategy=strategy,
+        sorted_coins=sorted_coins,
+        form=form,
+        chart_url=url_for(
+            "main.strategy_backtest",
+            strategy_id=strategy.id,
+            coin=selected_coin,
+            range=request.args.get("range", "all"),
+            format="binary",
+        ),
+    )
+
 
-    # Handle time range selection before localizing the time to the user's timezone
-    time_range = request.args.get(
-        "range", "all"
-    )  # Get the time range from the URL, default to 'all'
+@bp.route("/strategy/<strategy_id>/backtest")
+def strategy_backtest(strategy_id):
+    """
+    The backtest of the strategy page as chart arrays and performance metrics.
 
-    # Get current UTC time for range filtering
-    now_utc = datetime.now(pytz.UTC)
+    Takes the page's coin and range arguments, plus points to downsample the
+    curves to about that many points (the chart's width) with LTTB, and
+    format=binary for a chart_utils.encode_chart frame instead of JSON. Both
+    equity curves are rebased to 100 and sent as float32, with times as epoch
+    milliseconds.
 
-    if time_range == "30d":
-        start_date = now_utc - timedelta(days=30)
-        df = df[df["time_utc"] >= start_date]
-    elif time_range == "1y":
-        start_date = now_utc - timedelta(days=365)
-        df = df[df["time_utc"] >= start_date]
-    # No need for an "all" case, as that's the default behavior
+    The full backtest is cached for the hour, so switching ranges only slices
+    it and recomputes the metrics of the slice.
+    """
+    strategy = db.first_or_404(sa.select(Strategy).where(Strategy.id == strategy_id))
+    selected_coin = get_selected_coin(strategy)
+    params = get_backtest_params(strategy)
 
-    # Localize the time to UTC first (as your times are in UTC), then convert to the user's local timezone
-    user_timezone = pytz.timezone(session.get("timezone", "UTC"))
-    df["time_localized"] = df["time_utc"].dt.tz_convert(user_timezone)
+    df = get_cached_backtest(
+        get_redis_client(current_app),
+        strategy=strategy,
+        selected_coin=selected_coin,
+        param1=params["param1"],
+        param2=params["param2"],
+        stop_loss=params["stop_loss"],
+        execution_time=datetime(
+            1970,
+            1,
+            1,
+            params["execution_time"].hour,
+            params["execution_time"].minute,
+        ),
+    )
 
-    # Format the localized time back to ISO 8601 format for Chart.js
-    times = df["time_localized"].dt.strftime("%Y-%m-%dT%H:%M:%S").tolist()
+    # Epoch milliseconds, compared and sent as is: the browser formats them in
+    # the user's timezone
+    times = epoch_ms(df["time_utc"])
 
-    cumulative_returns2 = df[
-        "cumulative_returns2"
-    ].tolist()  # Convert cumulative returns to list
-    close_prices = df["close"].tolist()  # Convert close prices to list
+    time_range = request.args.get("range", "all")
+    if time_range in ("30d", "1y"):
+        days = 30 if time_range == "30d" else 365
+        start = datetime.now(timezone.utc) - timedelta(days=days)
+        selected = times >= int(start.timestamp() * 1000)
+        df, times = df[selected], times[selected]
+
+    performance = {
+        name: json_safe(value) for name, value in get_performance(df).items()
+    }
 
-    # Remove the first data point if necessary (as in your example)
+    # Remove the first data point, before the strategy's first decision
     times = times[1:]
-    cumulative_returns2 = cumulative_returns2[1:]
-    close_prices = close_prices[1:]
-    # Normalize both datasets to start from 100
-    start_value = 100
-    close_prices_normalized = [
-        price / close_prices[0] * start_value for price in close_prices
-    ]
-    cumulative_returns2_normalized = [
-        ret / cumulative_returns2[0] * start_value for ret in cumulative_returns2
-    ]
-    performance_dict = get_performance(df)
-    # Pass data to the template
+    series = {
+        "strategy": normalize(df["cumulative_returns2"].to_numpy()[1:]),
+        "close": normalize(df["close"].to_numpy()[1:]),
+    }
 
-    return render_template(
-        "strategy.html",
-        strategy=strategy,
-        sorted_coins=sorted_coins,
-        times=times,
-        cumulative_returns2_normalized=cumulative_returns2_normalized,
-        close_prices_normalized=close_prices_normalized,
-        form=form,
-        performance_dict=performance_dict,
+    points = request.args.get("points", type=int)
+    if points:
+        indices = downsample(times, series, points)
+        times = times[indices]
+        series = {name: values[indices] for name, values in series.items()}
+
+    header = {"performance": performance}
+    if request.args.get("format") == "binary":
+        return Response(
+            encode_chart(header, times, series), mimetype="application/octet-stream"
+        )
+    return jsonify(
+        {
+            **header,
+            "times": times.tolist(),
+            **{name: values.tolist() for name, values in series.items()},
+        }
     )
 
 
@@ -386,6 +366,8 @@ def remove_from_strategies(name):
             .where(UserStrategy.user_id == current_user.id)
             .where(UserStrategy.strategy_id == strategy.id)
         )
+        # Take the strategy out of the execution schedule before removing it
+        user_strategy.deactivate()
         db.session.delete(user_strategy)
         db.session.commit()
         flash(f"{strategy.name} 전략이 내 전략에서 삭제되었습니다.")
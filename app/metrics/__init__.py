@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint("metrics", __name__)
+
+from app.metrics import routes
@@ -0,0 +1,49 @@
+import time
+from collections import Counter
+
+import sqlalchemy as sa
+from flask import abort, current_app, g, request
+
+from app.metrics import bp
+from app.utils.metrics import (
+    DB_QUERIES_PER_REQUEST,
+    REDIS_COMMANDS_PER_REQUEST,
+    REQUEST_LATENCY,
+    count_call,
+    generate_metrics,
+)
+
+
+@sa.event.listens_for(sa.engine.Engine, "before_cursor_execute")
+def count_db_query(*args, **kwargs):
+    count_call("db")
+
+
+@bp.before_app_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_calls = Counter()
+
+
+@bp.after_app_request
+def observe_request_metrics(response):
+    started = g.get("metrics_started")
+    if started is None or request.endpoint == "metrics.metrics":
+        return response
+    endpoint = request.endpoint or "unmatched"
+    REQUEST_LATENCY.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - started
+    )
+    DB_QUERIES_PER_REQUEST.labels(endpoint).observe(g.metrics_calls["db"])
+    REDIS_COMMANDS_PER_REQUEST.labels(endpoint).observe(g.metrics_calls["redis"])
+    return response
+
+
+@bp.route("/metrics")
+def metrics():
+    # Not served at all unless a token is configured
+    token = current_app.config["METRICS_TOKEN"]
+    if not token or request.headers.get("Authorization") != f"Bearer {token}":
+        abort(404)
+    payload, content_type = generate_metrics()
+    return payload, 200, {"Content-Type": content_type}
@@ -8,9 +8,10 @@ from hashlib import md5
 from typing import Optional
 
 import pandas as pd
-import pyupbit
+import redis
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from celery.result import AsyncResult
 from flask import current_app, flash, redirect, url_for
 from flask_login import UserMixin
@@ -21,18 +22,94 @@ from werkzeug.security import check_password_hash, generate_password_hash
 from app import db, login
 
 # from app.tasks import update_strategies_historical_data
+from app.utils.balance_cache import get_cached_balance, invalidate_balances
+from app.utils.candle_aggregator import get_live_candles, get_live_since
+from app.utils.clock import utc_now
 from app.utils.crypto_utils import decrypt_api_key, encrypt_api_key
 from app.utils.df_utils import get_dataframe_from_pickle, save_dataframe_as_pickle
 from app.utils.formatter import format_integer
 from app.utils.handle_candle import concat_candles, get_candles
 from app.utils.key_manager import get_fernet
+from app.utils.metrics import STAGE_LATENCY, observe_since, observe_trigger_to_order
+from app.utils.order_intents import (
+    has_pending_order,
+    hold_pending_order,
+    submit_order_intent,
+)
+from app.utils.price_stream import USER_STRATEGY_CHANNEL, get_latest_prices
+from app.utils.push_channel import publish_user_update
+from app.utils.redis_utils import get_redis_client
+from app.utils.schedule_index import add_to_schedule, remove_from_schedule
+from app.utils.site_stats import set_investment
 from app.utils.trading_conditions import get_condition
+from app.utils.upbit_client import (
+    UpbitClient,
+    UpbitError,
+    client_pool,
+    parse_upbit_time,
+)
 
 tickers = {
     "bitcoin": "KRW-BTC",
     "ethereum": "KRW-ETH",
 }
 
+# Executions of a user's strategies hold a per-user lock this long at most
+EXECUTION_LOCK_TIMEOUT = 300  # seconds
+# The fill of an order placed by an execution is awaited this long, so the
+# execution ends well before its lock expires
+FILL_WAIT_TIMEOUT = 120  # seconds
+# An order still unfilled after FILL_WAIT_TIMEOUT is checked again this often by
+# reconcile_order_fill, until its pending order key expires
+FILL_RECONCILE_INTERVAL = 10  # seconds
+# How long activating a strategy waits for its first execution
+ACTIVATION_WAIT = 10  # seconds
+
+
+def wait_for_fill(upbit, order_uuid: str) -> dict:
+    """Poll an order until it has trades, for at most FILL_WAIT_TIMEOUT."""
+    deadline = time.monotonic() + FILL_WAIT_TIMEOUT
+    order = upbit.get_order(order_uuid)
+    while not order.get("trades"):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Order {order_uuid} was not filled in time.")
+        time.sleep(1)
+        order = upbit.get_order(order_uuid)
+    return order
+
+
+def get_buy_amount(user_strategy, krw_balance: float) -> float:
+    """KRW a market buy of user_strategy spends, leaving room for the fee."""
+    buy_needed: float = min(
+        krw_balance * 0.9995, user_strategy.investing_limit * 0.9995
+    )
+    # fix this. if the man has 100000 won, he can't buy.
+    if buy_needed < 100000 * 0.9995:
+        raise ValueError(
+            f"{user_strategy.user.username} 현재 보유 원화({krw_balance})이 최소 주문 금액({100000})보다 적습니다."
+        )
+    return buy_needed
+
+
+def defer_fill(redis_client, user_strategy, side: str, order_uuid: str):
+    """
+    Leave an accepted order whose fill wait timed out to reconcile_order_fill.
+
+    New orders of the strategy are held back until the fill is applied, so the
+    next trigger doesn't place the same order again.
+    """
+    if redis_client is not None:
+        hold_pending_order(redis_client, user_strategy.id, order_uuid)
+    current_app.extensions["celery"].send_task(
+        "app.tasks.reconcile_order_fill",
+        args=[user_strategy.id, order_uuid, side],
+        countdown=FILL_RECONCILE_INTERVAL,
+    )
+    current_app.logger.warning(
+        f"Order {order_uuid} of {user_strategy} was not filled in time, left to reconcile."
+    )
+
+
 # Association table
 coin_strategies = sa.Table(
     "coin_strategies",
@@ -148,6 +225,7 @@ class User(UserMixin, db.Model):
 
         # Hash the access key and store it
         self.open_api_key_access_upbit_hash = self.hash_api_key(api_key_access)
+        client_pool.invalidate(self.id)
 
     def get_open_api_key(self) -> str:
         """Decrypt and retrieve the Upbit API key."""
@@ -206,10 +284,9 @@ class User(UserMixin, db.Model):
         masked_email = re.sub(email_pattern, r"\1***\2", self.email)
         return masked_email
 
-    def create_upbit_client(self):
-        """Create and return a pyupbit Upbit client using the user's API keys."""
-        api_key_access, api_key_secret = self.get_open_api_key()
-        return pyupbit.Upbit(access=api_key_access, secret=api_key_secret)
+    def create_upbit_client(self) -> UpbitClient:
+        """Return an Upbit client using the user's API keys, reused across executions."""
+        return client_pool.get(self)
 
     def is_my_strategy(self, strategy):
         return (
@@ -239,6 +316,13 @@ class Coin(db.Model):
         index=True,
         unique=True,
     )
+    # Upbit market code, e.g. "KRW-BTC"
+    market: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(16),
+        index=True,
+        unique=True,
+        nullable=True,
+    )
     # Field to store pickled DataFrame data
     historical_data: so.Mapped[Optional[bytes]] = so.mapped_column(
         sa.LargeBinary,
@@ -265,6 +349,11 @@ class Coin(db.Model):
         passive_deletes=True,  # Enable passive deletes
     )
 
+    @property
+    def ticker(self) -> str:
+        """Upbit market code of the coin, falling back to the built-in tickers for older rows."""
+        return self.market or tickers.get(self.name)
+
     def save_historical_data(self, df: pd.DataFrame):
         """Save the historical data as binary pickle data."""
         # Use df_utils to convert DataFrame to pickle format
@@ -298,13 +387,13 @@ class Coin(db.Model):
     def make_historical_data(self):
         if not self.historical_data:
             # get historical data from the 2021/04/01 every minutes
-            long_df = get_candles(market=tickers[self.name])
+            long_df = get_candles(market=self.ticker)
         else:
             long_df = get_dataframe_from_pickle(self.historical_data)
 
             # check if long_df is outdated. if it is, then get fresh long_df
             # Assuming formatted_now is a datetime object without seconds (formatted_now = datetime.now().replace(second=0, microsecond=0))
-            formatted_now = datetime.now(timezone.utc).replace(
+            formatted_now = utc_now().replace(
                 second=0, microsecond=0
             )  # Convert formatted_now to naive if it has timezone info
             formatted_now_naive = formatted_now.replace(tzinfo=None)
@@ -314,16 +403,67 @@ class Coin(db.Model):
 
             # Compare the two naive datetime objects
             if last_time_utc + timedelta(hours=2, minutes=50) < formatted_now_naive:
-                long_df = get_candles(market=tickers[self.name])
+                long_df = get_candles(market=self.ticker)
 
-        now_minus_3hour = datetime.now(timezone.utc) - timedelta(hours=3)
-        now_minus_3hour = now_minus_3hour.strftime("%Y-%m-%d %H:%M:%S")
-        short_df = get_candles(market=tickers[self.name], start=now_minus_3hour)
+        # Prefer the minute bars built from the websocket feed; they are fresher
+        # than REST candles and cost no API quota
+        last_time_utc = pd.to_datetime(long_df.iloc[-1]["time_utc"])
+        formatted_now_naive = (
+            utc_now().replace(second=0, microsecond=0).replace(tzinfo=None)
+        )
+        short_df = self.get_live_candles(start=last_time_utc, end=formatted_now_naive)
+        if short_df is None:
+            # The live feed has a gap since the last stored candle; repair it from REST
+            now_minus_3hour = utc_now() - timedelta(hours=3)
+            now_minus_3hour = now_minus_3hour.strftime("%Y-%m-%d %H:%M:%S")
+            short_df = get_candles(market=self.ticker, start=now_minus_3hour)
         final_df = concat_candles(long_df=long_df, short_df=short_df)
 
         # add feature if final_df(concated df) has a time gap a lot.
         self.save_historical_data(final_df)
 
+    def get_live_candles(self, start: datetime, end: datetime) -> pd.DataFrame:
+        """Return the live minute bars from start to end, or None if the feed doesn't cover start."""
+        redis_client = get_redis_client(current_app)
+        if redis_client is None:
+            return None
+        try:
+            live_since = get_live_since(redis_client, self.ticker)
+            if live_since is None or live_since > start:
+                return None
+            return get_live_candles(redis_client, self.ticker, start=start, end=end)
+        except redis.RedisError as e:
+            current_app.logger.warning(
+                f"Failed to read live candles of {self.name}: {str(e)}"
+            )
+            return None
+
+    def reconcile_historical_data(self, minutes: int = 60):
+        """Verify the last minutes of stored history against REST candles and repair them."""
+        df = self.get_historical_data()
+        if df is None:
+            return
+        start = datetime.now(timezone.utc) - timedelta(minutes=minutes)
+        rest_df = get_candles(
+            market=self.ticker, start=start.strftime("%Y-%m-%d %H:%M:%S")
+        )
+
+        merged = rest_df.merge(df, on="time_utc", how="left", suffixes=("", "_stored"))
+        mismatched = merged[
+            merged["close_stored"].isna()
+            | ((merged["close"] - merged["close_stored"]).abs() > 1e-9)
+            | (
+                (merged["volume_market"] - merged["volume_market_stored"]).abs()
+                > 1e-6 * merged["volume_market"].abs().clip(lower=1)
+            )
+        ]
+        if len(mismatched) > 0:
+            current_app.logger.info(
+                f"Repairing {len(mismatched)} of {len(rest_df)} minute candles of {self.name} from REST."
+            )
+        # REST candles are authoritative, so they replace the stored rows either way
+        self.save_historical_data(concat_candles(long_df=df, short_df=rest_df))
+
     def __repr__(self):
         return f"<Coin name={self.name}>"
 
@@ -363,13 +503,23 @@ class Strategy(db.Model):
         passive_deletes=True,  # Enable passive deletes
     )
 
-    def execute_logic_for_user(self, user_strategy: "UserStrategy"):
-        """The core strategy logic, executed for a specific user."""
+    def execute_logic_for_user(
+        self,
+        user_strategy: "UserStrategy",
+        trigger: Optional[str] = None,
+        triggered_at: Optional[float] = None,
+    ):
+        """
+        The core strategy logic, executed for a specific user.
+
+        trigger ("tick" or "schedule") and triggered_at (epoch seconds) describe
+        the event that led to this execution and are only used for latency metrics.
+        """
         # check if the historical data is updated.
         while True:
             print(f"{user_strategy} started")
             # Assuming formatted_now is a datetime object without seconds (formatted_now = datetime.now().replace(second=0, microsecond=0))
-            formatted_now = datetime.now(timezone.utc).replace(
+            formatted_now = utc_now().replace(
                 second=0, microsecond=0
             )  # Convert formatted_now to naive if it has timezone info
             formatted_now_naive = formatted_now.replace(tzinfo=None)
@@ -394,11 +544,28 @@ class Strategy(db.Model):
 
         try:
             upbit = user_strategy.user.create_upbit_client()
-            # Fetch the initial balance to check for unexpected changes
+            redis_client = get_redis_client(current_app)
+            if redis_client is not None and has_pending_order(
+                redis_client, user_strategy.id
+            ):
+                # The fill of an earlier order is not applied yet
+                current_app.logger.info(
+                    f"{user_strategy} still has an order in flight, skipped."
+                )
+                return
+            # Check the initial balance for unexpected changes, using the balances
+            # prefetched before the execution minute when there are any
             if user_strategy.holding_position:
-                coin_balance: float = upbit.get_balance(
-                    tickers[user_strategy.target_currency.name]
+                coin_balance = get_cached_balance(
+                    redis_client,
+                    user_strategy.user_id,
+                    user_strategy.target_currency.ticker,
                 )
+                if coin_balance is None or user_strategy.sell_needed > coin_balance:
+                    # Not prefetched, or the prefetched balance is out of date
+                    coin_balance: float = upbit.get_balance(
+                        user_strategy.target_currency.ticker
+                    )
                 if user_strategy.sell_needed > coin_balance:
                     raise ValueError(
                         f"{user_strategy.target_currency.name} 현재 보유 수량({coin_balance})이 판매 수량({user_strategy.sell_needed})보다 적습니다."
@@ -407,78 +574,92 @@ class Strategy(db.Model):
                 sell_needed = user_strategy.sell_needed
 
             else:
-                krw_balance: float = upbit.get_balance()
-                buy_needed: float = min(
-                    krw_balance * 0.9995, user_strategy.investing_limit * 0.9995
+                krw_balance = get_cached_balance(
+                    redis_client, user_strategy.user_id, "KRW"
                 )
-                # fix this. if the man has 100000 won, he can't buy.
-                if buy_needed < 100000 * 0.9995:
-                    raise ValueError(
-                        f"{user_strategy.user.username} 현재 보유 원화({krw_balance})이 최소 주문 금액({100000})보다 적습니다."
-                    )
+                krw_prefetched = krw_balance is not None
+                if not krw_prefetched or krw_balance < 100000:
+                    krw_balance: float = upbit.get_balance()
+                buy_needed = get_buy_amount(user_strategy, krw_balance)
 
             # Buy & sell condition check and execute order
-            condition = get_condition(
-                self.name,
-                user_strategy.execution_time,
-                user_strategy.holding_position,
-                user_strategy.param1,
-                user_strategy.param2,
-                user_strategy.stop_loss,
-                short_historical_data,
-            )
+            with STAGE_LATENCY.labels("condition_eval").time():
+                condition = get_condition(
+                    self.name,
+                    user_strategy.execution_time,
+                    user_strategy.holding_position,
+                    user_strategy.param1,
+                    user_strategy.param2,
+                    user_strategy.stop_loss,
+                    short_historical_data,
+                )
             # condition = "buy"
             print(f"condition: {condition}")
 
-            if condition == "buy":
-                buy = upbit.buy_market_order(
-                    tickers[user_strategy.target_currency.name], buy_needed
+            if condition in ("buy", "sell") and current_app.config["ORDER_GATEWAY"]:
+                # The order gateway places the order and reports the fill to
+                # apply_order_fill, which updates this strategy
+                identifier = submit_order_intent(
+                    redis_client,
+                    user_strategy,
+                    "bid" if condition == "buy" else "ask",
+                    buy_needed if condition == "buy" else sell_needed,
+                    trigger,
+                    triggered_at,
                 )
+                if identifier is None:
+                    current_app.logger.info(
+                        f"{user_strategy} still has an order in flight, skipped."
+                    )
+
+            elif condition == "buy":
+                observe_trigger_to_order(trigger, triggered_at)
+                submitted = time.time()
+                try:
+                    buy = upbit.buy_market_order(
+                        user_strategy.target_currency.ticker, buy_needed
+                    )
+                except UpbitError as e:
+                    if not krw_prefetched or e.name != "insufficient_funds_bid":
+                        raise
+                    # The prefetched KRW balance was out of date
+                    buy_needed = get_buy_amount(user_strategy, upbit.get_balance())
+                    buy = upbit.buy_market_order(
+                        user_strategy.target_currency.ticker, buy_needed
+                    )
+                invalidate_balances(redis_client, user_strategy.user_id)
+                accepted = time.time()
+                observe_since("order_submit", submitted)
                 # get order data
-                order = upbit.get_order(buy["uuid"])
-                trades = order.get("trades")
-                while not trades:
-                    time.sleep(1)
-                    order = upbit.get_order(buy["uuid"])
-                    trades = order.get("trades")
-                buy_krw = float(order["price"])
-                fee = float(order["reserved_fee"])
-                executed_volume = float(order["executed_volume"])
-                buy_price = round((buy_krw + fee) / executed_volume)
-
-                user_strategy.sell_needed = executed_volume
-                user_strategy.holding_position = True
+                try:
+                    order = wait_for_fill(upbit, buy["uuid"])
+                except TimeoutError:
+                    defer_fill(redis_client, user_strategy, "bid", buy["uuid"])
+                    return
+                observe_since("fill_confirm", accepted)
+                user_strategy.apply_buy_fill(order)
 
             elif condition == "sell":
+                observe_trigger_to_order(trigger, triggered_at)
+                submitted = time.time()
                 sell = upbit.sell_market_order(
-                    tickers[user_strategy.target_currency.name], sell_needed
+                    user_strategy.target_currency.ticker, sell_needed
                 )
-                order = upbit.get_order(sell["uuid"])
-                trades = order.get("trades")
-                while not trades:
-                    time.sleep(1)
-                    order = upbit.get_order(sell["uuid"])
-                    trades = order.get("trades")
-
-                executed_volume = float(order["executed_volume"])
-                fee = float(order["paid_fee"])
-
-                krw_total = 0
-                for trade in trades:
-                    krw_total += float(trade["funds"])
-
-                sell_price = round((krw_total - fee) / executed_volume)
-
-                user_strategy.sell_needed = 0
-                user_strategy.holding_position = False
-                # need to hanlde fee.
-                remain = user_strategy.user.available + user_strategy.investing_limit
-                krw_remain = krw_total - fee
-                user_strategy.investing_limit = min(remain, krw_remain)
-
-                user_strategy.user.update_available()
+                invalidate_balances(redis_client, user_strategy.user_id)
+                accepted = time.time()
+                observe_since("order_submit", submitted)
+                try:
+                    order = wait_for_fill(upbit, sell["uuid"])
+                except TimeoutError:
+                    defer_fill(redis_client, user_strategy, "ask", sell["uuid"])
+                    return
+                observe_since("fill_confirm", accepted)
+                user_strategy.apply_sell_fill(order)
 
             db.session.commit()
+            publish_user_update(redis_client, user_strategy.user_id)
+            # A sell reinvests the proceeds, changing the investing limit
+            set_investment(redis_client, user_strategy.id, user_strategy.investment)
 
             # # Save data
             # save_data()
@@ -500,6 +681,11 @@ class Strategy(db.Model):
 
 
 class UserStrategy(db.Model):
+    # execute_strategies looks up active strategies by execution time every minute
+    __table_args__ = (
+        sa.Index("ix_user_strategy_active_execution_time", "active", "execution_time"),
+    )
+
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     user_id: so.Mapped[int] = so.mapped_column(
         sa.ForeignKey("user.id"),
@@ -559,6 +745,14 @@ class UserStrategy(db.Model):
         nullable=False,
     )
 
+    pnl: so.Mapped[Optional["StrategyPnL"]] = so.relationship(
+        "StrategyPnL",
+        back_populates="user_strategy",
+        uselist=False,
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
     def should_execute(self, current_price):
         """Determine if the strategy should execute based on the current price."""
         if self.target_price == None:
@@ -577,6 +771,11 @@ class UserStrategy(db.Model):
         # No validation for now, commit changes directly
         db.session.commit()
 
+    @property
+    def investment(self) -> int:
+        """What this strategy adds to the site's total investment."""
+        return self.investing_limit if self.active else 0
+
     def check_investing_limit(self):
         # Check if the new investing limit exceeds the user's available balance
         self.user.update_available()
@@ -587,7 +786,9 @@ class UserStrategy(db.Model):
 
         return True
 
-    def execute(self):
+    def execute(
+        self, trigger: Optional[str] = None, triggered_at: Optional[float] = None
+    ):
         """Execute the strategy for the specific user at the configured execution time."""
         if self.execution_time:
             print(
@@ -597,7 +798,48 @@ class UserStrategy(db.Model):
             print(f"Executing {self.strategy.name} for {self.user.username} now")
 
         # Call the core strategy logic and apply it to the user
-        self.strategy.execute_logic_for_user(self)
+        self.strategy.execute_logic_for_user(self, trigger, triggered_at)
+
+    def apply_fill(self, side: str, order: dict) -> bool:
+        """
+        Apply a filled order of the order gateway, unless it was applied already.
+
+        apply_order_fill can run twice for one order (a redelivered task, or a
+        fill check queued again before its first outcome was acknowledged).
+
+        Returns:
+            bool: Whether the order was applied now.
+        """
+        recorded = db.session.scalar(
+            sa.select(Order.id).where(Order.uuid == order["uuid"])
+        )
+        if recorded is not None:
+            return False
+        if side == "bid":
+            self.apply_buy_fill(order)
+        else:
+            self.apply_sell_fill(order)
+        return True
+
+    def apply_buy_fill(self, order: dict):
+        """Record the position bought by a filled market buy order."""
+        recorded = Order.record(self, order)
+
+        self.sell_needed = recorded.volume
+        self.holding_position = True
+
+    def apply_sell_fill(self, order: dict):
+        """Close the position after a filled market sell order and reinvest the proceeds."""
+        recorded = Order.record(self, order)
+
+        self.sell_needed = 0
+        self.holding_position = False
+        # need to hanlde fee.
+        remain = self.user.available + self.investing_limit
+        krw_remain = recorded.funds - recorded.fee
+        self.investing_limit = min(remain, krw_remain)
+
+        self.user.update_available()
 
     def set_execution_time(self, time_str: str):
         """Sets the execution time based on a provided time string in hh:mm:ss format."""
@@ -613,6 +855,7 @@ class UserStrategy(db.Model):
         # print(time_obj)
         # print(self.execution_time)
         db.session.commit()
+        self.sync_change()
 
     def activate(self):
         """activate a strategy and update the user's available balance."""
@@ -627,10 +870,12 @@ class UserStrategy(db.Model):
                 )
                 # Wait for task completion with timeout
                 try:
-                    task.get(timeout=10)  # Wait up to 10 seconds for task completion
+                    task.get(timeout=ACTIVATION_WAIT)
                     return (True, "success")
-                except TimeoutError:
-                    return (False, "전략 실행 시간이 초과되었습니다.")
+                except CeleryTimeoutError:
+                    # Still queued behind another execution of the user, or still
+                    # running: the task activates the strategy once it runs
+                    return (True, "pending")
                 except Exception as task_error:
                     return (False, f"전략 실행 중 오류: {str(task_error)}")
             else:
@@ -642,6 +887,286 @@ class UserStrategy(db.Model):
         """Deactivate a strategy and update the user's available balance."""
         self.active = False
         db.session.commit()
+        self.sync_change()
+
+    def sync_change(self):
+        """
+        Propagate a change of this strategy to the schedule index, the price
+        listeners, the push servers and the landing page totals.
+        """
+        redis_client = get_redis_client(current_app)
+        if redis_client is None:
+            return
+        try:
+            if self.active and self.execution_time is not None:
+                add_to_schedule(redis_client, self.id, self.execution_time)
+            else:
+                remove_from_schedule(redis_client, self.id)
+            # Price listeners keep active strategies in memory and reload this one
+            redis_client.publish(USER_STRATEGY_CHANNEL, self.id)
+            publish_user_update(redis_client, self.user_id)
+            set_investment(redis_client, self.id, self.investment)
+        except redis.RedisError as e:
+            # The database stays the source of truth; the hourly rebuild repairs the index
+            current_app.logger.warning(
+                f"Failed to propagate change of {self}: {str(e)}"
+            )
 
     def __repr__(self):
         return f"<UserStrategy user_id={self.user_id}, strategy_id={self.strategy_id}>"
+
+
+class Order(db.Model):
+    """A filled order placed for a UserStrategy, as reported by Upbit."""
+
+    # Order history is read per user or per strategy, newest first
+    __table_args__ = (
+        sa.Index("ix_order_user_id_created_at", "user_id", "created_at"),
+        sa.Index(
+            "ix_order_user_strategy_id_created_at", "user_strategy_id", "created_at"
+        ),
+    )
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    # Upbit order uuid and the client identifier it was placed with, if any
+    uuid: so.Mapped[str] = so.mapped_column(sa.String(36), unique=True)
+    identifier: so.Mapped[Optional[str]] = so.mapped_column(
+        sa.String(64), nullable=True
+    )
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey("user.id", ondelete="CASCADE"), nullable=False
+    )
+    # Kept in the ledger when the strategy is deleted
+    user_strategy_id: so.Mapped[Optional[int]] = so.mapped_column(
+        sa.ForeignKey("user_strategy.id", ondelete="SET NULL"), nullable=True
+    )
+    market: so.Mapped[str] = so.mapped_column(sa.String(16))
+    # "bid" or "ask"
+    side: so.Mapped[str] = so.mapped_column(sa.String(3))
+    # Coins bought or sold, the KRW they traded for, and the fee paid on top
+    volume: so.Mapped[float] = so.mapped_column(sa.Float)
+    funds: so.Mapped[float] = so.mapped_column(sa.Float)
+    fee: so.Mapped[float] = so.mapped_column(sa.Float)
+    # Naive UTC, like the other timestamps of the app
+    created_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime)
+
+    fills: so.Mapped[list["Fill"]] = so.relationship(
+        "Fill",
+        back_populates="order",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    @property
+    def price(self) -> float:
+        """Average price per coin, fee included."""
+        if self.side == "bid":
+            return (self.funds + self.fee) / self.volume
+        return (self.funds - self.fee) / self.volume
+
+    @classmethod
+    def record(cls, user_strategy: "UserStrategy", order: dict) -> "Order":
+        """
+        Add a filled Upbit order of user_strategy to the ledger and its PnL summary.
+
+        The fills go in with one bulk insert. Nothing is committed.
+
+        Args:
+            user_strategy (UserStrategy): The strategy the order was placed for.
+            order (dict): The order as returned by Upbit's /v1/order, with its trades.
+
+        Returns:
+            Order: The recorded order.
+        """
+        trades = order.get("trades") or []
+        recorded = cls(
+            uuid=order["uuid"],
+            identifier=order.get("identifier"),
+            user_id=user_strategy.user_id,
+            user_strategy_id=user_strategy.id,
+            market=order["market"],
+            side=order["side"],
+            volume=float(order["executed_volume"]),
+            funds=sum(float(trade["funds"]) for trade in trades),
+            fee=float(order["paid_fee"]),
+            created_at=parse_upbit_time(order["created_at"]),
+        )
+        db.session.add(recorded)
+        db.session.flush()
+        if trades:
+            db.session.execute(
+                sa.insert(Fill),
+                [
+                    {
+                        "order_id": recorded.id,
+                        "uuid": trade["uuid"],
+                        "price": float(trade["price"]),
+                        "volume": float(trade["volume"]),
+                        "funds": float(trade["funds"]),
+                        "created_at": parse_upbit_time(trade["created_at"]),
+                    }
+                    for trade in trades
+                ],
+            )
+
+        pnl = user_strategy.pnl
+        if pnl is None:
+            pnl = StrategyPnL(
+                user_strategy_id=user_strategy.id, user_id=user_strategy.user_id
+            )
+            user_strategy.pnl = pnl
+        pnl.apply(recorded)
+        return recorded
+
+    def __repr__(self):
+        return f"<Order {self.side} {self.volume} {self.market}>"
+
+
+class Fill(db.Model):
+    """A trade that (partly) filled an Order."""
+
+    id: so.Mapped[int] = so.mapped_column(primary_key=True)
+    order_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey("order.id", ondelete="CASCADE"), index=True, nullable=False
+    )
+    # Upbit trade uuid
+    uuid: so.Mapped[str] = so.mapped_column(sa.String(36), unique=True)
+    price: so.Mapped[float] = so.mapped_column(sa.Float)
+    volume: so.Mapped[float] = so.mapped_column(sa.Float)
+    funds: so.Mapped[float] = so.mapped_column(sa.Float)
+    created_at: so.Mapped[datetime] = so.mapped_column(sa.DateTime)
+
+    order: so.Mapped["Order"] = so.relationship("Order", back_populates="fills")
+
+    def __repr__(self):
+        return f"<Fill {self.volume} at {self.price}>"
+
+
+class StrategyPnL(db.Model):
+    """
+    Running profit and loss of a UserStrategy, updated with each recorded Order.
+
+    The open position is carried at its average cost, fees included, so
+    realized_pnl is what the closed trades returned after all fees.
+    """
+
+    user_strategy_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey("user_strategy.id", ondelete="CASCADE"), primary_key=True
+    )
+    user_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey("user.id", ondelete="CASCADE"), index=True, nullable=False
+    )
+    position_volume: so.Mapped[float] = so.mapped_column(
+        sa.Float, default=0, nullable=False
+    )
+    position_cost: so.Mapped[float] = so.mapped_column(
+        sa.Float, default=0, nullable=False
+    )
+    realized_pnl: so.Mapped[float] = so.mapped_column(
+        sa.Float, default=0, nullable=False
+    )
+    fees_paid: so.Mapped[float] = so.mapped_column(sa.Float, default=0, nullable=False)
+    order_count: so.Mapped[int] = so.mapped_column(
+        sa.Integer, default=0, nullable=False
+    )
+    updated_at: so.Mapped[Optional[datetime]] = so.mapped_column(sa.DateTime)
+
+    user_strategy: so.Mapped["UserStrategy"] = so.relationship(
+        "UserStrategy", back_populates="pnl"
+    )
+
+    def apply(self, order: Order):
+        """Update the summary with a newly recorded order."""
+        # Defaults only apply on insert, and a new summary is updated before that
+        self.position_volume = self.position_volume or 0
+        self.position_cost = self.position_cost or 0
+        self.realized_pnl = self.realized_pnl or 0
+        self.fees_paid = self.fees_paid or 0
+        self.order_count = self.order_count or 0
+
+        if order.side == "bid":
+            self.position_volume += order.volume
+            self.position_cost += order.funds + order.fee
+        else:
+            sold = min(order.volume, self.position_volume)
+            cost = (
+                self.position_cost * sold / self.position_volume
+                if self.position_volume
+                else 0
+            )
+            self.realized_pnl += order.funds - order.fee - cost
+            self.position_volume -= sold
+            self.position_cost -= cost
+        self.fees_paid += order.fee
+        self.order_count += 1
+        self.updated_at = order.created_at
+
+    def unrealized_pnl(self, price: float) -> float:
+        """What closing the open position at price would return, before the sell fee."""
+        return self.position_volume * price - self.position_cost
+
+    @classmethod
+    def report(cls, user_id: int, redis_client) -> dict:
+        """
+        Position and profit and loss of each strategy of a user, JSON-ready.
+
+        Realized PnL comes from the summaries kept up to date with every fill,
+        unrealized PnL from the last price of the websocket feed, so this costs
+        one query and one Redis read and no exchange calls.
+
+        Args:
+            user_id (int): The user to report on.
+            redis_client: Redis client of the app, or None to leave out prices.
+
+        Returns:
+            dict: Per strategy and in total, realized and unrealized PnL (None
+                for a strategy without a position or price).
+        """
+        rows = db.session.execute(
+            sa.select(UserStrategy, Coin, cls)
+            .join(Coin, UserStrategy.coin_id == Coin.id)
+            .outerjoin(cls, cls.user_strategy_id == UserStrategy.id)
+            .where(UserStrategy.user_id == user_id)
+        ).all()
+        prices = {}
+        if redis_client is not None:
+            try:
+                prices = get_latest_prices(
+                    redis_client, {coin.ticker for _, coin, _ in rows}
+                )
+            except redis.RedisError as e:
+                # Realized PnL is still served, unrealized PnL is left out
+                current_app.logger.warning(f"Failed to read the latest prices: {e}")
+
+        strategies = []
+        for user_strategy, coin, summary in rows:
+            price = prices.get(coin.ticker)
+            strategies.append(
+                {
+                    "user_strategy_id": user_strategy.id,
+                    "coin_id": coin.id,
+                    "coin": coin.name,
+                    "active": user_strategy.active,
+                    "holding_position": user_strategy.holding_position,
+                    "sell_needed": user_strategy.sell_needed,
+                    "investing_limit": user_strategy.investing_limit,
+                    "price": price,
+                    "position_volume": summary.position_volume if summary else 0.0,
+                    "position_cost": summary.position_cost if summary else 0.0,
+                    "realized_pnl": summary.realized_pnl if summary else 0.0,
+                    "unrealized_pnl": (
+                        summary.unrealized_pnl(price)
+                        if summary is not None and price is not None
+                        else None
+                    ),
+                    "fees_paid": summary.fees_paid if summary else 0.0,
+                }
+            )
+        return {
+            "strategies": strategies,
+            "realized_pnl": sum(s["realized_pnl"] for s in strategies),
+            "unrealized_pnl": sum(s["unrealized_pnl"] or 0 for s in strategies),
+        }
+
+    def __repr__(self):
+        return f"<StrategyPnL user_strategy_id={self.user_strategy_id}>"
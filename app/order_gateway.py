@@ -0,0 +1,276 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import redis.asyncio as aioredis
+import requests
+from flask import current_app
+
+from app import create_app, db
+from app.models import User
+from app.utils.metrics import observe_since, observe_trigger_to_order
+from app.utils.order_intents import (
+    ORDER_CONSUMER_GROUP,
+    ORDER_STREAM,
+    ORDER_STREAM_MAXLEN,
+    PENDING_ORDER_KEY,
+    PENDING_ORDER_TTL,
+)
+from app.utils.upbit_client import UpbitError
+
+app = create_app()
+
+with app.app_context():
+    REDIS_URL = current_app.config["REDIS_URL"]
+
+# A single gateway runs at a time (rate limits are tracked in process), under a
+# fixed name so a restarted gateway picks up the intents its predecessor read
+CONSUMER_NAME = "gateway"
+READ_COUNT = 100
+READ_BLOCK_MS = 1000
+# Orders being placed or awaiting their fill at once
+MAX_IN_FLIGHT = 256
+# Threads making the blocking Upbit requests; matches the shared session's pool
+HTTP_THREADS = 32
+# Upbit allows 8 order requests per second per account
+ORDER_RATE = 8
+SUBMIT_ATTEMPTS = 5
+RETRY_BACKOFF = 0.5  # seconds, doubled after each attempt
+FILL_POLL_INTERVAL = 0.5  # seconds
+FILL_TIMEOUT = 60  # seconds
+
+
+class FillPending(Exception):
+    """The order was placed but its outcome is not known yet."""
+
+
+class TokenBucket:
+    """Allow rate requests per second on average, in bursts of up to rate."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OrderGateway:
+    """
+    Place the market orders queued by the strategy executors.
+
+    Orders of different accounts are placed concurrently, each account within
+    Upbit's order rate limit. Every intent carries a client order identifier:
+    after a timeout or server error the gateway looks the order up by it before
+    submitting again, so an order is never placed twice. Fills (or failures)
+    are handed to the apply_order_fill task.
+
+    An order whose fill isn't confirmed within FILL_TIMEOUT is queued again as
+    a fill check, keeping the strategy's pending order, until Upbit reports it
+    filled or cancelled: until then the strategy must not order again.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.executor = ThreadPoolExecutor(max_workers=HTTP_THREADS)
+        self.buckets = {}
+        self.in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+
+    async def call(self, fn, *args, **kwargs):
+        """Run a blocking Upbit request on the gateway's threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def get_client(self, user_id: int):
+        # Runs on a gateway thread, with its own app context for the database
+        with app.app_context():
+            user = db.session.get(User, user_id)
+            if user is None:
+                raise ValueError(f"User {user_id} no longer exists.")
+            return user.create_upbit_client()
+
+    async def submit(self, client, intent: dict) -> dict:
+        """Place the order of intent once, however many attempts it takes."""
+        place = (
+            client.buy_market_order
+            if intent["side"] == "bid"
+            else client.sell_market_order
+        )
+        bucket = self.buckets.setdefault(client.access, TokenBucket(ORDER_RATE))
+        backoff = RETRY_BACKOFF
+        for attempt in range(SUBMIT_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                return await self.call(
+                    place, intent["market"], intent["amount"], intent["identifier"]
+                )
+            except UpbitError as e:
+                error, retryable = e, e.status == 429 or e.status >= 500
+            except requests.RequestException as e:
+                error, retryable = e, True
+            # The order may have been placed by a request that failed on the way
+            # back, or before the gateway restarted
+            existing = await self.find(client, intent["identifier"])
+            if existing is not None:
+                return existing
+            if not retryable:
+                raise error
+            await asyncio.sleep(backoff)
+            backoff *= 2
+        raise TimeoutError(f"Order {intent['identifier']} could not be submitted.")
+
+    async def find(self, client, identifier: str) -> dict | None:
+        try:
+            return await self.call(client.get_order, identifier=identifier)
+        except (UpbitError, requests.RequestException):
+            return None
+
+    async def wait_for_fill(self, client, order: dict) -> dict:
+        deadline = time.monotonic() + FILL_TIMEOUT
+        while not order.get("trades"):
+            if order.get("state") == "cancel":
+                raise ValueError(f"Order {order['uuid']} was cancelled unfilled.")
+            if time.monotonic() >= deadline:
+                raise FillPending(f"Order {order['uuid']} was not filled in time.")
+            await asyncio.sleep(FILL_POLL_INTERVAL)
+            try:
+                order = await self.call(client.get_order, order["uuid"])
+            except (UpbitError, requests.RequestException) as e:
+                app.logger.warning(f"Checking order {order['uuid']} failed: {e}")
+        return order
+
+    async def place(self, entry_id, intent: dict):
+        observe_since("order_queue", intent["queued_at"])
+        result = {"order": None, "error": None}
+        try:
+            client = await self.call(self.get_client, intent["user_id"])
+            if intent.get("fill_checks"):
+                order = await self.find(client, intent["identifier"])
+                if order is None:
+                    raise FillPending(f"Order {intent['identifier']} not found.")
+                result["order"] = await self.wait_for_fill(client, order)
+            else:
+                observe_trigger_to_order(intent["trigger"], intent["triggered_at"])
+                submitted = time.time()
+                order = await self.submit(client, intent)
+                accepted = time.time()
+                observe_since("order_submit", submitted)
+                result["order"] = await self.wait_for_fill(client, order)
+                observe_since("fill_confirm", accepted)
+        except FillPending as e:
+            app.logger.warning(f"{e} Checking again.")
+            await self.requeue(intent)
+            await self.redis_client.xack(ORDER_STREAM, ORDER_CONSUMER_GROUP, entry_id)
+            return
+        except Exception as e:
+            app.logger.error(f"Order {intent['identifier']} failed: {e}")
+            result["error"] = str(e)
+        self.report(intent, result)
+        await self.redis_client.xack(ORDER_STREAM, ORDER_CONSUMER_GROUP, entry_id)
+
+    async def requeue(self, intent: dict):
+        """Queue intent again as a check of its placed order, keeping it pending."""
+        intent = {
+            **intent,
+            "fill_checks": intent.get("fill_checks", 0) + 1,
+            "queued_at": time.time(),
+        }
+        await self.redis_client.expire(
+            PENDING_ORDER_KEY.format(user_strategy_id=intent["user_strategy_id"]),
+            PENDING_ORDER_TTL,
+        )
+        await self.redis_client.xadd(
+            ORDER_STREAM,
+            {"intent": json.dumps(intent)},
+            maxlen=ORDER_STREAM_MAXLEN,
+            approximate=True,
+        )
+
+    def report(self, intent: dict, result: dict):
+        """Hand the outcome of an order to apply_order_fill."""
+        app.extensions["celery"].send_task(
+            "app.tasks.apply_order_fill",
+            kwargs={
+                "user_strategy_id": intent["user_strategy_id"],
+                "identifier": intent["identifier"],
+                "side": intent["side"],
+                **result,
+            },
+        )
+
+    async def handle(self, entry_id, fields):
+        try:
+            try:
+                intent = json.loads(fields[b"intent"])
+            except (KeyError, ValueError) as e:
+                app.logger.error(f"Dropping malformed order intent {entry_id}: {e}")
+                await self.redis_client.xack(
+                    ORDER_STREAM, ORDER_CONSUMER_GROUP, entry_id
+                )
+                return
+            await self.place(entry_id, intent)
+        finally:
+            self.in_flight.release()
+
+    async def run(self, stop_event: threading.Event):
+        try:
+            await self.redis_client.xgroup_create(
+                ORDER_STREAM, ORDER_CONSUMER_GROUP, id="$", mkstream=True
+            )
+        except redis.exceptions.ResponseError as e:
+            # BUSYGROUP: the group survives gateway restarts
+            if "BUSYGROUP" not in str(e):
+                raise
+        tasks = set()
+        # Intents delivered to this consumer before a restart come first; their
+        # identifiers make placing them again safe
+        last_id = "0"
+        while not stop_event.is_set():
+            response = await self.redis_client.xreadgroup(
+                ORDER_CONSUMER_GROUP,
+                CONSUMER_NAME,
+                {ORDER_STREAM: last_id},
+                count=READ_COUNT,
+                block=READ_BLOCK_MS,
+            )
+            entries = response[0][1] if response else []
+            if last_id != ">":
+                # Page through the unacknowledged intents, then read new ones
+                last_id = entries[-1][0] if entries else ">"
+            for entry_id, fields in entries:
+                await self.in_flight.acquire()
+                task = asyncio.create_task(self.handle(entry_id, fields))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+
+def run_order_gateway(stop_event: threading.Event):
+    """Run the order gateway until stop_event is set."""
+
+    async def main():
+        redis_client = aioredis.from_url(REDIS_URL)
+        gateway = OrderGateway(redis_client)
+        try:
+            await gateway.run(stop_event)
+        finally:
+            gateway.executor.shutdown()
+            await redis_client.aclose()
+
+    asyncio.run(main())
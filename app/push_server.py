@@ -0,0 +1,239 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import redis
+import redis.asyncio as aioredis
+import sqlalchemy as sa
+import websockets
+from flask import current_app
+
+from app import create_app, db
+from app.models import Coin, Strategy, StrategyPnL
+from app.utils.performance_utils import get_performance_data
+from app.utils.price_stream import get_price_streams
+from app.utils.push_channel import (
+    RANKING_UPDATE_CHANNEL,
+    USER_UPDATE_CHANNEL,
+    load_push_token,
+)
+from app.utils.tick_codec import decode_frame
+
+app = create_app()
+
+with app.app_context():
+    REDIS_URL = current_app.config["REDIS_URL"]
+    SECRET_KEY = current_app.config["SECRET_KEY"]
+    PUSH_HOST = current_app.config["PUSH_HOST"]
+    PUSH_PORT = current_app.config["PUSH_PORT"]
+    # Reports and rankings are read on worker threads with the blocking client
+    redis_client = redis.StrictRedis.from_url(REDIS_URL)
+
+# Prices are batched and pushed at most this often
+PUSH_INTERVAL = 1.0  # seconds
+READ_COUNT = 100
+READ_BLOCK_MS = 1000
+# Threads loading reports and rankings from the database
+LOAD_THREADS = 8
+
+
+class PushClient:
+    """A connected page and what it is sent."""
+
+    def __init__(self, websocket, user_id: int | None):
+        self.websocket = websocket
+        # None for pages without a push token, which only get the rankings
+        self.user_id = user_id
+        # Coins of the user's strategies, whose prices the page shows
+        self.coin_ids = set()
+
+
+class PushServer:
+    """
+    Stream updates from Redis to the connected dashboard and ranking pages.
+
+    Each server process reads every tick and every notification once and fans
+    them out to its own connections, so pages no longer poll and the work
+    grows with the number of events rather than the number of open pages.
+    Any number of processes can run side by side behind the same address.
+
+    Pages receive JSON messages:
+        {"type": "report", ...}: the user's positions and PnL (StrategyPnL.report),
+            on connecting and whenever a fill or setting changes them.
+        {"type": "prices", "prices": {coin id: price}}: the latest prices of
+            the user's coins, at most every PUSH_INTERVAL.
+        {"type": "ranking", "strategies": {...}, "coins": {...}}: the
+            performance shown on the ranking page, after each hourly update.
+    """
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.executor = ThreadPoolExecutor(max_workers=LOAD_THREADS)
+        self.clients = set()
+        self.by_user = {}
+        # Prices of the coins that traded since the last push
+        self.prices = {}
+        self.ranking = None
+        self.tasks = set()
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def send(self, clients, message: dict):
+        # broadcast never waits for a page: a slow one is skipped, not awaited
+        websockets.broadcast(
+            [client.websocket for client in clients], json.dumps(message)
+        )
+
+    def load_report(self, user_id: int) -> dict:
+        # Runs on a worker thread, with its own app context for the database
+        with app.app_context():
+            try:
+                return StrategyPnL.report(user_id, redis_client)
+            finally:
+                db.session.remove()
+
+    def load_ranking(self) -> dict:
+        with app.app_context():
+            try:
+                strategy_ids = db.session.scalars(sa.select(Strategy.id)).all()
+                coin_ids = db.session.scalars(sa.select(Coin.id)).all()
+            finally:
+                db.session.remove()
+        ranking = {"type": "ranking"}
+        for kind, key, ids in (
+            ("strategy", "strategies", strategy_ids),
+            ("coin", "coins", coin_ids),
+        ):
+            performance_data = get_performance_data(redis_client, kind, ids)
+            for performance in performance_data.values():
+                if performance["last_update"] != "N/A":
+                    performance["last_update"] = performance["last_update"].isoformat()
+            ranking[key] = performance_data
+        return ranking
+
+    def spawn(self, coroutine):
+        """Run coroutine in the background, logging instead of raising its errors."""
+
+        async def logged():
+            try:
+                await coroutine
+            except Exception as e:
+                app.logger.error(f"Push failed: {e.__class__.__name__}: {e}")
+
+        task = asyncio.create_task(logged())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def push_report(self, user_id: int):
+        report = await self.call(self.load_report, user_id)
+        clients = self.by_user.get(user_id, set())
+        for client in clients:
+            client.coin_ids = {strategy["coin_id"] for strategy in report["strategies"]}
+        self.send(clients, {"type": "report", **report})
+
+    async def push_ranking(self):
+        self.ranking = await self.call(self.load_ranking)
+        self.send(self.clients, self.ranking)
+
+    async def handle(self, websocket):
+        token = parse_qs(urlparse(websocket.path).query).get("token", [None])[0]
+        user_id = load_push_token(SECRET_KEY, token) if token else None
+        client = PushClient(websocket, user_id)
+        self.clients.add(client)
+        if user_id is not None:
+            self.by_user.setdefault(user_id, set()).add(client)
+        try:
+            if self.ranking is not None:
+                self.send([client], self.ranking)
+            if user_id is not None:
+                self.spawn(self.push_report(user_id))
+            # Pages only listen; anything they send is ignored
+            async for _ in websocket:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self.clients.discard(client)
+            if user_id is not None:
+                self.by_user[user_id].discard(client)
+                if not self.by_user[user_id]:
+                    del self.by_user[user_id]
+
+    async def read_prices(self, stop_event: threading.Event):
+        # Every push server reads every tick, so no consumer group. Start after
+        # the newest entry by id: "$" would skip ticks added between two reads
+        last_ids = {}
+        for stream in get_price_streams():
+            newest = await self.redis_client.xrevrange(stream, count=1)
+            last_ids[stream] = newest[0][0] if newest else "0-0"
+        while not stop_event.is_set():
+            response = await self.redis_client.xread(
+                last_ids, count=READ_COUNT, block=READ_BLOCK_MS
+            )
+            for stream, entries in response or []:
+                for entry_id, fields in entries:
+                    _, ticks = decode_frame(fields[b"data"])
+                    for tick in ticks:
+                        self.prices[tick.coin_id] = tick.price
+                last_ids[stream.decode()] = entries[-1][0]
+
+    async def push_prices(self, stop_event: threading.Event):
+        while not stop_event.is_set():
+            await asyncio.sleep(PUSH_INTERVAL)
+            if not self.prices:
+                continue
+            prices, self.prices = self.prices, {}
+            for client in list(self.clients):
+                changed = {
+                    coin_id: prices[coin_id]
+                    for coin_id in client.coin_ids
+                    if coin_id in prices
+                }
+                if changed:
+                    self.send([client], {"type": "prices", "prices": changed})
+
+    async def read_updates(self, stop_event: threading.Event):
+        pubsub = self.redis_client.pubsub()
+        await pubsub.subscribe(USER_UPDATE_CHANNEL, RANKING_UPDATE_CHANNEL)
+        try:
+            while not stop_event.is_set():
+                message = await pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=READ_BLOCK_MS / 1000
+                )
+                if message is None:
+                    continue
+                if message["channel"].decode() == RANKING_UPDATE_CHANNEL:
+                    self.spawn(self.push_ranking())
+                elif int(message["data"]) in self.by_user:
+                    self.spawn(self.push_report(int(message["data"])))
+        finally:
+            await pubsub.aclose()
+
+    async def run(self, stop_event: threading.Event):
+        await self.push_ranking()
+        async with websockets.serve(self.handle, PUSH_HOST, PUSH_PORT, reuse_port=True):
+            app.logger.info(f"Push server listening on {PUSH_HOST}:{PUSH_PORT}.")
+            await asyncio.gather(
+                self.read_prices(stop_event),
+                self.push_prices(stop_event),
+                self.read_updates(stop_event),
+            )
+
+
+def run_push_server(stop_event: threading.Event):
+    """Serve the push channel until stop_event is set."""
+
+    async def main():
+        async_redis_client = aioredis.from_url(REDIS_URL)
+        server = PushServer(async_redis_client)
+        try:
+            await server.run(stop_event)
+        finally:
+            server.executor.shutdown()
+            await async_redis_client.aclose()
+
+    asyncio.run(main())
@@ -1,59 +1,244 @@
-import json
+import struct
+import threading
+import time
+from typing import NamedTuple, Optional
 
 import redis
 import sqlalchemy as sa
 from flask import current_app
 
 from app import create_app, db
-from app.models import Coin, UserStrategy  # Import your models
+from app.models import UserStrategy  # Import your models
+from app.stream_service import RENEW_INTERVAL, Lease
+from app.utils.metrics import STAGE_LATENCY, observe_since
+from app.utils.price_stream import (
+    PRICE_CONSUMER_GROUP,
+    USER_STRATEGY_CHANNEL,
+    get_slot_streams,
+)
+from app.utils.tick_codec import SequenceTracker, Tick, decode_frame
 
 app = create_app()
 
 with app.app_context():
     REDIS_URL = current_app.config["REDIS_URL"]
     redis_client = redis.StrictRedis.from_url(REDIS_URL)
-
-ticker_to_coin = {"KRW-BTC": "bitcoin", "KRW-ETH": "ethereum"}
-
-
-def handle_price_update(message):
-    """Process price update messages and execute strategies if conditions are met."""
-
+    PRICE_LISTENERS = current_app.config["PRICE_LISTENERS"]
+
+# Each listener holds one of PRICE_LISTENERS slot leases and reads the partitions
+# of its slot alone, as consumer "listener-{slot}": the ticks of a ticker are
+# handled in order, and a restarted listener takes over the same consumer
+SLOT_LEASE = "listener:slot:{slot}"
+CONSUMER_NAME = "listener-{slot}"
+READ_COUNT = 100
+READ_BLOCK_MS = 1000
+
+# Full reload of the strategy cache, in case a change notification was missed
+STRATEGY_RELOAD_INTERVAL = 300  # seconds
+
+
+class ActiveStrategy(NamedTuple):
+    """The parts of an active UserStrategy a tick is checked against."""
+
+    id: int
+    coin_id: int
+    target_price: Optional[float]
+
+    def should_execute(self, current_price):
+        # Same rule as UserStrategy.should_execute
+        if self.target_price is None:
+            return False
+        return current_price >= self.target_price
+
+
+class StrategyCache:
+    """Active UserStrategies per coin, kept in memory so ticks need no database query."""
+
+    def __init__(self):
+        self.by_coin = {}
+        self.loaded_at = 0.0
+
+    @staticmethod
+    def select_active():
+        return sa.select(
+            UserStrategy.id, UserStrategy.coin_id, UserStrategy.target_price
+        ).where(UserStrategy.active == True)
+
+    def reload(self):
+        by_coin = {}
+        for row in db.session.execute(self.select_active()):
+            strategy = ActiveStrategy(*row)
+            by_coin.setdefault(strategy.coin_id, {})[strategy.id] = strategy
+        self.by_coin = by_coin
+        self.loaded_at = time.monotonic()
+        db.session.rollback()
+
+    def refresh(self, user_strategy_id: int):
+        """Reload one strategy after a change notification."""
+        for strategies in self.by_coin.values():
+            strategies.pop(user_strategy_id, None)
+        row = db.session.execute(
+            self.select_active().where(UserStrategy.id == user_strategy_id)
+        ).first()
+        if row is not None:
+            strategy = ActiveStrategy(*row)
+            self.by_coin.setdefault(strategy.coin_id, {})[strategy.id] = strategy
+        db.session.rollback()
+
+    def get(self, coin_id) -> list[ActiveStrategy]:
+        return list(self.by_coin.get(coin_id, {}).values())
+
+
+strategy_cache = StrategyCache()
+sequence_tracker = SequenceTracker()
+
+TRIGGER_SCAN_LATENCY = STAGE_LATENCY.labels("trigger_scan")
+
+
+def apply_strategy_changes(changes):
+    """Apply pending change notifications to the strategy cache."""
+    while True:
+        message = changes.get_message(timeout=0)
+        if message is None:
+            break
+        if message["type"] == "subscribe":
+            # (Re)subscribed: changes may have been missed while disconnected
+            strategy_cache.reload()
+        elif message["type"] == "message":
+            strategy_cache.refresh(int(message["data"]))
+    if time.monotonic() - strategy_cache.loaded_at >= STRATEGY_RELOAD_INTERVAL:
+        strategy_cache.reload()
+
+
+def handle_price_update(tick: Tick):
+    """Execute the strategies whose conditions are met by a price update."""
+    with TRIGGER_SCAN_LATENCY.time():
+        triggered = [
+            user_strategy.id
+            for user_strategy in strategy_cache.get(tick.coin_id)
+            if user_strategy.should_execute(tick.price)
+        ]
+    for user_strategy_id in triggered:
+        # Trigger a Celery task for user_strategy execution
+        app.extensions["celery"].send_task(
+            "app.tasks.execute_user_strategy",
+            args=[user_strategy_id],
+            # The exchange time of the tick, to measure latency up to the order
+            kwargs={"trigger": "tick", "triggered_at": tick.timestamp_ms / 1000},
+        )
+
+
+def ensure_consumer_group(streams):
+    for stream in streams:
+        try:
+            redis_client.xgroup_create(
+                stream, PRICE_CONSUMER_GROUP, id="$", mkstream=True
+            )
+        except redis.exceptions.ResponseError as e:
+            # BUSYGROUP: another listener created it first
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+def handle_entries(stream, entries):
+    """Handle stream entries and acknowledge them once processed."""
+    if not entries:
+        return
+    for entry_id, fields in entries:
+        try:
+            published_ms, ticks = decode_frame(fields[b"data"])
+        except (KeyError, ValueError, struct.error) as e:
+            app.logger.error(f"Dropping malformed tick frame {entry_id}: {e}")
+            continue
+        observe_since("listener_decode", published_ms / 1000)
+        for tick in ticks:
+            missed = sequence_tracker.check(tick)
+            if missed:
+                app.logger.warning(f"Missed {missed} ticks of coin {tick.coin_id}.")
+            handle_price_update(tick)
+    redis_client.xack(
+        stream, PRICE_CONSUMER_GROUP, *[entry_id for entry_id, _ in entries]
+    )
+
+
+def acquire_slot(stop_event: threading.Event):
+    """Block until a listener slot is free and return it with its lease, or None, None."""
+    while not stop_event.is_set():
+        for slot in range(PRICE_LISTENERS):
+            lease = Lease(SLOT_LEASE.format(slot=slot))
+            if lease.try_acquire():
+                return slot, lease
+        app.logger.info("All listener slots are taken, standing by.")
+        stop_event.wait(RENEW_INTERVAL)
+    return None, None
+
+
+def take_over_streams(streams, consumer: str):
+    """
+    Handle the ticks left unacknowledged in streams, then drop the other consumers.
+
+    The slot's streams have no other reader: these are ticks of this consumer's
+    previous run, or of consumers from before the slots changed.
+    """
+    for stream in streams:
+        start_id = "0-0"
+        while True:
+            start_id, entries, _ = redis_client.xautoclaim(
+                stream,
+                PRICE_CONSUMER_GROUP,
+                consumer,
+                min_idle_time=0,
+                start_id=start_id,
+                count=READ_COUNT,
+            )
+            handle_entries(stream, entries)
+            if start_id in (b"0-0", "0-0"):
+                break
+        for info in redis_client.xinfo_consumers(stream, PRICE_CONSUMER_GROUP):
+            name = info["name"]
+            name = name.decode() if isinstance(name, bytes) else name
+            if name != consumer:
+                redis_client.xgroup_delconsumer(stream, PRICE_CONSUMER_GROUP, name)
+
+
+def listen_to_price_stream(stop_event: threading.Event | None = None):
+    """
+    Consume price updates from the partitioned price streams until stop_event is set.
+
+    Each listener process takes a free slot of PRICE_LISTENERS and reads the
+    partitions of that slot, so more listeners spread the ticks while every
+    ticker is still handled by one listener, in order. Listeners beyond
+    PRICE_LISTENERS stand by and take over the slot of one that stops.
+    """
+    stop_event = stop_event or threading.Event()
+    slot, lease = acquire_slot(stop_event)
+    if lease is None:
+        return
+    consumer = CONSUMER_NAME.format(slot=slot)
+    streams = get_slot_streams(slot, PRICE_LISTENERS)
+    # The slot's coins were read by another listener until now
+    sequence_tracker.reset()
+    app.logger.info(f"Listening as {consumer} to {', '.join(streams)}.")
+    changes = redis_client.pubsub()
+    changes.subscribe(USER_STRATEGY_CHANNEL)
     try:
-        # The message data may need to be decoded from binary
-        data = json.loads(message["data"].decode("utf-8"))
-
-        # Extract ticker and price from the data
-        ticker = data.get("ticker")  # Make sure to use the correct key
-        current_price = data.get("price")
-
-        print("Ticker:", ticker, "Price:", current_price)  # Debug: Check values
-
-        # Fetch active strategies for the given ticker
-        user_strategies = db.session.scalars(
-            sa.select(UserStrategy)
-            .join(UserStrategy.target_currency)  # Join with the Coin table
-            .where(UserStrategy.active == True)
-            .where(Coin.name == ticker_to_coin.get(ticker))  # Use Coin.name
-        ).all()
-
-        for user_strategy in user_strategies:
-            if user_strategy.should_execute(current_price):
-                # Trigger a Celery task for user_strategy execution
-                app.extensions["celery"].send_task(
-                    "app.tasks.execute_user_strategy", args=[user_strategy.id]
+        ensure_consumer_group(streams)
+        # The strategy cache loads from the database, which needs an app context
+        with app.app_context():
+            apply_strategy_changes(changes)
+            take_over_streams(streams, consumer)
+            while not stop_event.is_set() and not lease.lost.is_set():
+                apply_strategy_changes(changes)
+                # Block for a bounded time so stop_event is noticed on a quiet feed
+                response = redis_client.xreadgroup(
+                    PRICE_CONSUMER_GROUP,
+                    consumer,
+                    {stream: ">" for stream in streams},
+                    count=READ_COUNT,
+                    block=READ_BLOCK_MS,
                 )
-
-    except Exception as e:
-        # Print any exceptions for debugging
-        print("Error parsing message:", e)
-
-
-def listen_to_redis_channel():
-    """Listen to the Redis Pub/Sub channel for coin price updates."""
-    pubsub = redis_client.pubsub()
-    pubsub.subscribe(**{"coin_prices": handle_price_update})
-
-    for message in pubsub.listen():
-        if message and message["type"] == "message":
-            handle_price_update(message)
+                for stream, entries in response or []:
+                    handle_entries(stream, entries)
+    finally:
+        changes.close()
+        lease.release()
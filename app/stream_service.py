@@ -0,0 +1,169 @@
+# app/stream_service.py
+
+import json
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+import redis
+from flask import current_app
+
+from app import create_app
+
+app = create_app()
+
+with app.app_context():
+    REDIS_URL = current_app.config["REDIS_URL"]
+    redis_client = redis.StrictRedis.from_url(REDIS_URL)
+
+LEASE_TTL = 30  # seconds a lease survives without renewal
+RENEW_INTERVAL = 10  # seconds between lease renewals and heartbeats
+BACKOFF_INITIAL = 1
+BACKOFF_MAX = 60
+# A run that lasted this long counts as healthy and resets the backoff
+HEALTHY_RUN_SECONDS = 60
+
+
+class Lease:
+    """A Redis lock held by one stream process and renewed while it is alive."""
+
+    def __init__(self, name, ttl=LEASE_TTL, renew_interval=RENEW_INTERVAL):
+        self.name = name
+        self.renew_interval = renew_interval
+        # The lease is renewed from a background thread, so the token can't be thread-local
+        self.lock = redis_client.lock(
+            f"stream:{name}:lease", timeout=ttl, thread_local=False
+        )
+        self.heartbeat_key = f"stream:{name}:heartbeat"
+        self.ttl = ttl
+        self.lost = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def acquire(self):
+        """Block until the lease is ours, standing by while another process holds it."""
+        while not self.try_acquire():
+            app.logger.info(f"Stream {self.name}: lease held elsewhere, standing by.")
+            time.sleep(self.renew_interval)
+
+    def try_acquire(self) -> bool:
+        """Take the lease if it is free, and keep renewing it."""
+        if not self.lock.acquire(blocking=False):
+            return False
+        self.beat()
+        self._thread = threading.Thread(target=self._renew, daemon=True)
+        self._thread.start()
+        return True
+
+    def beat(self):
+        """Publish a heartbeat so operators can see who owns the stream and since when."""
+        redis_client.set(
+            self.heartbeat_key,
+            json.dumps(
+                {
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "time": datetime.now(timezone.utc).isoformat(),
+                }
+            ),
+            ex=self.ttl,
+        )
+
+    def _renew(self):
+        renewed_at = time.monotonic()
+        while not self._stopped.wait(self.renew_interval):
+            try:
+                # Reset the TTL back to the full lease; fails if the lock was lost
+                self.lock.reacquire()
+                self.beat()
+                renewed_at = time.monotonic()
+            except redis.exceptions.LockError:
+                app.logger.error(f"Stream {self.name}: lease lost, stopping.")
+                self.lost.set()
+                return
+            except redis.RedisError as e:
+                app.logger.warning(f"Stream {self.name}: lease renewal failed: {e}")
+                # Past the TTL another process may already own the lease
+                if time.monotonic() - renewed_at >= self.ttl:
+                    app.logger.error(f"Stream {self.name}: lease expired, stopping.")
+                    self.lost.set()
+                    return
+
+    def release(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.lock.release()
+            redis_client.delete(self.heartbeat_key)
+        except redis.exceptions.LockError:
+            pass
+
+
+def run_supervised(name, target):
+    """
+    Run target under a renewed lease, restarting it with backoff when it fails.
+
+    Args:
+        name (str): Name of the stream, used for the lease and heartbeat keys.
+        target (callable): Function taking a threading.Event; it must return soon
+            after the event is set, which happens when the lease is lost.
+    """
+    while True:
+        lease = Lease(name)
+        lease.acquire()
+        app.logger.info(f"Stream {name}: lease acquired, starting.")
+        try:
+            run_until_lost(name, target, lease)
+        finally:
+            lease.release()
+        # Another process owns the stream now; go back to standing by
+
+
+def run_until_lost(name, target, lease):
+    backoff = BACKOFF_INITIAL
+    while not lease.lost.is_set():
+        started = time.monotonic()
+        try:
+            target(lease.lost)
+        except Exception as e:
+            app.logger.error(f"Stream {name}: {e.__class__.__name__}: {e}")
+        if lease.lost.is_set():
+            break
+        if time.monotonic() - started >= HEALTHY_RUN_SECONDS:
+            backoff = BACKOFF_INITIAL
+        # Jitter keeps several services from reconnecting in lockstep
+        delay = backoff * random.uniform(0.5, 1.5)
+        app.logger.info(f"Stream {name}: reconnecting in {delay:.1f}s.")
+        lease.lost.wait(delay)
+        backoff = min(backoff * 2, BACKOFF_MAX)
+
+
+def get_stream_targets():
+    """Map each service to its target and whether only one process may run it."""
+    # Imported lazily so each process only builds the clients it runs
+    from app.order_gateway import run_order_gateway
+    from app.push_server import run_push_server
+    from app.redis_listener import listen_to_price_stream
+    from app.websocket_client import run_websocket_client
+
+    return {
+        # A second websocket client would publish every tick twice
+        "websocket": (run_websocket_client, True),
+        # Listeners split the partitions between them, each under a slot lease
+        "listener": (listen_to_price_stream, False),
+        # Per-account order rate limits are tracked by the one gateway process
+        "orders": (run_order_gateway, True),
+        # Each push server fans every update out to its own connections
+        "push": (run_push_server, False),
+    }
+
+
+def get_lease_name(service, exclusive):
+    if exclusive:
+        return service
+    # A per-process lease never blocks, but still gives each process a heartbeat
+    return f"{service}:{socket.gethostname()}-{os.getpid()}"
@@ -1,57 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 
 import redis
+import requests
 import sqlalchemy as sa
 from celery import shared_task
 from flask import current_app
 from flask_mail import Message
 
 from app import create_app, db, mail
-from app.models import Coin, Strategy, UserStrategy
-from app.redis_listener import listen_to_redis_channel
+from app.models import (
+    EXECUTION_LOCK_TIMEOUT,
+    FILL_RECONCILE_INTERVAL,
+    Coin,
+    Strategy,
+    User,
+    UserStrategy,
+)
+from app.utils.balance_cache import (
+    BALANCE_PREFETCH_LEAD,
+    cache_balances,
+    invalidate_balances,
+)
+from app.utils.clock import utc_now
+from app.utils.metrics import LOCK_CONTENTION
+from app.utils.order_intents import PENDING_ORDER_TTL, clear_pending_order
 from app.utils.performance_utils import (
     calculate_coin_performance,
     calculate_strategy_performance,
 )
-from app.websocket_client import run_websocket_client
+from app.utils.push_channel import publish_ranking_update, publish_user_update
+from app.utils.schedule_index import (
+    get_minute_of_day,
+    get_scheduled_ids,
+    rebuild_schedule,
+)
+from app.utils.site_stats import rebuild_site_stats, set_investment
+from app.utils.upbit_client import UpbitError
 
 app = create_app()
 
+# Concurrent balance requests of the prefetch, each for a different Upbit account
+BALANCE_PREFETCH_WORKERS = 16
+
 with app.app_context():
     REDIS_URL = current_app.config["REDIS_URL"]
     redis_client = redis.StrictRedis.from_url(REDIS_URL)
 
 
-@shared_task
-def start_websocket_client():
-    """Celery task to start the WebSocket client."""
-    # Create a Redis lock object
-    lock = redis_client.lock("start_websocket_client", timeout=3600)  # Lock for 1 hour
-
-    # Attempt to acquire the lock
-    if lock.acquire(blocking=False):  # Non-blocking acquire
-        try:
-            # Only one task will proceed to run this
-            run_websocket_client()
-        finally:
-            # Ensure the lock is released when done
-            lock.release()
-
-
-@shared_task
-def start_redis_listener():
-    """Celery task to start the Redis Pub/Sub listener."""
-    # Create a Redis lock object
-    lock = redis_client.lock("start_redis_listener", timeout=3600)  # Lock for 1 hour
-
-    # Attempt to acquire the lock
-    if lock.acquire(blocking=False):  # Non-blocking acquire
-        try:
-            # Only one task will proceed to run this
-            listen_to_redis_channel()
-        finally:
-            # Ensure the lock is released when done
-            lock.release()
+def release_lock(lock):
+    """Release lock, which may have expired and been taken by another task meanwhile."""
+    try:
+        lock.release()
+    except redis.exceptions.LockNotOwnedError:
+        current_app.logger.warning(f"Lock {lock.name} expired before it was released.")
 
 
 @shared_task
@@ -82,6 +84,7 @@ def update_strategies_performance():
         redis_client.hset(f"strategy:{strategy.id}:performance", "24h", performance_24h)
         redis_client.hset(f"strategy:{strategy.id}:performance", "30d", performance_30d)
         redis_client.hset(f"strategy:{strategy.id}:performance", "1y", performance_1y)
+    publish_ranking_update(redis_client)
 
 
 @shared_task
@@ -99,6 +102,7 @@ def update_coins_performance():
         redis_client.hset(f"coin:{coin.id}:performance", "24h", coin_24h)
         redis_client.hset(f"coin:{coin.id}:performance", "30d", coin_30d)
         redis_client.hset(f"coin:{coin.id}:performance", "1y", coin_1y)
+    publish_ranking_update(redis_client)
 
 
 @shared_task
@@ -109,9 +113,16 @@ def update_and_execute():
 
     if not have_lock:
         # If another worker is running this task, exit the function
+        LOCK_CONTENTION.labels("update_and_execute").inc()
         print("Another instance of update_and_execute is already running.")
         return
     try:
+        # Fetch the balances of next minute's executions while this minute's run
+        next_minute = utc_now().replace(second=0, microsecond=0) + timedelta(minutes=1)
+        prefetch_balances.apply_async(
+            args=[next_minute.isoformat()],
+            eta=next_minute - timedelta(seconds=BALANCE_PREFETCH_LEAD),
+        )
         update_coins_historical_data()
         execute_strategies.delay()
 
@@ -120,24 +131,110 @@ def update_and_execute():
         # update_coins_performance()
         # update_strategies_performance()
         if current.minute == 0:
-            update_coins_performance()
-            update_strategies_performance()
+            # Hand the hourly analytics to the analytics queue so they don't hold
+            # up the next minute's executions
+            update_coins_performance.delay()
+            update_strategies_performance.delay()
+            rebuild_schedule_index.delay()
+            recount_site_stats.delay()
 
     finally:
         # Ensure the lock is released when the task is done
-        lock.release()
+        release_lock(lock)
 
 
-@shared_task
-def execute_user_strategy(user_strategy_id, first_execution=False):
+@shared_task(bind=True, acks_late=True, max_retries=120)
+def execute_user_strategy(
+    self, user_strategy_id, first_execution=False, trigger=None, triggered_at=None
+):
     print("task execute_user_strategy executed.")
     user_strategy = db.session.get(UserStrategy, user_strategy_id)
-    print(user_strategy, user_strategy.active)
-    if first_execution:
-        user_strategy.active = True
-    print(user_strategy, user_strategy.active)
-    if user_strategy and user_strategy.active:
-        user_strategy.execute()
+    if user_strategy is None:
+        # The strategy was removed after it was scheduled
+        return
+
+    # Serialize executions per user: two strategies of the same user share one
+    # KRW balance, so they must not place orders at the same time.
+    lock = redis_client.lock(
+        f"execute_user_strategy:user:{user_strategy.user_id}",
+        timeout=EXECUTION_LOCK_TIMEOUT,
+    )
+    if not lock.acquire(blocking=False):
+        LOCK_CONTENTION.labels("execute_user_strategy").inc()
+        current_app.logger.info(
+            f"Another execution for user {user_strategy.user_id} is running."
+        )
+        raise self.retry(countdown=1)
+    try:
+        print(user_strategy, user_strategy.active)
+        if first_execution:
+            user_strategy.active = True
+        print(user_strategy, user_strategy.active)
+        if user_strategy.active:
+            user_strategy.execute(trigger=trigger, triggered_at=triggered_at)
+            if first_execution:
+                user_strategy.sync_change()
+    finally:
+        release_lock(lock)
+
+
+@shared_task(bind=True, acks_late=True, max_retries=120)
+def apply_order_fill(self, user_strategy_id, identifier, side, order=None, error=None):
+    """
+    Update a UserStrategy with the outcome of an order placed by the order gateway,
+    or of one an execution left to reconcile_order_fill.
+    """
+    user_strategy = db.session.get(UserStrategy, user_strategy_id)
+    if user_strategy is None:
+        clear_pending_order(redis_client, user_strategy_id, identifier)
+        return
+
+    # Same lock as the executions, which read the state changed here
+    lock = redis_client.lock(
+        f"execute_user_strategy:user:{user_strategy.user_id}",
+        timeout=EXECUTION_LOCK_TIMEOUT,
+    )
+    if not lock.acquire(blocking=False):
+        LOCK_CONTENTION.labels("apply_order_fill").inc()
+        raise self.retry(countdown=1)
+    try:
+        if order is None:
+            current_app.logger.error(
+                f"Order {identifier} of {user_strategy} failed: {error}"
+            )
+            return
+        invalidate_balances(redis_client, user_strategy.user_id)
+        if not user_strategy.apply_fill(side, order):
+            current_app.logger.info(f"Order {identifier} was already applied.")
+            return
+        db.session.commit()
+        publish_user_update(redis_client, user_strategy.user_id)
+        set_investment(redis_client, user_strategy.id, user_strategy.investment)
+        current_app.logger.info(f"Applied order {identifier} to {user_strategy}.")
+    finally:
+        clear_pending_order(redis_client, user_strategy_id, identifier)
+        release_lock(lock)
+
+
+@shared_task(bind=True, max_retries=PENDING_ORDER_TTL // FILL_RECONCILE_INTERVAL)
+def reconcile_order_fill(self, user_strategy_id, order_uuid, side):
+    """Hand the outcome of an order an execution stopped waiting for to apply_order_fill."""
+    user_strategy = db.session.get(UserStrategy, user_strategy_id)
+    if user_strategy is None:
+        clear_pending_order(redis_client, user_strategy_id, order_uuid)
+        return
+    try:
+        order = user_strategy.user.create_upbit_client().get_order(order_uuid)
+    except (UpbitError, requests.RequestException) as e:
+        raise self.retry(exc=e, countdown=FILL_RECONCILE_INTERVAL)
+    if order.get("trades"):
+        apply_order_fill.delay(user_strategy_id, order_uuid, side, order=order)
+    elif order.get("state") == "cancel":
+        apply_order_fill.delay(
+            user_strategy_id, order_uuid, side, error="cancelled without trades"
+        )
+    else:
+        raise self.retry(countdown=FILL_RECONCILE_INTERVAL)
 
 
 @shared_task
@@ -145,31 +242,90 @@ def execute_strategies():
     """Launch a Celery task for each user's strategy that needs to be executed."""
     print("task execute_strategies executed.")
 
-    now = datetime.now(timezone.utc).replace(microsecond=0, second=0, tzinfo=None)
+    now = utc_now().replace(microsecond=0, second=0, tzinfo=None)
 
-    # Query active UserStrategies that match the current execution time (HH:MM:SS)
-    user_strategies = db.session.scalars(
-        sa.select(UserStrategy)
-        .where(UserStrategy.active == True)
-        .where(UserStrategy.execution_time == now.time())
-        # .where(UserStrategy.execution_time != None)
-        # .where(sa.func.time(UserStrategy.execution_time) == now.time())
-    ).all()
-    # print(now.time())
+    # Look up the UserStrategies due this minute in the Redis schedule index
+    user_strategy_ids = get_scheduled_ids(redis_client, now.time())
+    if user_strategy_ids is None:
+        # The index is cold (e.g. Redis was flushed), rebuild it from the database
+        schedule = rebuild_schedule_index()
+        user_strategy_ids = schedule.get(get_minute_of_day(now.time()), [])
 
     # Launch a separate task for each UserStrategy
-    for user_strategy in user_strategies:
+    triggered_at = now.replace(tzinfo=timezone.utc).timestamp()
+    for user_strategy_id in user_strategy_ids:
         execute_user_strategy.delay(
-            user_strategy_id=user_strategy.id
+            user_strategy_id=user_strategy_id,
+            trigger="schedule",
+            triggered_at=triggered_at,
         )  # Launch each task concurrently
 
         # Log the execution
-    if len(user_strategies) > 0:
+    if len(user_strategy_ids) > 0:
         current_app.logger.info(
-            f"Scheduled {len(user_strategies)} strategies to execute at {now}."
+            f"Scheduled {len(user_strategy_ids)} strategies to execute at {now}."
         )
 
 
+@shared_task
+def prefetch_balances(execution_minute: str):
+    """Fetch and cache the balances of the users with strategies due at execution_minute."""
+    execution_time = datetime.fromisoformat(execution_minute).time()
+    user_strategy_ids = get_scheduled_ids(redis_client, execution_time)
+    if not user_strategy_ids:
+        return
+    users = db.session.scalars(
+        sa.select(User)
+        .join(UserStrategy, UserStrategy.user_id == User.id)
+        .where(UserStrategy.id.in_(user_strategy_ids))
+        .distinct()
+    ).all()
+    # Clients are created here, they need the app to decrypt the keys
+    clients = {}
+    for user in users:
+        try:
+            clients[user.id] = user.create_upbit_client()
+        except Exception as e:
+            current_app.logger.warning(f"No Upbit client for {user}: {str(e)}")
+
+    def get_balances(client):
+        try:
+            return client.get_balances()
+        except (UpbitError, requests.RequestException):
+            # The execution fetches the balance itself
+            return None
+
+    with ThreadPoolExecutor(max_workers=BALANCE_PREFETCH_WORKERS) as executor:
+        balances = dict(zip(clients, executor.map(get_balances, clients.values())))
+    cache_balances(
+        redis_client,
+        {user_id: found for user_id, found in balances.items() if found is not None},
+    )
+
+
+@shared_task
+def rebuild_schedule_index():
+    """Rebuild the Redis schedule index from the active UserStrategies in the database."""
+    entries = db.session.execute(
+        sa.select(UserStrategy.id, UserStrategy.execution_time)
+        .where(UserStrategy.active == True)
+        .where(UserStrategy.execution_time != None)
+    ).all()
+    return rebuild_schedule(redis_client, entries)
+
+
+@shared_task
+def recount_site_stats():
+    """Recount the landing page totals from the database, correcting any drift."""
+    total_users = db.session.scalar(sa.select(sa.func.count(User.id)))
+    investments = db.session.execute(
+        sa.select(UserStrategy.id, UserStrategy._investing_limit).where(
+            UserStrategy.active == True
+        )
+    ).all()
+    return rebuild_site_stats(redis_client, total_users, investments)
+
+
 # need to handle speed. it would slow down as make strategies
 @shared_task()
 def update_coins_historical_data():
@@ -180,6 +336,7 @@ def update_coins_historical_data():
 
     if not have_lock:
         # If another worker is running this task, exit the function
+        LOCK_CONTENTION.labels("update_strategies_lock").inc()
         print("Another instance of update_coins_historical_data is already running.")
         return
     try:
@@ -187,9 +344,12 @@ def update_coins_historical_data():
         for coin in coins:
             # can't do seperate and delay bcs there are limit on the api call.
             coin.make_historical_data()
+            if datetime.now().minute == 30:
+                # Check the candles built from the websocket feed against REST once an hour
+                coin.reconcile_historical_data()
     finally:
         # Ensure the lock is released when the task is done
-        lock.release()
+        release_lock(lock)
 
 
 @shared_task
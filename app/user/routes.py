@@ -4,11 +4,27 @@ import pytz
 
 # import requests
 import sqlalchemy as sa
-from flask import flash, redirect, render_template, request, session, url_for
+from flask import (
+    current_app,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from flask_login import current_user, login_required, logout_user
 
 from app import db
-from app.models import Coin, MembershipType, Strategy, User, UserStrategy
+from app.models import (
+    Coin,
+    MembershipType,
+    Strategy,
+    StrategyPnL,
+    User,
+    UserStrategy,
+)
 from app.user import bp
 from app.user.forms import (
     EmptyForm,
@@ -19,6 +35,9 @@ from app.user.forms import (
     UserResetPasswordForm,
 )
 from app.utils.formatter import format_integer
+from app.utils.push_channel import make_push_token
+from app.utils.redis_utils import get_redis_client
+from app.utils.upbit_client import UpbitError
 
 # # Function to get the server's public IP address
 # def get_public_ip():
@@ -84,20 +103,20 @@ def set_api_key():
             )
             try:
                 upbit = current_user.create_upbit_client()
-                balance = upbit.get_balances()
-
-                # Check if there is an error in the balance response
-                if isinstance(balance, dict) and "error" in balance:
-                    error_name = balance["error"]["name"]
-                    if error_name == "no_authorization_ip":
-                        flash(
-                            "API 연동에 실패했습니다. 서버 IP 주소를 업비트 화이트리스트에 등록해주세요.",
-                            "danger",
-                        )
-                        db.session.rollback()
-                        return redirect(
-                            url_for("user.set_api_key")
-                        )  # Redirect or handle as needed
+                try:
+                    upbit.get_balances()
+                except UpbitError as e:
+                    # Check if there is an error in the balance response
+                    if e.name != "no_authorization_ip":
+                        raise
+                    flash(
+                        "API 연동에 실패했습니다. 서버 IP 주소를 업비트 화이트리스트에 등록해주세요.",
+                        "danger",
+                    )
+                    db.session.rollback()
+                    return redirect(
+                        url_for("user.set_api_key")
+                    )  # Redirect or handle as needed
 
                 flash("API가 성공적으로 연동되었습니다.")
                 # Save changes to the database
@@ -148,7 +167,11 @@ def dashboard():
                 status, message = (
                     user_strategy.activate()
                 )  # Activate strategy after selling is set
-                if status:
+                if status and message == "pending":
+                    flash(
+                        f"{user_strategy.strategy.name} 전략을 활성화하고 있어요. 잠시 후 대시보드에서 확인해주세요."
+                    )
+                elif status:
                     flash(
                         f"{user_strategy.strategy.name} 전략이 성공적으로 활성화 되었습니다."
                     )
@@ -176,6 +199,8 @@ def dashboard():
         form_e=form_e,
         format_integer=format_integer,
         membership_dic=membership_dic,
+        push_url=current_app.config["PUSH_WEBSOCKET_URL"],
+        push_token=make_push_token(current_app.config["SECRET_KEY"], current_user.id),
     )
 
 
@@ -244,6 +269,7 @@ def set_strategy(name):
         user_strategy.stop_loss = stop_loss
 
         db.session.commit()
+        user_strategy.sync_change()
 
         flash(f"{user_strategy.strategy.name} 전략 투자 설정이 완료되었습니다.")
         return redirect(url_for("user.dashboard"))
@@ -270,6 +296,8 @@ def remove_from_strategies(name):
             .where(UserStrategy.user_id == current_user.id)
             .where(UserStrategy.strategy_id == strategy.id)
         )
+        # Take the strategy out of the execution schedule before removing it
+        user_strategy.deactivate()
         db.session.delete(user_strategy)
         db.session.commit()
         flash(f"{strategy.name} 전략이 내 전략에서 삭제되었습니다.")
@@ -309,6 +337,17 @@ def no_setting_while_investing():
     return redirect(url_for("user.dashboard"))
 
 
+@bp.route("/pnl")
+@login_required
+def pnl():
+    """
+    Profit and loss of the user's strategies as JSON, polled by the dashboard.
+
+    The push server sends the same report to pages connected to it.
+    """
+    return jsonify(StrategyPnL.report(current_user.id, get_redis_client(current_app)))
+
+
 @bp.route("/set_timezone", methods=["POST"])
 def set_timezone():
     data = request.get_json()
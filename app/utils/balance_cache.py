@@ -0,0 +1,46 @@
+import json
+
+import redis
+
+from app.utils.upbit_client import find_balance
+
+# Balances of a user as returned by /v1/accounts, fetched just before the
+# execution minute so executions can check them without a round trip
+BALANCE_KEY = "balances:{user_id}"
+# Long enough to cover the executions of one minute, short enough to never
+# outlive the next prefetch
+BALANCE_TTL = 90  # seconds
+# Seconds before the execution minute the balances are fetched
+BALANCE_PREFETCH_LEAD = 5
+
+
+def cache_balances(redis_client, balances_by_user: dict[int, list[dict]]):
+    pipe = redis_client.pipeline(transaction=False)
+    for user_id, balances in balances_by_user.items():
+        pipe.set(
+            BALANCE_KEY.format(user_id=user_id), json.dumps(balances), ex=BALANCE_TTL
+        )
+    pipe.execute()
+
+
+def get_cached_balance(redis_client, user_id: int, ticker: str) -> float | None:
+    """The prefetched balance of ticker, or None if nothing was prefetched."""
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(BALANCE_KEY.format(user_id=user_id))
+    except redis.RedisError:
+        return None
+    if cached is None:
+        return None
+    return find_balance(json.loads(cached), ticker)
+
+
+def invalidate_balances(redis_client, user_id: int):
+    """Drop the prefetched balances of a user whose balances just changed."""
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(BALANCE_KEY.format(user_id=user_id))
+    except redis.RedisError:
+        pass
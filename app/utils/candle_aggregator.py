@@ -0,0 +1,135 @@
+import json
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# One key per market and minute holds that minute's bar as JSON
+CANDLE_KEY = "candle:{market}:{minute}"
+# Minute (epoch ms) since which a market has been streamed without interruption
+LIVE_SINCE_KEY = "candle:{market}:live_since"
+# Live bars only need to bridge the gap to the next stored history update
+CANDLE_TTL = 4 * 60 * 60  # seconds
+# Refreshed while the market is streamed; expires when the streaming process dies
+LIVE_SINCE_TTL = 120  # seconds
+
+MINUTE_MS = 60 * 1000
+
+CANDLE_COLUMNS = [
+    "market",
+    "time_utc",
+    "open",
+    "high",
+    "low",
+    "close",
+    "volume_krw",
+    "volume_market",
+]
+
+
+def floor_minute(timestamp_ms: int) -> int:
+    return timestamp_ms // MINUTE_MS * MINUTE_MS
+
+
+class CandleAggregator:
+    """Build 1-minute OHLCV bars per market from individual trades."""
+
+    def __init__(self):
+        # Bar of the minute currently being built, per market
+        self.bars = {}
+        # Bars changed since the last drain, keyed by (market, minute)
+        self.dirty = {}
+
+    def add_trade(self, market: str, price: float, volume: float, timestamp_ms: int):
+        minute = floor_minute(timestamp_ms)
+        bar = self.bars.get(market)
+        if bar is not None and minute < bar["minute"]:
+            # Late trade for a minute already closed; REST reconciliation covers it
+            return
+        if bar is None or minute > bar["minute"]:
+            bar = {
+                "market": market,
+                "minute": minute,
+                "time_utc": datetime.fromtimestamp(minute / 1000, timezone.utc)
+                .replace(tzinfo=None)
+                .isoformat(),
+                "open": price,
+                "high": price,
+                "low": price,
+                "close": price,
+                "volume_krw": 0.0,
+                "volume_market": 0.0,
+            }
+            self.bars[market] = bar
+        else:
+            bar["high"] = max(bar["high"], price)
+            bar["low"] = min(bar["low"], price)
+            bar["close"] = price
+        bar["volume_krw"] += price * volume
+        bar["volume_market"] += volume
+        self.dirty[(market, minute)] = bar
+
+    def drain(self) -> list[dict]:
+        """Return the bars changed since the last call, including the open minute."""
+        bars, self.dirty = list(self.dirty.values()), {}
+        return [dict(bar) for bar in bars]
+
+
+def write_candles(pipe, bars: list[dict]):
+    """Queue the bars on a Redis pipeline, overwriting earlier versions of the same minute."""
+    for bar in bars:
+        pipe.set(
+            CANDLE_KEY.format(market=bar["market"], minute=bar["minute"]),
+            json.dumps(bar),
+            ex=CANDLE_TTL,
+        )
+
+
+def mark_live(pipe, markets, since_ms: int):
+    """Record that markets are streamed from since_ms, keeping an earlier start if present."""
+    for market in markets:
+        key = LIVE_SINCE_KEY.format(market=market)
+        pipe.set(key, since_ms, ex=LIVE_SINCE_TTL, nx=True)
+        pipe.expire(key, LIVE_SINCE_TTL)
+
+
+def mark_down(pipe, markets):
+    for market in markets:
+        pipe.delete(LIVE_SINCE_KEY.format(market=market))
+
+
+def get_live_since(redis_client, market: str) -> datetime | None:
+    """Return the first complete minute streamed for market, as naive UTC."""
+    since_ms = redis_client.get(LIVE_SINCE_KEY.format(market=market))
+    if since_ms is None:
+        return None
+    return datetime.fromtimestamp(int(since_ms) / 1000, timezone.utc).replace(
+        tzinfo=None
+    )
+
+
+def get_live_candles(
+    redis_client, market: str, start: datetime, end: datetime
+) -> pd.DataFrame:
+    """
+    Read the live bars of market between start and end (naive UTC, inclusive).
+
+    Args:
+        redis_client: Redis client the aggregator writes to.
+        market (str): Upbit market code, e.g. "KRW-BTC".
+        start (datetime): First minute to read.
+        end (datetime): Last minute to read.
+
+    Returns:
+        pd.DataFrame: Bars in the same layout as get_candles, minutes without trades omitted.
+    """
+    start_ms = int(start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    end_ms = int(end.replace(tzinfo=timezone.utc).timestamp() * 1000)
+    keys = [
+        CANDLE_KEY.format(market=market, minute=minute)
+        for minute in range(floor_minute(start_ms), end_ms + 1, MINUTE_MS)
+    ]
+    bars = [json.loads(raw) for raw in redis_client.mget(keys) if raw is not None]
+
+    df = pd.DataFrame(bars, columns=CANDLE_COLUMNS)
+    df["time_utc"] = pd.to_datetime(df["time_utc"])
+    return df
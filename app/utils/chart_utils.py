@@ -0,0 +1,133 @@
+import json
+import math
+import struct
+
+import numpy as np
+import pandas as pd
+
+# Equity curves are rebased to start at this value, so curves compare at a glance
+START_VALUE = 100
+
+
+def normalize(values) -> np.ndarray:
+    """values rebased to start at START_VALUE, as float32 (plenty for a chart)."""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return values.astype(np.float32)
+    return (values / values[0] * START_VALUE).astype(np.float32)
+
+
+def lttb(x, y, points: int) -> np.ndarray:
+    """
+    Indices of about points samples of the curve (x, y) that keep its shape.
+
+    Largest-Triangle-Three-Buckets: the first and last points are kept, the
+    rest are split into points - 2 buckets, and each bucket keeps the point
+    forming the largest triangle with the point kept before it and the average
+    of the next bucket. Unlike an even stride, peaks and drawdowns survive.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    length = len(y)
+    if points >= length or points < 3:
+        return np.arange(length)
+
+    # Bucket i covers edges[i]:edges[i + 1]; the first and last points are alone
+    edges = np.linspace(1, length - 1, points - 1).astype(np.int64)
+    indices = np.empty(points, dtype=np.int64)
+    indices[0], indices[-1] = 0, length - 1
+    kept = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        following = slice(end, edges[i + 2] if i + 2 < len(edges) else length)
+        avg_x, avg_y = x[following].mean(), y[following].mean()
+        # Twice the triangle areas; the factor doesn't change the argmax
+        areas = np.abs(
+            (x[kept] - avg_x) * (y[start:end] - y[kept])
+            - (x[kept] - x[start:end]) * (avg_y - y[kept])
+        )
+        kept = start + int(np.argmax(areas))
+        indices[i + 1] = kept
+    return indices
+
+
+def downsample(x, series: dict[str, np.ndarray], points: int) -> np.ndarray:
+    """
+    Indices of about points samples for several curves sharing the x axis.
+
+    Each curve gets its share of points by lttb, and the union is kept, so
+    every curve keeps its own turning points.
+    """
+    if not series or points >= len(x):
+        return np.arange(len(x))
+    share = max(points // len(series), 3)
+    return np.unique(
+        np.concatenate([lttb(x, values, share) for values in series.values()])
+    )
+
+
+def json_safe(value):
+    """A metric as a JSON-serializable value: NumPy scalars unwrapped, NaN and inf as None."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+def epoch_ms(times) -> np.ndarray:
+    """Datetimes (naive ones taken as UTC) as int64 milliseconds since the epoch."""
+    return (
+        pd.to_datetime(times, utc=True)
+        .to_numpy(dtype="datetime64[ms]")
+        .astype(np.int64)
+    )
+
+
+def encode_chart(header: dict, times, series: dict[str, np.ndarray]) -> bytes:
+    """
+    Pack a chart into one binary frame for the browser.
+
+    Layout, little-endian:
+        uint32 header length, then the header as UTF-8 JSON, padded with spaces
+        to a multiple of 8 bytes so the arrays can be read in place; then the
+        times as float64 epoch milliseconds (exact, and a Float64Array in the
+        browser, which formats them in the user's timezone); then each series
+        as float32, in the order header["series"] lists.
+
+    Args:
+        header (dict): JSON-serializable data sent along with the series.
+        times: Epoch milliseconds of the points.
+        series (dict): Arrays of the same length as times, by name.
+
+    Returns:
+        bytes: The frame.
+    """
+    header = {**header, "size": len(times), "series": list(series)}
+    encoded = json.dumps(header).encode()
+    encoded += b" " * (-(4 + len(encoded)) % 8)
+    return b"".join(
+        [
+            struct.pack("<I", len(encoded)),
+            encoded,
+            np.asarray(times, dtype="<f8").tobytes(),
+        ]
+        + [np.asarray(values, dtype="<f4").tobytes() for values in series.values()]
+    )
+
+
+def decode_chart(frame: bytes) -> tuple[dict, np.ndarray, dict[str, np.ndarray]]:
+    """Unpack a frame of encode_chart (the browser does the same with a DataView)."""
+    (length,) = struct.unpack_from("<I", frame)
+    header = json.loads(frame[4 : 4 + length])
+    size = header["size"]
+    times = np.frombuffer(frame, dtype="<f8", count=size, offset=4 + length)
+    arrays = np.frombuffer(frame, dtype="<f4", offset=4 + length + size * 8)
+    return (
+        header,
+        times.astype(np.int64),
+        {
+            name: arrays[i * size : (i + 1) * size]
+            for i, name in enumerate(header["series"])
+        },
+    )
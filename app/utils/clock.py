@@ -0,0 +1,23 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Time seen by the execution pipeline while history is replayed (see replay.py)
+_frozen_now = None
+
+
+def utc_now() -> datetime:
+    """The current time as timezone-aware UTC, or the replayed time during a replay."""
+    if _frozen_now is not None:
+        return _frozen_now
+    return datetime.now(timezone.utc)
+
+
+@contextmanager
+def frozen_at(now: datetime):
+    """Make utc_now return now, timezone-aware UTC, within the block."""
+    global _frozen_now
+    previous, _frozen_now = _frozen_now, now
+    try:
+        yield
+    finally:
+        _frozen_now = previous
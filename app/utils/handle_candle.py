@@ -5,6 +5,12 @@ from datetime import datetime, timedelta, timezone
 import pandas as pd
 import requests
 
+from app.utils.metrics import UPBIT_LATENCY, UPBIT_RATE_LIMITED
+from app.utils.upbit_client import get_upbit_api_url
+
+# Candles are fetched many at a time, so keep the connection to Upbit open
+session = requests.Session()
+
 
 def remove_duplicates(dict_list):
     seen = set()
@@ -53,12 +59,14 @@ def get_candles(
 
     times = times[1:]
 
+    api_url = get_upbit_api_url()
     lst = []
     for t in times:
-        url = f"https://api.upbit.com/v1/candles/{interval}/{interval2}?market={market}&count={count}&to={t}"
+        url = f"{api_url}/v1/candles/{interval}/{interval2}?market={market}&count={count}&to={t}"
         headers = {"accept": "application/json"}
         while True:
-            response = requests.get(url, headers=headers)
+            with UPBIT_LATENCY.labels("candles").time():
+                response = session.get(url, headers=headers)
 
             if response.status_code == 200:
                 try:
@@ -71,7 +79,7 @@ def get_candles(
                     print(f"Response text: {response.text}")
                     break  # Exit the loop on JSON parsing error
             elif response.status_code == 429:
-                pass
+                UPBIT_RATE_LIMITED.labels("candles").inc()
             else:
                 print(f"Unexpected error: {response.status_code}")
                 print(f"Response text: {response.text}")
@@ -1,13 +1,17 @@
 import base64
 import hashlib
+from functools import lru_cache
 
 from cryptography.fernet import Fernet
 
 
 def get_fernet(app):
     """Generate a Fernet encryption key based on the Flask app's SECRET_KEY."""
+    return _get_fernet(app.config["SECRET_KEY"])
+
+
+@lru_cache(maxsize=4)
+def _get_fernet(secret_key: str) -> Fernet:
     # Derive a 32-byte encryption key from the app's SECRET_KEY
-    key = base64.urlsafe_b64encode(
-        hashlib.sha256(app.config["SECRET_KEY"].encode()).digest()
-    )
+    key = base64.urlsafe_b64encode(hashlib.sha256(secret_key.encode()).digest())
     return Fernet(key)
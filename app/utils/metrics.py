@@ -0,0 +1,247 @@
+import os
+import time
+
+import redis
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_process_shutdown,
+)
+from flask import g, has_request_context
+from kombu.transport.redis import PRIORITY_STEPS, Channel
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# From a millisecond up to a few minutes: scheduled executions include the
+# wait for the minute's candle, tick executions should stay far below a second.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+
+# Stages between an Upbit event (or execution minute) and a filled order:
+#   ws_receive       exchange trade timestamp -> received by the websocket client
+#                    (includes the clock offset between Upbit and this host)
+#   redis_publish    received -> written to the price stream
+#   listener_decode  frame sent to the price stream -> decoded by a listener
+#   trigger_scan     checking the cached strategies of a coin against a tick
+#   condition_eval   evaluating a strategy's buy/sell condition on its candles
+#   celery_queue     task published -> picked up by a worker
+#   order_queue      order intent queued -> picked up by the order gateway
+#   order_submit     market order request -> response
+#   fill_confirm     order response -> trades confirmed by get_order
+STAGE_LATENCY = Histogram(
+    "offbit_stage_latency_seconds",
+    "Time spent in each stage from a trigger to a filled order.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# End to end, from the tick or execution minute that triggered a strategy
+TRIGGER_TO_ORDER = Histogram(
+    "offbit_trigger_to_order_seconds",
+    "Time from the event that triggered a strategy to its order being submitted.",
+    ["trigger"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# Web requests, with the number of database queries and Redis commands each one made
+REQUEST_LATENCY = Histogram(
+    "offbit_request_latency_seconds",
+    "Time to handle a web request, by endpoint.",
+    ["endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+CALL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "offbit_request_db_queries",
+    "Database queries made by a web request, by endpoint.",
+    ["endpoint"],
+    buckets=CALL_COUNT_BUCKETS,
+)
+REDIS_COMMANDS_PER_REQUEST = Histogram(
+    "offbit_request_redis_commands",
+    "Redis round trips made by a web request, by endpoint.",
+    ["endpoint"],
+    buckets=CALL_COUNT_BUCKETS,
+)
+
+TASK_DURATION = Histogram(
+    "offbit_task_duration_seconds",
+    "Time to run a Celery task, by task name and final state.",
+    ["task", "state"],
+    buckets=LATENCY_BUCKETS,
+)
+# Non-blocking lock acquisitions that found the lock already held
+LOCK_CONTENTION = Counter(
+    "offbit_lock_contention",
+    "Times a task skipped or retried because its lock was held.",
+    ["lock"],
+)
+
+UPBIT_LATENCY = Histogram(
+    "offbit_upbit_request_latency_seconds",
+    "Time of Upbit REST API calls, by endpoint.",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+UPBIT_RATE_LIMITED = Counter(
+    "offbit_upbit_rate_limited",
+    "Upbit REST API calls answered with 429 Too Many Requests.",
+    ["endpoint"],
+)
+
+# Message header carrying the time a task was published
+ENQUEUED_AT_HEADER = "enqueued_at"
+# Start times of the tasks running in this process, by task id
+_task_started = {}
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_LATENCY.labels(stage).observe(max(seconds, 0.0))
+
+
+def observe_since(stage: str, started: float):
+    """Observe the time since started, a time.time() timestamp."""
+    observe_stage(stage, time.time() - started)
+
+
+def observe_trigger_to_order(trigger: str | None, triggered_at: float | None):
+    """Observe the time from triggered_at, a time.time() timestamp, to now."""
+    if triggered_at is not None:
+        TRIGGER_TO_ORDER.labels(trigger or "manual").observe(
+            max(time.time() - triggered_at, 0.0)
+        )
+
+
+def stamp_enqueued_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(ENQUEUED_AT_HEADER, time.time())
+
+
+def observe_queue_wait(task=None, **kwargs):
+    enqueued_at = task.request.get(ENQUEUED_AT_HEADER) if task else None
+    if enqueued_at is not None:
+        observe_since("celery_queue", enqueued_at)
+
+
+def start_task_timer(task_id=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+
+
+def observe_task_duration(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None and task is not None:
+        TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(
+            time.perf_counter() - started
+        )
+
+
+def count_call(kind: str):
+    """Count a database query or Redis command against the current web request."""
+    if has_request_context():
+        calls = g.get("metrics_calls")
+        if calls is not None:
+            calls[kind] += 1
+
+
+class QueueDepthCollector:
+    """Report the messages waiting in each Celery queue of a Redis broker."""
+
+    def __init__(self, broker_url: str, queues: list[str]):
+        self.redis_client = redis.StrictRedis.from_url(broker_url)
+        self.queues = queues
+
+    def queue_keys(self, queue):
+        # kombu keeps one list per priority step, the lowest under the plain name
+        return [queue] + [f"{queue}{Channel.sep}{step}" for step in PRIORITY_STEPS[1:]]
+
+    def collect(self):
+        depth = GaugeMetricFamily(
+            "offbit_celery_queue_depth",
+            "Messages waiting in each Celery queue.",
+            labels=["queue"],
+        )
+        pipe = self.redis_client.pipeline(transaction=False)
+        for queue in self.queues:
+            for key in self.queue_keys(queue):
+                pipe.llen(key)
+        try:
+            lengths = iter(pipe.execute())
+        except redis.RedisError:
+            return
+        for queue in self.queues:
+            depth.add_metric([queue], sum(next(lengths) for _ in PRIORITY_STEPS))
+        yield depth
+
+
+def get_registry():
+    """
+    The registry to export from this process.
+
+    Web and worker processes are usually forked several times, in which case
+    PROMETHEUS_MULTIPROC_DIR must point at a directory shared by the processes
+    so their metrics are aggregated.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    return generate_latest(get_registry()), CONTENT_TYPE_LATEST
+
+
+def init_celery_metrics():
+    """Measure Celery tasks: queue wait, from publish to worker pickup, and run time."""
+    before_task_publish.connect(stamp_enqueued_at, dispatch_uid="offbit_enqueued_at")
+    task_prerun.connect(observe_queue_wait, dispatch_uid="offbit_queue_wait")
+    task_prerun.connect(start_task_timer, dispatch_uid="offbit_task_timer")
+    task_postrun.connect(observe_task_duration, dispatch_uid="offbit_task_duration")
+
+
+def start_worker_exporter(celery_app, port: int):
+    """Serve the metrics of a Celery worker and its pool processes on port."""
+    registry = get_registry()
+    if celery_app.conf.broker_url and celery_app.conf.broker_url.startswith("redis"):
+        registry.register(
+            QueueDepthCollector(
+                celery_app.conf.broker_url,
+                [queue.name for queue in celery_app.conf.task_queues or ()],
+            )
+        )
+    start_http_server(port, registry=registry)
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+
+        def mark_process_dead(pid=None, **kwargs):
+            multiprocess.mark_process_dead(pid or os.getpid())
+
+        worker_process_shutdown.connect(mark_process_dead, weak=False)
@@ -0,0 +1,89 @@
+import json
+import time
+import uuid
+
+# Redis names shared by the strategy executors (producers) and the order gateway
+
+# Orders the executors want placed, consumed by the order gateway
+ORDER_STREAM = "stream:order_intents"
+ORDER_STREAM_MAXLEN = 100000
+ORDER_CONSUMER_GROUP = "order_gateway"
+# Identifier of the order a UserStrategy has in flight, so a second trigger
+# doesn't place another order before the first one's fill is applied
+PENDING_ORDER_KEY = "order:pending:{user_strategy_id}"
+PENDING_ORDER_TTL = 10 * 60  # seconds
+
+
+def submit_order_intent(
+    redis_client,
+    user_strategy,
+    side: str,
+    amount: float,
+    trigger: str | None = None,
+    triggered_at: float | None = None,
+) -> str | None:
+    """
+    Queue a market order of a UserStrategy for the order gateway.
+
+    Args:
+        redis_client: Redis client of the app.
+        user_strategy (UserStrategy): The strategy the order is for.
+        side (str): "bid" to buy amount KRW worth, "ask" to sell amount coins.
+        amount (float): KRW to spend or volume to sell.
+        trigger (str): What triggered the execution, for the latency metrics.
+        triggered_at (float): When it was triggered, epoch seconds.
+
+    Returns:
+        str: The client order identifier, or None if the strategy already has
+            an order in flight.
+    """
+    identifier = f"offbit-{user_strategy.id}-{uuid.uuid4().hex}"
+    if not redis_client.set(
+        PENDING_ORDER_KEY.format(user_strategy_id=user_strategy.id),
+        identifier,
+        nx=True,
+        ex=PENDING_ORDER_TTL,
+    ):
+        return None
+    intent = {
+        "identifier": identifier,
+        "user_strategy_id": user_strategy.id,
+        "user_id": user_strategy.user_id,
+        "market": user_strategy.target_currency.ticker,
+        "side": side,
+        "amount": amount,
+        "trigger": trigger,
+        "triggered_at": triggered_at,
+        "queued_at": time.time(),
+    }
+    redis_client.xadd(
+        ORDER_STREAM,
+        {"intent": json.dumps(intent)},
+        maxlen=ORDER_STREAM_MAXLEN,
+        approximate=True,
+    )
+    return identifier
+
+
+def has_pending_order(redis_client, user_strategy_id: int) -> bool:
+    """Whether a UserStrategy has an order whose fill is not applied yet."""
+    return bool(
+        redis_client.exists(PENDING_ORDER_KEY.format(user_strategy_id=user_strategy_id))
+    )
+
+
+def hold_pending_order(redis_client, user_strategy_id: int, identifier: str):
+    """Block new orders of a UserStrategy until the order placed with identifier is settled."""
+    redis_client.set(
+        PENDING_ORDER_KEY.format(user_strategy_id=user_strategy_id),
+        identifier,
+        ex=PENDING_ORDER_TTL,
+    )
+
+
+def clear_pending_order(redis_client, user_strategy_id: int, identifier: str):
+    """Allow new orders once the order placed with identifier is settled."""
+    key = PENDING_ORDER_KEY.format(user_strategy_id=user_strategy_id)
+    pending = redis_client.get(key)
+    if pending is not None and pending.decode() == identifier:
+        redis_client.delete(key)
@@ -2,13 +2,19 @@ from datetime import datetime, timedelta, timezone
 
 import numpy as np
 import pandas as pd
+import redis
 import sqlalchemy as sa
 from flask import current_app
 
 from app import db
 from app.models import Coin, Strategy
+from app.utils.df_utils import get_dataframe_from_pickle, save_dataframe_as_pickle
 from app.utils.handle_candle import resample_df
 
+# Backtests of the strategy page, per setting; the hour keeps results fresh
+BACKTEST_CACHE_KEY = "backtest:{strategy_id}:{coin}:{params}:{hour}"
+BACKTEST_CACHE_TTL = 60 * 60  # seconds
+
 
 def calculate_strategy_performance(
     strategy: Strategy,
@@ -499,6 +505,92 @@ def calculate_coin_performance(
     )
 
 
+def get_performance_data(redis_client, kind: str, ids) -> dict:
+    """
+    Read the performance stored by the hourly update tasks, in one round trip.
+
+    Args:
+        redis_client: Redis client of the app.
+        kind (str): "strategy" or "coin".
+        ids: Ids of the strategies or coins.
+
+    Returns:
+        dict: By id, the 24h, 30d and 1y returns formatted for display ("N/A"
+            until computed) and the last update as aware UTC ("N/A" until then).
+    """
+    ids = list(ids)
+    pipe = redis_client.pipeline(transaction=False)
+    for id_ in ids:
+        pipe.hmget(f"{kind}:{id_}:performance", "24h", "30d", "1y")
+        pipe.hget(f"{kind}:{id_}:update", "last_update")
+    results = pipe.execute()
+
+    performance_data = {}
+    for i, id_ in enumerate(ids):
+        returns, last_update = results[2 * i], results[2 * i + 1]
+        performance_data[id_] = {
+            "last_update": (
+                datetime.strptime(last_update.decode(), "%Y-%m-%d %H:%M:%S").replace(
+                    tzinfo=timezone.utc
+                )
+                if last_update
+                else "N/A"
+            ),
+            **{
+                period: f"{float(value.decode()):.2f}" if value else "N/A"
+                for period, value in zip(("24h", "30d", "1y"), returns)
+            },
+        }
+    return performance_data
+
+
+def get_cached_backtest(
+    redis_client,
+    strategy: Strategy,
+    selected_coin: str,
+    param1: int,
+    param2: int | None,
+    stop_loss: int | None,
+    execution_time: datetime = datetime(1970, 1, 1, 0, 0),
+) -> pd.DataFrame:
+    """
+    get_backtest, cached in Redis until the next hour.
+
+    The strategy page slices this one result for every time range and
+    resolution it shows, instead of running the backtest again. The daily
+    bars only close once a day, so an hour-old result is at most an hour
+    behind in its last, unfinished day.
+    """
+    key = BACKTEST_CACHE_KEY.format(
+        strategy_id=strategy.id,
+        coin=selected_coin,
+        params=f"{param1}:{param2}:{stop_loss}:{execution_time:%H%M}",
+        hour=datetime.now(timezone.utc).strftime("%Y%m%d%H"),
+    )
+    try:
+        cached = redis_client.get(key) if redis_client is not None else None
+    except redis.RedisError as e:
+        current_app.logger.warning(f"Failed to read cached backtest {key}: {e}")
+        cached = None
+    if cached is not None:
+        return get_dataframe_from_pickle(cached)
+
+    df = get_backtest(
+        strategy=strategy,
+        selected_coin=selected_coin,
+        param1=param1,
+        param2=param2,
+        stop_loss=stop_loss,
+        execution_time=execution_time,
+    )
+    if redis_client is not None:
+        try:
+            redis_client.set(key, save_dataframe_as_pickle(df), ex=BACKTEST_CACHE_TTL)
+        except redis.RedisError as e:
+            current_app.logger.warning(f"Failed to cache backtest {key}: {e}")
+    return df
+
+
 def get_backtest(
     strategy: Strategy,
     selected_coin: str,
@@ -0,0 +1,53 @@
+import zlib
+
+# Redis names shared by the websocket client (producer) and the price listeners (consumers)
+
+# Ticks are spread over this many streams by ticker, so every tick of a ticker
+# lands in the same stream and stays in order
+PRICE_STREAM_PARTITIONS = 8
+PRICE_STREAM = "stream:coin_prices:{partition}"
+# Approximate number of entries kept in each stream
+PRICE_STREAM_MAXLEN = 20000
+# Consumer group of the price listener processes, each reading its own partitions
+PRICE_CONSUMER_GROUP = "price_listeners"
+# Pub/Sub channel carrying the ids of UserStrategies whose settings changed
+USER_STRATEGY_CHANNEL = "user_strategy:changes"
+# Hash of the last traded price per market, for reads that only need the latest one
+LATEST_PRICE_KEY = "prices:latest"
+
+
+def get_partition(ticker: str) -> int:
+    # crc32 rather than hash(), which differs between processes
+    return zlib.crc32(ticker.encode()) % PRICE_STREAM_PARTITIONS
+
+
+def get_price_stream(ticker: str) -> str:
+    return PRICE_STREAM.format(partition=get_partition(ticker))
+
+
+def get_price_streams() -> list[str]:
+    return [
+        PRICE_STREAM.format(partition=partition)
+        for partition in range(PRICE_STREAM_PARTITIONS)
+    ]
+
+
+def get_slot_streams(slot: int, slots: int) -> list[str]:
+    """The price streams read by listener slot of slots; every stream has one reader."""
+    return [
+        PRICE_STREAM.format(partition=partition)
+        for partition in range(slot, PRICE_STREAM_PARTITIONS, slots)
+    ]
+
+
+def get_latest_prices(redis_client, markets) -> dict[str, float]:
+    """Last traded price of each market streamed so far, by market code."""
+    markets = list(markets)
+    if not markets:
+        return {}
+    prices = redis_client.hmget(LATEST_PRICE_KEY, markets)
+    return {
+        market: float(price)
+        for market, price in zip(markets, prices)
+        if price is not None
+    }
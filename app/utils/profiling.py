@@ -0,0 +1,170 @@
+import cProfile
+import io
+import json
+import marshal
+import pstats
+import time
+import uuid
+from datetime import datetime, timezone
+
+import redis
+from celery.signals import task_postrun, task_prerun
+
+from app.utils.redis_utils import get_redis_client
+
+# One hash per profile: metadata, the text report and the raw pstats data
+PROFILE_KEY = "profile:{id}"
+# Sorted set of profile ids by capture time, newest last
+PROFILE_INDEX = "profiles"
+# Routes ("route:<endpoint>") and tasks ("task:<name>") profiled on every call
+PROFILE_TARGETS_KEY = "profiling:targets"
+PROFILE_TTL = 7 * 24 * 60 * 60  # seconds
+MAX_PROFILES = 200
+# Lines of the report kept, sorted by cumulative time
+REPORT_LINES = 60
+# Request header (admins only) or task header asking for a single call to be profiled
+PROFILE_HEADER = "X-Offbit-Profile"
+TASK_PROFILE_HEADER = "profile"
+# How long a process trusts its copy of the profiled targets
+TARGETS_CACHE_SECONDS = 10
+
+
+class Profiler:
+    """A cProfile run of one request or task."""
+
+    def __init__(self, kind: str, name: str):
+        self.kind = kind
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.started = 0.0
+        self.duration = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.duration = time.perf_counter() - self.started
+
+    def report(self) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(REPORT_LINES)
+        return stream.getvalue()
+
+
+def save_profile(redis_client, profiler: Profiler, details: str = "") -> str:
+    """Store a finished profile and drop the oldest ones beyond MAX_PROFILES."""
+    profile_id = uuid.uuid4().hex
+    profiler.profile.create_stats()
+    # Same format as pstats.Stats.dump_stats, loadable with pstats or snakeviz.
+    # Taken before the report, since building pstats.Stats empties profile.stats
+    raw_stats = marshal.dumps(profiler.profile.stats)
+    meta = {
+        "id": profile_id,
+        "kind": profiler.kind,
+        "name": profiler.name,
+        "details": details,
+        "duration": profiler.duration,
+        "time": datetime.now(timezone.utc).isoformat(),
+    }
+    key = PROFILE_KEY.format(id=profile_id)
+    pipe = redis_client.pipeline()
+    pipe.hset(
+        key,
+        mapping={
+            "meta": json.dumps(meta),
+            "report": profiler.report(),
+            "stats": raw_stats,
+        },
+    )
+    pipe.expire(key, PROFILE_TTL)
+    pipe.zadd(PROFILE_INDEX, {profile_id: time.time()})
+    pipe.zremrangebyrank(PROFILE_INDEX, 0, -MAX_PROFILES - 1)
+    pipe.execute()
+    return profile_id
+
+
+def list_profiles(redis_client, limit: int = MAX_PROFILES) -> list[dict]:
+    """Metadata of the stored profiles, newest first."""
+    ids = redis_client.zrevrange(PROFILE_INDEX, 0, limit - 1)
+    pipe = redis_client.pipeline()
+    for profile_id in ids:
+        pipe.hget(PROFILE_KEY.format(id=profile_id.decode()), "meta")
+    return [json.loads(meta) for meta in pipe.execute() if meta is not None]
+
+
+def get_profile(redis_client, profile_id: str) -> dict | None:
+    """Metadata, report and raw stats of a profile, or None if it expired."""
+    stored = redis_client.hgetall(PROFILE_KEY.format(id=profile_id))
+    if not stored:
+        return None
+    profile = json.loads(stored[b"meta"])
+    profile["report"] = stored[b"report"].decode()
+    profile["stats"] = stored[b"stats"]
+    return profile
+
+
+def get_targets(redis_client) -> set[str]:
+    return {target.decode() for target in redis_client.smembers(PROFILE_TARGETS_KEY)}
+
+
+def set_target(redis_client, target: str, enabled: bool):
+    if enabled:
+        redis_client.sadd(PROFILE_TARGETS_KEY, target)
+    else:
+        redis_client.srem(PROFILE_TARGETS_KEY, target)
+
+
+class TargetCache:
+    """The profiled targets, re-read at most every TARGETS_CACHE_SECONDS."""
+
+    def __init__(self):
+        self.targets = set()
+        self.loaded_at = float("-inf")
+
+    def is_profiled(self, redis_client, kind: str, name: str) -> bool:
+        if time.monotonic() - self.loaded_at >= TARGETS_CACHE_SECONDS:
+            self.targets = get_targets(redis_client)
+            self.loaded_at = time.monotonic()
+        return f"{kind}:{name}" in self.targets
+
+
+target_cache = TargetCache()
+
+
+def init_celery_profiling(app):
+    """Profile tasks enabled on the admin page, or published with the profile header."""
+    # Profilers of the tasks running in this process, by task id
+    running = {}
+
+    def start_task_profile(task_id=None, task=None, **kwargs):
+        redis_client = get_redis_client(app)
+        if redis_client is None or task is None:
+            return
+        try:
+            wanted = task.request.get(TASK_PROFILE_HEADER) or target_cache.is_profiled(
+                redis_client, "task", task.name
+            )
+        except redis.RedisError:
+            return
+        if wanted:
+            profiler = Profiler("task", task.name)
+            running[task_id] = profiler
+            profiler.start()
+
+    def save_task_profile(task_id=None, state=None, **kwargs):
+        profiler = running.pop(task_id, None)
+        if profiler is None:
+            return
+        profiler.stop()
+        try:
+            save_profile(
+                get_redis_client(app), profiler, details=f"{task_id} {state or ''}"
+            )
+        except redis.RedisError as e:
+            app.logger.warning(f"Could not save profile of {profiler.name}: {e}")
+
+    task_prerun.connect(start_task_profile, weak=False, dispatch_uid="offbit_profile")
+    task_postrun.connect(save_task_profile, weak=False, dispatch_uid="offbit_profile")
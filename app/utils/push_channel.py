@@ -0,0 +1,51 @@
+import redis
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+# Redis names the app publishes to and the push server fans out to browsers
+
+# Ids of users whose strategies, positions or PnL changed
+USER_UPDATE_CHANNEL = "push:user_updates"
+# Published once the hourly strategy and coin performance are updated
+RANKING_UPDATE_CHANNEL = "push:ranking_updates"
+
+PUSH_TOKEN_SALT = "push"
+# A page left open longer reconnects without its user's updates
+PUSH_TOKEN_MAX_AGE = 24 * 60 * 60  # seconds
+
+
+def make_push_token(secret_key: str, user_id: int) -> str:
+    """Signed token a page passes to the push server to receive user_id's updates."""
+    return URLSafeTimedSerializer(secret_key, salt=PUSH_TOKEN_SALT).dumps(user_id)
+
+
+def load_push_token(secret_key: str, token: str) -> int | None:
+    """The user id of a push token, or None if it is invalid or expired."""
+    try:
+        return URLSafeTimedSerializer(secret_key, salt=PUSH_TOKEN_SALT).loads(
+            token, max_age=PUSH_TOKEN_MAX_AGE
+        )
+    except BadSignature:
+        return None
+
+
+def publish_user_update(redis_client, user_id: int) -> bool:
+    """Tell the push servers that user_id's strategies changed; best effort."""
+    if redis_client is None:
+        # No Redis configured, so no push servers either
+        return False
+    try:
+        redis_client.publish(USER_UPDATE_CHANNEL, user_id)
+        return True
+    except redis.RedisError:
+        # Pushed pages catch up on the next update or reload
+        return False
+
+
+def publish_ranking_update(redis_client) -> bool:
+    if redis_client is None:
+        return False
+    try:
+        redis_client.publish(RANKING_UPDATE_CHANNEL, 1)
+        return True
+    except redis.RedisError:
+        return False
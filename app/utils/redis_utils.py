@@ -0,0 +1,28 @@
+import redis
+
+from app.utils.metrics import count_call
+
+
+class CountingRedis(redis.StrictRedis):
+    """Redis client that counts its round trips against the current web request."""
+
+    def execute_command(self, *args, **options):
+        count_call("redis")
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        # A pipeline is sent as a single round trip
+        count_call("redis")
+        return super().pipeline(transaction, shard_hint)
+
+
+def get_redis_client(app):
+    """Return the Redis client shared by the Flask app, or None if Redis is not configured."""
+    if not app.config.get("REDIS_URL"):
+        return None
+    # Reuse one client (and its connection pool) per app instead of one per call
+    client = app.extensions.get("redis")
+    if client is None:
+        client = CountingRedis.from_url(app.config["REDIS_URL"])
+        app.extensions["redis"] = client
+    return client
@@ -0,0 +1,84 @@
+from datetime import time
+
+# One Redis set per minute of the day holds the ids of the active UserStrategies
+# due at that minute, so dispatch is a single SMEMBERS instead of a table scan.
+SCHEDULE_MINUTE_KEY = "schedule:minute:{minute}"
+# Hash of user_strategy_id -> minute of day, used to move an id between sets
+SCHEDULE_MEMBERSHIP_KEY = "schedule:membership"
+# Set once the index has been built, so an empty set can be told apart from a cold index
+SCHEDULE_READY_KEY = "schedule:ready"
+
+MINUTES_PER_DAY = 24 * 60
+
+
+def get_minute_of_day(execution_time: time) -> int:
+    return execution_time.hour * 60 + execution_time.minute
+
+
+def remove_from_schedule(redis_client, user_strategy_id: int):
+    """Remove a UserStrategy from the schedule index."""
+    old_minute = redis_client.hget(SCHEDULE_MEMBERSHIP_KEY, user_strategy_id)
+    pipe = redis_client.pipeline()
+    if old_minute is not None:
+        pipe.srem(SCHEDULE_MINUTE_KEY.format(minute=int(old_minute)), user_strategy_id)
+    pipe.hdel(SCHEDULE_MEMBERSHIP_KEY, user_strategy_id)
+    pipe.execute()
+
+
+def add_to_schedule(redis_client, user_strategy_id: int, execution_time: time):
+    """Add a UserStrategy to the schedule index, moving it if its time changed."""
+    minute = get_minute_of_day(execution_time)
+    old_minute = redis_client.hget(SCHEDULE_MEMBERSHIP_KEY, user_strategy_id)
+    pipe = redis_client.pipeline()
+    if old_minute is not None and int(old_minute) != minute:
+        pipe.srem(SCHEDULE_MINUTE_KEY.format(minute=int(old_minute)), user_strategy_id)
+    pipe.sadd(SCHEDULE_MINUTE_KEY.format(minute=minute), user_strategy_id)
+    pipe.hset(SCHEDULE_MEMBERSHIP_KEY, user_strategy_id, minute)
+    pipe.execute()
+
+
+def get_scheduled_ids(redis_client, execution_time: time) -> list[int] | None:
+    """Return the ids due at execution_time, or None if the index has not been built."""
+    minute = get_minute_of_day(execution_time)
+    pipe = redis_client.pipeline()
+    pipe.exists(SCHEDULE_READY_KEY)
+    pipe.smembers(SCHEDULE_MINUTE_KEY.format(minute=minute))
+    ready, members = pipe.execute()
+    if not ready:
+        return None
+    return sorted(int(member) for member in members)
+
+
+def rebuild_schedule(redis_client, entries) -> dict[int, list[int]]:
+    """
+    Replace the schedule index with the given (user_strategy_id, execution_time) pairs.
+
+    Args:
+        redis_client: Redis client to write the index to.
+        entries: Iterable of (user_strategy_id, execution_time) for active strategies.
+
+    Returns:
+        dict[int, list[int]]: The rebuilt mapping of minute of day to ids.
+    """
+    schedule = {}
+    for user_strategy_id, execution_time in entries:
+        if execution_time is None:
+            continue
+        schedule.setdefault(get_minute_of_day(execution_time), []).append(
+            user_strategy_id
+        )
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(
+        SCHEDULE_MEMBERSHIP_KEY,
+        *[SCHEDULE_MINUTE_KEY.format(minute=m) for m in range(MINUTES_PER_DAY)],
+    )
+    membership = {}
+    for minute, ids in schedule.items():
+        pipe.sadd(SCHEDULE_MINUTE_KEY.format(minute=minute), *ids)
+        membership.update({user_strategy_id: minute for user_strategy_id in ids})
+    if membership:
+        pipe.hset(SCHEDULE_MEMBERSHIP_KEY, mapping=membership)
+    pipe.set(SCHEDULE_READY_KEY, 1)
+    pipe.execute()
+    return schedule
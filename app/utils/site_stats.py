@@ -0,0 +1,103 @@
+import redis
+
+# Totals shown on the landing page, kept up to date as users register and
+# strategies change, so the page reads them without touching the database
+SITE_STATS_KEY = "site:stats"
+# Hash of user_strategy_id -> amount it adds to the total investment (its
+# investing limit while active), used to apply a change as a difference
+SITE_INVESTMENT_KEY = "site:investment"
+# Set once the totals have been built, so missing totals can be told apart from zeros
+SITE_STATS_READY_KEY = "site:ready"
+
+
+def whole_won(amount) -> int:
+    """Round an amount in KRW to whole won; investing limits become floats after a sell."""
+    return int(round(float(amount or 0)))
+
+
+def get_site_stats(redis_client) -> dict | None:
+    """Return total_users and total_investment, or None if they have not been built."""
+    pipe = redis_client.pipeline()
+    pipe.exists(SITE_STATS_READY_KEY)
+    pipe.hmget(SITE_STATS_KEY, "total_users", "total_investment")
+    ready, (total_users, total_investment) = pipe.execute()
+    if not ready:
+        return None
+    try:
+        return {
+            "total_users": int(total_users or 0),
+            "total_investment": whole_won(total_investment),
+        }
+    except ValueError:
+        # Unreadable totals are counted again, like missing ones
+        return None
+
+
+def add_user(redis_client) -> bool:
+    """Count a newly registered user; best effort, the hourly rebuild corrects misses."""
+    if redis_client is None:
+        return False
+    try:
+        redis_client.hincrby(SITE_STATS_KEY, "total_users", 1)
+        return True
+    except redis.RedisError:
+        return False
+
+
+def set_investment(redis_client, user_strategy_id: int, amount: float) -> bool:
+    """Set what a UserStrategy adds to the total investment (0 once inactive); best effort."""
+    if redis_client is None:
+        return False
+    # HINCRBY only takes integers
+    amount = whole_won(amount)
+
+    def update(pipe):
+        old = whole_won(pipe.hget(SITE_INVESTMENT_KEY, user_strategy_id))
+        # Checked before MULTI, where a failed HINCRBY would not undo the HSET
+        int(pipe.hget(SITE_STATS_KEY, "total_investment") or 0)
+        pipe.multi()
+        if amount:
+            pipe.hset(SITE_INVESTMENT_KEY, user_strategy_id, amount)
+        else:
+            pipe.hdel(SITE_INVESTMENT_KEY, user_strategy_id)
+        pipe.hincrby(SITE_STATS_KEY, "total_investment", amount - old)
+
+    try:
+        # Retried if another change of the totals lands between read and write
+        redis_client.transaction(update, SITE_INVESTMENT_KEY, SITE_STATS_KEY)
+        return True
+    except (redis.RedisError, ValueError):
+        # Unreadable amounts are drift, which the hourly rebuild corrects
+        return False
+
+
+def rebuild_site_stats(redis_client, total_users: int, investments) -> dict:
+    """
+    Replace the landing page totals with ones counted from the database.
+
+    Args:
+        redis_client: Redis client to write the totals to.
+        total_users (int): Number of registered users.
+        investments: Iterable of (user_strategy_id, investing_limit) of the
+            active strategies.
+
+    Returns:
+        dict: The rebuilt totals, as get_site_stats returns them.
+    """
+    investments = {
+        user_strategy_id: whole_won(amount)
+        for user_strategy_id, amount in investments
+        if whole_won(amount)
+    }
+    stats = {
+        "total_users": total_users,
+        "total_investment": sum(investments.values()),
+    }
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(SITE_INVESTMENT_KEY)
+    if investments:
+        pipe.hset(SITE_INVESTMENT_KEY, mapping=investments)
+    pipe.hset(SITE_STATS_KEY, mapping=stats)
+    pipe.set(SITE_STATS_READY_KEY, 1)
+    pipe.execute()
+    return stats
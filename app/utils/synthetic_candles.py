@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+def make_candles(
+    market: str, days: int, seed: int, end: datetime | None = None
+) -> pd.DataFrame:
+    """
+    Generate minute candles in the layout returned by get_candles.
+
+    Args:
+        market (str): Market code written to the "market" column.
+        days (int): Length of the history.
+        seed (int): Seed of the random walk, so every run sees the same prices.
+        end (datetime): Last minute, naive UTC. Defaults to a fixed date.
+
+    Returns:
+        pd.DataFrame: One row per minute, oldest first.
+    """
+    rng = np.random.default_rng(seed)
+    end = end or datetime(2024, 10, 1)
+    rows = days * 24 * 60
+    times = pd.date_range(end=end, periods=rows, freq="1min")
+    # Geometric random walk with a volatility close to a large-cap coin
+    close = 50_000_000 * np.exp(np.cumsum(rng.normal(0, 0.0008, rows)))
+    open_ = np.concatenate(([close[0]], close[:-1]))
+    spread = np.abs(rng.normal(0, 0.0004, rows)) * close
+    volume_market = rng.gamma(2.0, 0.5, rows)
+    return pd.DataFrame(
+        {
+            "market": market,
+            "time_utc": times,
+            "open": open_,
+            "high": np.maximum(open_, close) + spread,
+            "low": np.minimum(open_, close) - spread,
+            "close": close,
+            "volume_krw": volume_market * close,
+            "volume_market": volume_market,
+        }
+    )
@@ -0,0 +1,78 @@
+import struct
+from typing import NamedTuple
+
+# Binary layout of the frames published on the price streams. A frame is a
+# header followed by a fixed-size record per tick, little-endian throughout.
+FRAME_VERSION = 2
+# Format version, number of ticks, publish time (epoch ms)
+FRAME_HEADER = struct.Struct("<BHq")
+# Coin id, price, volume, exchange timestamp (ms), per-coin sequence number
+TICK_RECORD = struct.Struct("<IddqQ")
+MAX_TICKS_PER_FRAME = 0xFFFF
+
+
+class Tick(NamedTuple):
+    coin_id: int
+    price: float
+    volume: float
+    timestamp_ms: int
+    seq: int
+
+
+def encode_frame(ticks: list[Tick], published_ms: int) -> bytes:
+    """Pack ticks into a single frame stamped with its publish time."""
+    if len(ticks) > MAX_TICKS_PER_FRAME:
+        raise ValueError(f"A frame holds at most {MAX_TICKS_PER_FRAME} ticks.")
+    frame = bytearray(FRAME_HEADER.size + TICK_RECORD.size * len(ticks))
+    FRAME_HEADER.pack_into(frame, 0, FRAME_VERSION, len(ticks), published_ms)
+    for i, tick in enumerate(ticks):
+        TICK_RECORD.pack_into(frame, FRAME_HEADER.size + i * TICK_RECORD.size, *tick)
+    return bytes(frame)
+
+
+def decode_frame(frame: bytes) -> tuple[int, list[Tick]]:
+    """Unpack a frame written by encode_frame into its publish time and ticks."""
+    version, count, published_ms = FRAME_HEADER.unpack_from(frame)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported tick frame version {version}.")
+    if len(frame) != FRAME_HEADER.size + count * TICK_RECORD.size:
+        raise ValueError("Truncated tick frame.")
+    records = memoryview(frame)[FRAME_HEADER.size :]
+    return published_ms, [
+        Tick._make(record) for record in TICK_RECORD.iter_unpack(records)
+    ]
+
+
+class SequenceTracker:
+    """
+    Detect ticks lost between publisher and consumer from their sequence numbers.
+
+    The publisher numbers the ticks of each coin from 1, so a jump means ticks
+    were dropped (e.g. trimmed from the stream before being read) and a restart
+    at 1 means the publisher restarted. Numbers at or below the last one seen are
+    redeliveries and are ignored. A consumer only sees the ticks delivered to it,
+    so it must be the only reader of the coins it tracks: each price listener
+    owns its partitions (see redis_listener) and resets its tracker when it
+    takes over a slot.
+    """
+
+    def __init__(self):
+        self.last_seq = {}
+        self.dropped = 0
+
+    def reset(self):
+        """Forget the coins seen, e.g. when another listener read them meanwhile."""
+        self.last_seq = {}
+
+    def check(self, tick: Tick) -> int:
+        """Record tick and return how many ticks of its coin were skipped before it."""
+        last = self.last_seq.get(tick.coin_id)
+        if last is None or tick.seq == 1:
+            self.last_seq[tick.coin_id] = tick.seq
+            return 0
+        if tick.seq <= last:
+            return 0
+        self.last_seq[tick.coin_id] = tick.seq
+        missed = tick.seq - last - 1
+        self.dropped += missed
+        return missed
@@ -0,0 +1,225 @@
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import jwt
+import requests
+from flask import current_app, has_app_context
+from requests.adapters import HTTPAdapter
+
+from app.utils.metrics import UPBIT_LATENCY, UPBIT_RATE_LIMITED
+
+DEFAULT_API_URL = "https://api.upbit.com"
+DEFAULT_WEBSOCKET_URL = "wss://api.upbit.com/websocket/v1"
+REQUEST_TIMEOUT = 10  # seconds
+# Connections kept open to Upbit per process, shared by all clients
+MAX_CONNECTIONS = 32
+# How long a process keeps the client of a user it executed strategies for
+CLIENT_TTL = 60 * 60  # seconds
+
+_session = None
+
+
+def get_upbit_api_url() -> str:
+    """Base URL of the Upbit REST API, configurable so a local simulator can stand in."""
+    if has_app_context():
+        return current_app.config.get("UPBIT_API_URL") or DEFAULT_API_URL
+    return DEFAULT_API_URL
+
+
+def get_upbit_websocket_url() -> str:
+    if has_app_context():
+        return current_app.config.get("UPBIT_WEBSOCKET_URL") or DEFAULT_WEBSOCKET_URL
+    return DEFAULT_WEBSOCKET_URL
+
+
+class UpbitError(Exception):
+    """An error response from the Upbit API."""
+
+    def __init__(self, status: int, name: str, message: str):
+        super().__init__(f"{status} {name}: {message}")
+        self.status = status
+        self.name = name
+        self.message = message
+
+
+def get_session() -> requests.Session:
+    """The HTTP session of this process, created after any fork of the worker."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MAX_CONNECTIONS)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+    return _session
+
+
+def find_balance(balances: list[dict], ticker: str = "KRW") -> float:
+    """Available balance of ticker in a /v1/accounts response."""
+    fiat, currency = ticker.split("-") if "-" in ticker else ("KRW", ticker)
+    for balance in balances:
+        if balance["currency"] == currency and balance["unit_currency"] == fiat:
+            return float(balance["balance"])
+    return 0.0
+
+
+def parse_upbit_time(value: str) -> datetime:
+    """A timestamp of the Upbit API ("2024-01-01T09:00:00+09:00") as naive UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+class UpbitClient:
+    """
+    The Upbit exchange calls Offbit makes, over the process's keep-alive connections.
+
+    Mirrors the pyupbit.Upbit methods used by the app, but raises UpbitError
+    instead of returning None, and sends every call to a configurable base URL.
+    """
+
+    def __init__(
+        self,
+        access: str,
+        secret: str,
+        base_url: str | None = None,
+        session: requests.Session | None = None,
+    ):
+        self.access = access
+        self.secret = secret
+        self.base_url = (base_url or get_upbit_api_url()).rstrip("/")
+        self.session = session or get_session()
+
+    def _headers(self, query: dict | None = None) -> dict:
+        payload = {"access_key": self.access, "nonce": str(uuid.uuid4())}
+        if query:
+            # Upbit signs the url-encoded query, with "[]" left unescaped
+            encoded = urlencode(query, doseq=True).replace("%5B%5D=", "[]=")
+            payload["query_hash"] = hashlib.sha512(encoded.encode()).hexdigest()
+            payload["query_hash_alg"] = "SHA512"
+        return {"Authorization": f"Bearer {jwt.encode(payload, self.secret)}"}
+
+    def _request(self, method: str, path: str, endpoint: str, query=None):
+        """Send a signed request and return the decoded JSON body."""
+        headers = self._headers(query)
+        kwargs = {"json": query} if method == "POST" else {"params": query}
+        with UPBIT_LATENCY.labels(endpoint).time():
+            response = self.session.request(
+                method,
+                f"{self.base_url}{path}",
+                headers=headers,
+                timeout=REQUEST_TIMEOUT,
+                **kwargs,
+            )
+        if response.status_code == 429:
+            UPBIT_RATE_LIMITED.labels(endpoint).inc()
+        if response.status_code >= 400:
+            try:
+                error = response.json()["error"]
+            except (ValueError, KeyError, TypeError):
+                error = {"name": "http_error", "message": response.text}
+            raise UpbitError(response.status_code, error["name"], error["message"])
+        return response.json()
+
+    def get_balances(self) -> list[dict]:
+        return self._request("GET", "/v1/accounts", "accounts")
+
+    def get_balance(self, ticker: str = "KRW") -> float:
+        """Available balance of a currency ("KRW") or the coin of a market ("KRW-BTC")."""
+        return find_balance(self.get_balances(), ticker)
+
+    def buy_market_order(
+        self, ticker: str, price: float, identifier: str | None = None
+    ) -> dict:
+        """
+        Buy ticker for price KRW at the market price.
+
+        identifier is a client order id: Upbit refuses a second order with the
+        same one, and get_order finds the order by it.
+        """
+        query = {
+            "market": ticker,
+            "side": "bid",
+            "price": str(price),
+            "ord_type": "price",
+        }
+        if identifier:
+            query["identifier"] = identifier
+        return self._request("POST", "/v1/orders", "orders", query)
+
+    def sell_market_order(
+        self, ticker: str, volume: float, identifier: str | None = None
+    ) -> dict:
+        """Sell volume of ticker at the market price."""
+        query = {
+            "market": ticker,
+            "side": "ask",
+            "volume": str(volume),
+            "ord_type": "market",
+        }
+        if identifier:
+            query["identifier"] = identifier
+        return self._request("POST", "/v1/orders", "orders", query)
+
+    def get_order(
+        self, order_uuid: str | None = None, identifier: str | None = None
+    ) -> dict:
+        """An order by its Upbit uuid or by the identifier it was placed with."""
+        query = {"uuid": order_uuid} if order_uuid else {"identifier": identifier}
+        return self._request("GET", "/v1/order", "order", query)
+
+
+class UpbitClientPool:
+    """
+    The Upbit clients of the users this process executes for, by user id.
+
+    A client is reused until CLIENT_TTL passes, the user's API keys expire, or
+    the stored keys change (detected from the encrypted keys, so a hit costs no
+    decryption), and is replaced on the next call.
+    """
+
+    def __init__(self, ttl: float = CLIENT_TTL):
+        self.ttl = ttl
+        # user id -> (client, fingerprint of the stored keys, expiry on time.monotonic())
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(user) -> bytes:
+        return hashlib.sha256(
+            (user.open_api_key_access_upbit or b"")
+            + (user.open_api_key_secret_upbit or b"")
+        ).digest()
+
+    def get(self, user) -> UpbitClient:
+        fingerprint = self.fingerprint(user)
+        with self.lock:
+            cached = self.clients.get(user.id)
+        if (
+            cached is not None
+            and cached[1] == fingerprint
+            and cached[2] > time.monotonic()
+        ):
+            return cached[0]
+
+        api_key_access, api_key_secret = user.get_open_api_key()
+        client = UpbitClient(access=api_key_access, secret=api_key_secret)
+        ttl = self.ttl
+        if user.open_api_key_expiration is not None:
+            ttl = min(
+                ttl, (user.open_api_key_expiration - datetime.now()).total_seconds()
+            )
+        with self.lock:
+            self.clients[user.id] = (client, fingerprint, time.monotonic() + ttl)
+        return client
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.clients.pop(user_id, None)
+
+
+client_pool = UpbitClientPool()
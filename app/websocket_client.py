@@ -2,49 +2,311 @@
 
 import asyncio
 import json
+import threading
+import time
+import zlib
+from collections import Counter
 
-import redis
+import redis.asyncio as aioredis
+import sqlalchemy as sa
 import websockets
 from flask import current_app
 
-from app import create_app
+from app import create_app, db
+from app.models import Coin, UserStrategy
+from app.utils.candle_aggregator import (
+    MINUTE_MS,
+    CandleAggregator,
+    floor_minute,
+    mark_down,
+    mark_live,
+    write_candles,
+)
+from app.utils.metrics import STAGE_LATENCY
+from app.utils.price_stream import (
+    LATEST_PRICE_KEY,
+    PRICE_STREAM_MAXLEN,
+    get_price_stream,
+)
+from app.utils.tick_codec import Tick, encode_frame
+from app.utils.upbit_client import get_upbit_websocket_url
 
 app = create_app()
 
 with app.app_context():
     REDIS_URL = current_app.config["REDIS_URL"]
-    redis_client = redis.StrictRedis.from_url(REDIS_URL)
-
-
-async def upbit_websocket():
-    """Connect to Upbit WebSocket and publish coin prices to Redis."""
-    uri = "wss://api.upbit.com/websocket/v1"
-    async with websockets.connect(uri) as websocket:
-        subscribe_message = [
-            {"ticket": "test"},
-            {
-                "type": "ticker",
-                "codes": ["KRW-BTC", "KRW-ETH"],
-                # "isOnlyRealtime": True,
-            },  # Add more coins as needed
-            {"format": "SIMPLE"},
-        ]
-        await websocket.send(json.dumps(subscribe_message))
+    UPBIT_WEBSOCKET_URI = get_upbit_websocket_url()
 
+# Ticks for the same ticker arriving within this window are coalesced into one
+COALESCE_WINDOW = 0.05  # seconds
+# Markets are split across connections so no single connection carries the whole feed
+MAX_CODES_PER_CONNECTION = 50
+# How often the subscribed markets are re-read from the database
+SUBSCRIPTION_REFRESH_INTERVAL = 30  # seconds
+RECONNECT_BACKOFF_MAX = 60  # seconds
+# How often the live-since markers of streamed markets are refreshed
+LIVE_REFRESH_INTERVAL = 10  # seconds
+
+WS_RECEIVE_LATENCY = STAGE_LATENCY.labels("ws_receive")
+REDIS_PUBLISH_LATENCY = STAGE_LATENCY.labels("redis_publish")
+
+
+class TickPublisher:
+    """Coalesce ticks per ticker and publish them to Redis as one binary frame per stream."""
+
+    def __init__(self, redis_client, window=COALESCE_WINDOW):
+        self.redis_client = redis_client
+        self.window = window
+        # Coin id of each subscribed market, the tick frames carry ids instead of codes
+        self.coin_ids = {}
+        # Latest tick per ticker since the last flush
+        self.pending = {}
+        # Sequence number of the last tick published per coin, so consumers can spot drops
+        self.seq = {}
+        # Every trade goes into the minute bars, coalesced or not
+        self.aggregator = CandleAggregator()
+        # Streamed markets and the first complete minute they were streamed from
+        self.live = {}
+        self.gone = set()
+        self.live_refreshed_at = 0.0
+
+    def add(self, ticker, price, volume, timestamp_ms):
+        # No I/O here, so the receive loop never waits on Redis
+        received = time.time()
+        WS_RECEIVE_LATENCY.observe(max(received - timestamp_ms / 1000, 0.0))
+        self.pending[ticker] = (price, volume, timestamp_ms, received)
+        self.aggregator.add_trade(ticker, price, volume, timestamp_ms)
+
+    def mark_live(self, codes):
+        """Record that codes are streamed from the next full minute on."""
+        since_ms = floor_minute(int(time.time() * 1000)) + MINUTE_MS
+        # A reconnect leaves the code in gone too, so the next flush first drops
+        # the old marker and then starts a new one from since_ms
+        for code in codes:
+            self.live[code] = since_ms
+        self.live_refreshed_at = 0.0
+
+    def mark_down(self, codes):
+        """Record that codes stopped streaming, so their live bars have a gap."""
+        for code in codes:
+            self.live.pop(code, None)
+            self.gone.add(code)
+
+    async def flush(self):
+        bars = self.aggregator.drain()
+        refresh_live = (
+            time.monotonic() - self.live_refreshed_at >= LIVE_REFRESH_INTERVAL
+        )
+        if not self.pending and not bars and not self.gone and not refresh_live:
+            return
+        ticks, self.pending = self.pending, {}
+        gone, self.gone = self.gone, set()
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for stream, frame in self.build_frames(ticks).items():
+                pipe.xadd(
+                    stream,
+                    {"data": frame},
+                    maxlen=PRICE_STREAM_MAXLEN,
+                    approximate=True,
+                )
+            if ticks:
+                # One field per market, however many strategies read it
+                pipe.hset(
+                    LATEST_PRICE_KEY,
+                    mapping={ticker: tick[0] for ticker, tick in ticks.items()},
+                )
+            write_candles(pipe, bars)
+            mark_down(pipe, gone)
+            if refresh_live:
+                for code, since_ms in self.live.items():
+                    mark_live(pipe, [code], since_ms)
+                self.live_refreshed_at = time.monotonic()
+            await pipe.execute()
+        published = time.time()
+        for _, _, _, received in ticks.values():
+            REDIS_PUBLISH_LATENCY.observe(published - received)
+
+    def build_frames(self, ticks) -> dict[str, bytes]:
+        """Encode the coalesced ticks into one frame per price stream."""
+        by_stream = {}
+        for ticker, (price, volume, timestamp_ms, _) in ticks.items():
+            coin_id = self.coin_ids.get(ticker)
+            if coin_id is None:
+                continue
+            seq = self.seq.get(coin_id, 0) + 1
+            self.seq[coin_id] = seq
+            by_stream.setdefault(get_price_stream(ticker), []).append(
+                Tick(coin_id, price, volume, timestamp_ms, seq)
+            )
+        published_ms = int(time.time() * 1000)
+        return {
+            stream: encode_frame(batch, published_ms)
+            for stream, batch in by_stream.items()
+        }
+
+    async def run(self):
         while True:
-            response = await websocket.recv()
-            data = json.loads(response)
-            ticker = data.get("cd")
-            price = data.get("tp")
-
-            # Publish the price update to Redis
-            redis_client.publish(
-                "coin_prices", json.dumps({"ticker": ticker, "price": price})
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+
+def get_subscription_markets() -> dict[str, int]:
+    """Coin ids by market code of the coins used by any strategy or active UserStrategy."""
+    with app.app_context():
+        coins = db.session.scalars(
+            sa.select(Coin).where(
+                Coin.strategies.any()
+                | Coin.user_strategies.any(UserStrategy.active == True)
             )
+        ).all()
+        return {coin.ticker: coin.id for coin in coins if coin.ticker}
+
+
+def assign_shards(current: dict[str, int], codes) -> dict[str, int]:
+    """
+    Shard of each code, keeping the shard of every code already assigned.
+
+    New codes go to the first shard with room, so adding or removing a market
+    only reconnects the one shard it is in.
+
+    Args:
+        current (dict): The previous assignment, shard by code.
+        codes: The codes to stream now.
+
+    Returns:
+        dict: Shard by code.
+    """
+    codes = set(codes)
+    assignment = {code: shard for code, shard in current.items() if code in codes}
+    sizes = Counter(assignment.values())
+    for code in sorted(codes - set(assignment)):
+        shard = 0
+        while sizes[shard] >= MAX_CODES_PER_CONNECTION:
+            shard += 1
+        assignment[code] = shard
+        sizes[shard] += 1
+    return assignment
+
+
+def group_shards(assignment: dict[str, int]) -> dict[int, tuple[str, ...]]:
+    """The sorted codes of each shard of an assignment."""
+    shards = {}
+    for code, shard in sorted(assignment.items()):
+        shards.setdefault(shard, []).append(code)
+    return {shard: tuple(codes) for shard, codes in shards.items()}
+
+
+def get_ticket(codes: tuple[str, ...]) -> str:
+    """Ticket of the connection streaming codes, distinct for every set of codes."""
+    return f"offbit-{zlib.crc32(','.join(codes).encode()):08x}"
+
+
+async def stream_shard(shard_id: int, codes: tuple[str, ...], publisher: TickPublisher):
+    """Keep one websocket connection subscribed to codes, reconnecting with backoff."""
+    backoff = 1
+    while True:
+        try:
+            async with websockets.connect(UPBIT_WEBSOCKET_URI) as websocket:
+                subscribe_message = [
+                    {"ticket": get_ticket(codes)},
+                    {
+                        # Every trade, so minute bars can be built from the feed
+                        "type": "trade",
+                        "codes": list(codes),
+                    },
+                    {"format": "SIMPLE"},
+                ]
+                await websocket.send(json.dumps(subscribe_message))
+                publisher.mark_live(codes)
+                backoff = 1
+                async for response in websocket:
+                    try:
+                        data = json.loads(response)
+                    except ValueError:
+                        app.logger.warning(
+                            f"Websocket shard {shard_id} got {response!r}"
+                        )
+                        continue
+                    if "error" in data:
+                        app.logger.warning(
+                            f"Websocket shard {shard_id} error: {data['error']}"
+                        )
+                        continue
+                    publisher.add(
+                        data.get("cd"), data.get("tp"), data.get("tv"), data.get("ttms")
+                    )
+        except Exception as e:
+            # Disconnects, but also refused handshakes (e.g. HTTP 429): the shard
+            # keeps retrying, its markets must not silently stop streaming
+            app.logger.warning(
+                f"Websocket shard {shard_id} disconnected: {e.__class__.__name__}: {e}"
+            )
+        finally:
+            publisher.mark_down(codes)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+
+
+async def upbit_websocket(stop_event: threading.Event):
+    """Stream Upbit tickers for the markets in use and publish them to Redis until stop_event is set."""
+    redis_client = aioredis.from_url(REDIS_URL)
+    publisher = TickPublisher(redis_client)
+    flusher = asyncio.create_task(publisher.run())
+    # Shard of each streamed code, and the codes and running task of each shard
+    assignment = {}
+    shards = {}
+    loop = asyncio.get_running_loop()
+    next_refresh = 0
+    try:
+        while not stop_event.is_set():
+            if flusher.done():
+                # Surface publish errors so the supervisor reconnects
+                flusher.result()
+            for shard_id, (_, task) in list(shards.items()):
+                if task.done():
+                    # Shards retry on their own; one that ended anyway is restarted
+                    # on the next refresh
+                    app.logger.error(
+                        f"Websocket shard {shard_id} stopped: {task.exception()}"
+                    )
+                    del shards[shard_id]
+                    next_refresh = 0
+
+            if loop.time() >= next_refresh:
+                markets = await asyncio.to_thread(get_subscription_markets)
+                publisher.coin_ids.update(markets)
+                assignment = assign_shards(assignment, markets)
+                wanted = group_shards(assignment)
+                # Only shards whose markets changed are reconnected
+                for shard_id in list(shards):
+                    if shards[shard_id][0] != wanted.get(shard_id):
+                        shards.pop(shard_id)[1].cancel()
+                for shard_id, codes in wanted.items():
+                    if shard_id not in shards:
+                        task = asyncio.create_task(
+                            stream_shard(shard_id, codes, publisher)
+                        )
+                        shards[shard_id] = (codes, task)
+                next_refresh = loop.time() + SUBSCRIPTION_REFRESH_INTERVAL
+
+            await asyncio.sleep(1)
+    finally:
+        for _, task in shards.values():
+            task.cancel()
+        flusher.cancel()
+        try:
+            # Publish whatever arrived since the last flush
+            await publisher.flush()
+        finally:
+            await redis_client.aclose()
 
 
-def run_websocket_client():
+def run_websocket_client(stop_event: threading.Event | None = None):
     """Run the WebSocket client."""
+    stop_event = stop_event or threading.Event()
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(upbit_websocket())
+    try:
+        loop.run_until_complete(upbit_websocket(stop_event))
+    finally:
+        loop.close()
@@ -0,0 +1,197 @@
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+
+from app import create_app, db
+from app.models import Coin, Strategy
+from app.utils.df_utils import get_dataframe_from_pickle, save_dataframe_as_pickle
+from app.utils.handle_candle import concat_candles, resample_df
+from app.utils.performance_utils import get_backtest, get_performance
+from app.utils.synthetic_candles import make_candles
+from app.utils.trading_conditions import get_condition
+from config import Config
+
+# Benchmarks for the data paths behind strategy execution and the strategy pages,
+# run on synthetic minute candles so results are reproducible anywhere:
+#   python benchmarks.py                  run everything, append to benchmark_results.jsonl
+#   python benchmarks.py -k backtest      only benchmarks whose name contains "backtest"
+#   python benchmarks.py --compare        also show the change against the previous run
+
+# Strategy names and the default parameters they are benchmarked with
+STRATEGY_PARAMS = {
+    "Relative_Strength_Index": (14, None),
+    "Moving_Average_Crossover": (5, 20),
+    "Trading_Range_Breakout": (20, None),
+    "Moving_Average_Convergence_Divergence": (12, 26),
+    "Rate_of_Change": (10, None),
+    "On_Balance_Volume": (5, 20),
+}
+STOP_LOSS = 5  # percent
+# Same length as the short history kept per coin (see Coin.save_historical_data)
+SHORT_HISTORY_ROWS = 100000
+EXECUTION_TIME = datetime(1970, 1, 1, 9, 0)
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite:///"
+    REDIS_URL = None
+
+
+def measure(fn, repeat: int) -> dict:
+    """Run fn once to warm up, then repeat times, and summarize the timings."""
+    fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "repeat": repeat,
+    }
+
+
+def load_all_historical_data():
+    for coin in db.session.scalars(sa.select(Coin)):
+        coin.get_historical_data()
+
+
+def get_benchmarks(candles: dict[str, pd.DataFrame], wanted):
+    """Yield (name, callable) pairs accepted by wanted. Expects the coins to be stored."""
+    coin_name, df = next(iter(candles.items()))
+    short_df = df.tail(SHORT_HISTORY_ROWS).reset_index(drop=True)
+    # The last three hours, as fetched by Coin.make_historical_data every minute
+    recent_df = make_candles(
+        df["market"].iloc[0], days=1, seed=0, end=df["time_utc"].iloc[-1]
+    ).tail(180)
+    pickled = save_dataframe_as_pickle(df)
+
+    yield "resample_df", partial(resample_df, df=df, execution_time=EXECUTION_TIME)
+    yield "concat_candles", partial(concat_candles, long_df=df, short_df=recent_df)
+    yield "pickle_save", partial(save_dataframe_as_pickle, df)
+    yield "pickle_load", partial(get_dataframe_from_pickle, pickled)
+    yield "load_historical_data:all_coins", load_all_historical_data
+
+    for name, (param1, param2) in STRATEGY_PARAMS.items():
+        for stop_loss in (None, STOP_LOSS):
+            suffix = f"{name}:stop_loss" if stop_loss else name
+            yield f"get_condition:{suffix}", partial(
+                get_condition,
+                name,
+                EXECUTION_TIME,
+                False,
+                param1,
+                param2,
+                stop_loss,
+                short_df,
+            )
+
+    for name, (param1, param2) in STRATEGY_PARAMS.items():
+        strategy = db.session.scalar(sa.select(Strategy).where(Strategy.name == name))
+        for stop_loss in (None, STOP_LOSS):
+            suffix = f"{name}:stop_loss" if stop_loss else name
+            backtest = partial(
+                get_backtest,
+                strategy=strategy,
+                selected_coin=coin_name,
+                param1=param1,
+                param2=param2,
+                stop_loss=stop_loss,
+                execution_time=EXECUTION_TIME,
+            )
+            yield f"get_backtest:{suffix}", backtest
+            # get_performance is timed on a finished backtest
+            if not stop_loss and wanted(f"get_performance:{name}"):
+                yield f"get_performance:{name}", partial(get_performance, backtest())
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_previous_results(path: str) -> dict:
+    """The latest recorded result of each benchmark in the results file."""
+    results = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    results.update(json.loads(line)["results"])
+    except FileNotFoundError:
+        pass
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Offbit's data paths.")
+    parser.add_argument("-k", "--filter", help="only run benchmarks containing this")
+    parser.add_argument("--days", type=int, default=420, help="days of minute candles")
+    parser.add_argument("--coins", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="benchmark_results.jsonl")
+    parser.add_argument(
+        "--compare", action="store_true", help="compare with the previous run"
+    )
+    args = parser.parse_args()
+
+    previous = load_previous_results(args.output) if args.compare else {}
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        db.create_all()
+        candles = {}
+        for i in range(args.coins):
+            coin = Coin(name=f"coin{i}", market=f"KRW-BENCH{i}")
+            candles[coin.name] = make_candles(coin.market, args.days, seed=i)
+            db.session.add(coin)
+            coin.save_historical_data(candles[coin.name])
+        for name, (param1, param2) in STRATEGY_PARAMS.items():
+            db.session.add(Strategy(name=name, base_param1=param1, base_param2=param2))
+        db.session.commit()
+
+        results = {}
+        wanted = lambda name: not args.filter or args.filter in name
+        for name, fn in get_benchmarks(candles, wanted):
+            if not wanted(name):
+                continue
+            results[name] = measure(fn, args.repeat)
+            line = f"{name:<60} {results[name]['median'] * 1000:>10.1f} ms"
+            if name in previous:
+                before = previous[name]["median"]
+                line += f" {(results[name]['median'] / before - 1) * 100:>+8.1f}%"
+            print(line)
+
+    run = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "commit": get_git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "days": args.days,
+        "coins": args.coins,
+        "results": results,
+    }
+    with open(args.output, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+if __name__ == "__main__":
+    main()
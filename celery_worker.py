@@ -1,4 +1,23 @@
+from celery.signals import worker_init
+
 from app import create_app
+from app.utils.metrics import start_worker_exporter
+
+# Run one worker pool per queue so executions never wait behind analytics:
+#   celery -A celery_worker.celery_app worker -Q execution -n execution@%h
+#   celery -A celery_worker.celery_app worker -Q analytics -n analytics@%h
+#   celery -A celery_worker.celery_app worker -Q offbit -n offbit@%h
+#   celery -A celery_worker.celery_app beat
+# The websocket client and price listener run via stream_worker.py instead.
+# Set CELERY_METRICS_PORT (one port per worker) to export worker metrics, and
+# PROMETHEUS_MULTIPROC_DIR so the pool processes' metrics are aggregated.
 
 flask_app = create_app()
 celery_app = flask_app.extensions["celery"]
+
+
+@worker_init.connect
+def start_metrics_exporter(sender=None, **kwargs):
+    port = flask_app.config["CELERY_METRICS_PORT"]
+    if port:
+        start_worker_exporter(celery_app, port)
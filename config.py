@@ -28,6 +28,38 @@ class Config:
     CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL")
     CELERY_RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND")
 
+    # Upbit endpoints, pointed at upbit_simulator.py for load and latency tests
+    UPBIT_API_URL = os.environ.get("UPBIT_API_URL") or "https://api.upbit.com"
+    UPBIT_WEBSOCKET_URL = (
+        os.environ.get("UPBIT_WEBSOCKET_URL") or "wss://api.upbit.com/websocket/v1"
+    )
+
+    # Place orders through the order gateway service (stream_worker.py orders)
+    # instead of from the Celery task executing the strategy; only when set to
+    # 1/true/yes/on, so ORDER_GATEWAY=0 doesn't route orders to a stopped service
+    ORDER_GATEWAY = (os.environ.get("ORDER_GATEWAY") or "").strip().lower() in (
+        "1",
+        "true",
+        "yes",
+        "on",
+    )
+
+    # Price listeners (stream_worker.py listener) splitting the price stream
+    # partitions; listeners started beyond this many stand by
+    PRICE_LISTENERS = int(os.environ.get("PRICE_LISTENERS") or 1)
+
+    # Push server (stream_worker.py push) streaming updates to the dashboard and
+    # ranking pages, which poll instead while PUSH_WEBSOCKET_URL is unset
+    PUSH_HOST = os.environ.get("PUSH_HOST") or "0.0.0.0"
+    PUSH_PORT = int(os.environ.get("PUSH_PORT") or 8765)
+    # Address browsers connect to, e.g. wss://offbit.example/push
+    PUSH_WEBSOCKET_URL = os.environ.get("PUSH_WEBSOCKET_URL")
+
+    # Prometheus: /metrics requires "Authorization: Bearer <token>" and is not
+    # served without one, and Celery workers serve their metrics on this port when set
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    CELERY_METRICS_PORT = int(os.environ.get("CELERY_METRICS_PORT") or 0)
+
     # Add your default values here
     MEMBERSHIP_DEFAULT_DURATION_DAYS = 30  # Default 30 days for membership
     MEMBERSHIP_DEFAULT_EXTEND_DAYS = 30  # Default 30 days for membership extension
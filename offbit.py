@@ -2,7 +2,7 @@ import sqlalchemy as sa
 import sqlalchemy.orm as so
 
 from app import create_app, db
-from app.models import Coin, Strategy, User, UserStrategy
+from app.models import Coin, Order, Strategy, StrategyPnL, User, UserStrategy
 
 app = create_app()
 
@@ -17,4 +17,6 @@ def make_shell_context():
         "Strategy": Strategy,
         "UserStrategy": UserStrategy,
         "Coin": Coin,
+        "Order": Order,
+        "StrategyPnL": StrategyPnL,
     }
@@ -0,0 +1,370 @@
+import argparse
+import contextlib
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import sqlalchemy as sa
+
+from app.utils.upbit_client import UpbitError
+from config import Config
+from upbit_simulator import Exchange, public_order
+
+# Replays stored minute candles through the production execution path (historical
+# data update, execute_strategies, get_condition, market orders) on a frozen clock,
+# then checks the positions taken against get_backtest:
+#   python replay.py --days 90 --strategy Relative_Strength_Index 14
+#   python replay.py --synthetic-days 500 --days 120 --users 50 --update-every 1
+# Everything runs in one process: an in-memory database, Celery tasks executed
+# eagerly, orders filled by the simulated exchange at the open of the execution
+# minute. Redis is required for the live candles, schedule index and locks; use a
+# database of its own, as the replay overwrites the candle and schedule keys.
+
+# make_historical_data refetches everything from REST once the history is this old
+MAX_UPDATE_EVERY = 170  # minutes
+REPLAY_EMAIL = "replay-{i}@offbit.invalid"
+
+
+class ReplayBroker:
+    """The UpbitClient calls of one replayed user, answered by the simulated exchange."""
+
+    def __init__(self, exchange: Exchange, access_key: str):
+        self.exchange = exchange
+        self.access_key = access_key
+
+    def get_balance(self, ticker: str = "KRW") -> float:
+        currency = ticker.split("-")[-1]
+        return self.exchange.get_account(self.access_key).get(currency, 0.0)
+
+    def buy_market_order(
+        self, ticker: str, price: float, identifier: str | None = None
+    ) -> dict:
+        order = {
+            "market": ticker,
+            "side": "bid",
+            "price": price,
+            "ord_type": "price",
+            "identifier": identifier,
+        }
+        return public_order(self.exchange.place_order(self.access_key, order))
+
+    def sell_market_order(
+        self, ticker: str, volume: float, identifier: str | None = None
+    ) -> dict:
+        order = {
+            "market": ticker,
+            "side": "ask",
+            "volume": volume,
+            "ord_type": "market",
+            "identifier": identifier,
+        }
+        return public_order(self.exchange.place_order(self.access_key, order))
+
+    def get_order(
+        self, order_uuid: str | None = None, identifier: str | None = None
+    ) -> dict:
+        order = self.exchange.get_order(self.access_key, order_uuid, identifier)
+        if order is None:
+            raise UpbitError(404, "order_not_found", "주문을 찾지 못했습니다.")
+        return public_order(order)
+
+
+def load_stored_candles(database_url: str, coins: list[str] | None) -> dict:
+    """Minute candles of the coins stored in database_url, by coin name and market."""
+    from app.models import Coin
+    from app.utils.df_utils import get_dataframe_from_pickle
+
+    engine = sa.create_engine(database_url)
+    query = sa.select(Coin.name, Coin.market, Coin.historical_data).where(
+        Coin.historical_data != None
+    )
+    if coins:
+        query = query.where(Coin.name.in_(coins))
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+    return {
+        (name, market): get_dataframe_from_pickle(data) for name, market, data in rows
+    }
+
+
+def get_steps(
+    start: datetime, end: datetime, update_every: int, minutes_of_day: set[int]
+):
+    """Replayed minutes with a history update or a scheduled execution, in order."""
+    step = start
+    while step <= end:
+        yield step
+        minute_of_day = step.hour * 60 + step.minute
+        upcoming = [(m - minute_of_day - 1) % (24 * 60) + 1 for m in minutes_of_day] + [
+            update_every - (step - start) // timedelta(minutes=1) % update_every
+        ]
+        step += timedelta(minutes=min(upcoming))
+
+
+def get_backtest_positions(user_strategy) -> dict[datetime, bool]:
+    """Whether get_backtest holds the coin during each daily bar, by bar start."""
+    from app.utils.performance_utils import get_backtest
+
+    df = get_backtest(
+        strategy=user_strategy.strategy,
+        selected_coin=user_strategy.target_currency.name,
+        param1=user_strategy.param1,
+        param2=user_strategy.param2,
+        stop_loss=user_strategy.stop_loss,
+        execution_time=user_strategy.execution_time,
+    )
+    return dict(zip(pd.to_datetime(df["time_utc"]), df["position"] == 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay history through Offbit.")
+    parser.add_argument("--days", type=int, default=30, help="days to replay")
+    parser.add_argument(
+        "--strategy",
+        nargs="+",
+        action="append",
+        metavar=("NAME", "PARAM"),
+        help="strategy and its parameters, e.g. Moving_Average_Crossover 5 20",
+    )
+    parser.add_argument("--stop-loss", type=int)
+    parser.add_argument("--execution-time", default="00:00:00", help="UTC, hh:mm:ss")
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--investing-limit", type=int, default=1_000_000)
+    parser.add_argument("--coins", nargs="+", help="coin names to replay")
+    parser.add_argument(
+        "--source-database",
+        default=Config.SQLALCHEMY_DATABASE_URI,
+        help="database holding the stored candles",
+    )
+    parser.add_argument(
+        "--synthetic-days",
+        type=int,
+        help="replay generated candles of this many days instead of stored ones",
+    )
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument(
+        "--update-every",
+        type=int,
+        default=60,
+        help="minutes between history updates besides the execution minutes",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if not 1 <= args.update_every <= MAX_UPDATE_EVERY:
+        parser.error(f"--update-every must be between 1 and {MAX_UPDATE_EVERY}.")
+    strategies = args.strategy or [["Relative_Strength_Index", "14"]]
+
+    if args.synthetic_days:
+        from app.utils.synthetic_candles import make_candles
+
+        candles = {
+            ("replay", "KRW-REPLAY"): make_candles(
+                "KRW-REPLAY", args.synthetic_days, seed=0
+            )
+        }
+    else:
+        candles = load_stored_candles(args.source_database, args.coins)
+    if not candles:
+        parser.error("No stored candles to replay.")
+
+    # The app is configured before app.tasks creates it on import
+    Config.SQLALCHEMY_DATABASE_URI = "sqlite://"
+    Config.REDIS_URL = args.redis_url
+    Config.CELERY_BROKER_URL = "memory://"
+    Config.CELERY_RESULT_BACKEND = None
+
+    from app import db
+    from app.models import Coin, MembershipType, Strategy, User, UserStrategy
+    from app.tasks import app, execute_strategies, rebuild_schedule_index, redis_client
+    from app.utils.candle_aggregator import (
+        MINUTE_MS,
+        mark_down,
+        mark_live,
+        write_candles,
+    )
+    from app.utils.clock import frozen_at
+
+    app.extensions["celery"].conf.task_always_eager = True
+    exchange = Exchange(
+        initial_krw=args.investing_limit * len(strategies) * len(candles),
+        fill_delay=0,
+        days=1,
+    )
+    # Orders go to the simulated exchange instead of Upbit
+    User.create_upbit_client = lambda user: ReplayBroker(exchange, f"replay-{user.id}")
+    quiet = open(os.devnull, "w")
+
+    with app.app_context():
+        db.create_all()
+        feeds = {}
+        # The replayed feed continues the stored history without interruption
+        live_since = {}
+        end = min(df["time_utc"].iloc[-1] for df in candles.values())
+        start = (end - timedelta(days=args.days)).floor("1min")
+        for (name, market), df in candles.items():
+            coin = Coin(name=name, market=market)
+            db.session.add(coin)
+            history = df[df["time_utc"] < start].reset_index(drop=True)
+            coin.save_historical_data(history)
+            live_since[market] = int(
+                history["time_utc"].iloc[-1].replace(tzinfo=timezone.utc).timestamp()
+                * 1000
+            )
+            # Keyed by minute (epoch ms) like the bars of the live candle aggregator
+            replayed = df[(df["time_utc"] >= start) & (df["time_utc"] <= end)]
+            feeds[market] = {
+                int(row.time_utc.replace(tzinfo=timezone.utc).timestamp() * 1000): {
+                    "market": market,
+                    "minute": int(
+                        row.time_utc.replace(tzinfo=timezone.utc).timestamp() * 1000
+                    ),
+                    "time_utc": row.time_utc.isoformat(),
+                    "open": row.open,
+                    "high": row.high,
+                    "low": row.low,
+                    "close": row.close,
+                    "volume_krw": row.volume_krw,
+                    "volume_market": row.volume_market,
+                }
+                for row in replayed.itertuples()
+            }
+
+        execution_time = datetime.strptime(args.execution_time, "%H:%M:%S").time()
+        strategy_ids = []
+        for name, *params in strategies:
+            params = [int(param) for param in params] + [None, None]
+            strategy = db.session.scalar(
+                sa.select(Strategy).where(Strategy.name == name)
+            )
+            if strategy is None:
+                strategy = Strategy(
+                    name=name, base_param1=params[0], base_param2=params[1]
+                )
+                db.session.add(strategy)
+                db.session.flush()
+            strategy_ids.append((strategy.id, params))
+        coin_ids = db.session.scalars(sa.select(Coin.id)).all()
+        for i in range(args.users):
+            user = User(
+                username=f"replay{i}",
+                email=REPLAY_EMAIL.format(i=i),
+                membership_type=MembershipType.AIRPLANE,
+            )
+            db.session.add(user)
+            db.session.flush()
+            for coin_id in coin_ids:
+                for strategy_id, params in strategy_ids:
+                    # Added by id, like the strategies page does
+                    db.session.add(
+                        UserStrategy(
+                            user_id=user.id,
+                            strategy_id=strategy_id,
+                            coin_id=coin_id,
+                            active=True,
+                            execution_time=execution_time,
+                            param1=params[0],
+                            param2=params[1],
+                            stop_loss=args.stop_loss,
+                            _investing_limit=args.investing_limit,
+                        )
+                    )
+        db.session.commit()
+        schedule = rebuild_schedule_index()
+
+        pipe = redis_client.pipeline()
+        mark_down(pipe, feeds)
+        pipe.execute()
+        fed_until = (
+            int(start.replace(tzinfo=timezone.utc).timestamp() * 1000) - MINUTE_MS
+        )
+        # Holding position of each user strategy after each of its executions
+        positions = {}
+        update_seconds = execute_seconds = 0.0
+        executions = skipped = 0
+        started = time.perf_counter()
+
+        for step in get_steps(start, end, args.update_every, set(schedule)):
+            step_ms = int(step.replace(tzinfo=timezone.utc).timestamp() * 1000)
+            with frozen_at(step.to_pydatetime().replace(tzinfo=timezone.utc)):
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else quiet):
+                    # The websocket client would have written these bars by now
+                    pipe = redis_client.pipeline()
+                    for market, bars in feeds.items():
+                        write_candles(
+                            pipe,
+                            [
+                                bars[minute]
+                                for minute in range(
+                                    fed_until + MINUTE_MS, step_ms + 1, MINUTE_MS
+                                )
+                                if minute in bars
+                            ],
+                        )
+                        mark_live(pipe, [market], live_since[market])
+                        if step_ms in bars:
+                            exchange.prices[market] = bars[step_ms]["open"]
+                    pipe.execute()
+                    fed_until = step_ms
+
+                    updated = time.perf_counter()
+                    for coin in db.session.scalars(sa.select(Coin)):
+                        coin.make_historical_data()
+                    update_seconds += time.perf_counter() - updated
+
+                    due = schedule.get(step.hour * 60 + step.minute, [])
+                    if not due:
+                        continue
+                    if any(step_ms not in bars for bars in feeds.values()):
+                        # Production waits for the minute's candle, which never comes
+                        skipped += 1
+                        continue
+                    executed = time.perf_counter()
+                    execute_strategies()
+                    execute_seconds += time.perf_counter() - executed
+                    executions += len(due)
+                    db.session.expire_all()
+                    for user_strategy_id in due:
+                        user_strategy = db.session.get(UserStrategy, user_strategy_id)
+                        positions.setdefault(user_strategy_id, {})[
+                            step.to_pydatetime()
+                        ] = user_strategy.holding_position
+
+        elapsed = time.perf_counter() - started
+        replayed = (end - start).total_seconds()
+        print(
+            f"Replayed {args.days} days ({start} to {end}) in {elapsed:.1f}s, "
+            f"{replayed / elapsed:.0f}x real time"
+        )
+        print(f"History updates: {update_seconds:.1f}s")
+        print(
+            f"Executions: {executions} in {execute_seconds:.1f}s"
+            + (
+                f", {execute_seconds / executions * 1000:.1f} ms each"
+                if executions
+                else ""
+            )
+        )
+        if skipped:
+            print(f"Execution minutes skipped for lack of a candle: {skipped}")
+
+        # Live positions against get_backtest over the same history
+        mismatches = 0
+        for user_strategy_id, live in positions.items():
+            user_strategy = db.session.get(UserStrategy, user_strategy_id)
+            expected = get_backtest_positions(user_strategy)
+            for minute, holding in live.items():
+                if expected.get(pd.Timestamp(minute)) != holding:
+                    mismatches += 1
+                    if args.verbose or mismatches <= 10:
+                        print(
+                            f"{user_strategy} at {minute}: live holding={holding}, "
+                            f"backtest holding={expected.get(pd.Timestamp(minute))}"
+                        )
+        compared = sum(len(live) for live in positions.values())
+        print(f"Positions matching get_backtest: {compared - mismatches}/{compared}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+import argparse
+
+from prometheus_client import start_http_server
+
+from app.stream_service import get_lease_name, get_stream_targets, run_supervised
+
+# Long-lived streaming services, one service per process:
+#   python stream_worker.py websocket
+#   python stream_worker.py listener  (up to PRICE_LISTENERS; extras stand by)
+#   python stream_worker.py orders    (when ORDER_GATEWAY=1)
+#   python stream_worker.py push      (when PUSH_WEBSOCKET_URL is set; scales out)
+# Extra websocket processes wait as hot standbys until the lease frees up.
+# Pass --metrics-port to expose the stage latency histograms to Prometheus.
+
+if __name__ == "__main__":
+    targets = get_stream_targets()
+    parser = argparse.ArgumentParser(description="Run an Offbit streaming service.")
+    parser.add_argument("service", choices=sorted(targets))
+    parser.add_argument("--metrics-port", type=int)
+    args = parser.parse_args()
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+    target, exclusive = targets[args.service]
+    run_supervised(get_lease_name(args.service, exclusive), target)
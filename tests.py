@@ -1,12 +1,64 @@
+import asyncio
+import json
 import os
+import threading
+import time
 import unittest
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
+from datetime import time as dt_time
+from datetime import timedelta, timezone
 
+import fakeredis
+import jwt
+import numpy as np
+import redis
+import requests
 from flask import current_app
 
-from app import create_app, db
-from app.models import Strategy, User, UserStrategy
+from app import create_app, db, models, order_gateway
+from app.models import (
+    Coin,
+    MembershipType,
+    Order,
+    Strategy,
+    StrategyPnL,
+    User,
+    UserStrategy,
+    wait_for_fill,
+)
+from app.order_gateway import OrderGateway
+from app.utils.balance_cache import cache_balances
+from app.utils.candle_aggregator import CandleAggregator
+from app.utils.chart_utils import (
+    decode_chart,
+    downsample,
+    encode_chart,
+    epoch_ms,
+    lttb,
+    normalize,
+)
+from app.utils.clock import frozen_at
+from app.utils.order_intents import ORDER_STREAM
+from app.utils.price_stream import get_price_streams, get_slot_streams
+from app.utils.push_channel import load_push_token, make_push_token
+from app.utils.schedule_index import (
+    SCHEDULE_MEMBERSHIP_KEY,
+    add_to_schedule,
+    get_scheduled_ids,
+    rebuild_schedule,
+    remove_from_schedule,
+)
+from app.utils.site_stats import (
+    get_site_stats,
+    rebuild_site_stats,
+    set_investment,
+)
+from app.utils.synthetic_candles import make_candles
+from app.utils.tick_codec import SequenceTracker, Tick, decode_frame, encode_frame
+from app.websocket_client import assign_shards, get_ticket, group_shards
 from config import Config
+from replay import ReplayBroker, get_steps
+from upbit_simulator import RATE_LIMITS, Exchange, RateLimiter, create_simulator_app
 
 
 class TestConfig(Config):
@@ -61,6 +113,18 @@ class UserModelCase(unittest.TestCase):
         retrieved_user = User.query.filter_by(username="sugang").first()
         self.assertEqual(retrieved_user.get_open_api_key(), api_key)
 
+    def test_upbit_client_pool(self):
+        u = User(username="sugang", email="sugang@gmail.com")
+        u.set_open_api_key("access", "secret", datetime.now() + timedelta(days=30))
+        db.session.add(u)
+        db.session.commit()
+
+        client = u.create_upbit_client()
+        self.assertIs(u.create_upbit_client(), client)
+        # New keys replace the pooled client
+        u.set_open_api_key("access2", "secret2", datetime.now() + timedelta(days=30))
+        self.assertEqual(u.create_upbit_client().access, "access2")
+
     def test_verification_code_generation(self):
         u = User(username="testuser", email="test@example.com")
         db.session.add(u)
@@ -131,6 +195,29 @@ class StrategyModelCase(unittest.TestCase):
                 )
 
 
+class CoinModelCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ticker(self):
+        bitcoin = Coin(name="bitcoin")
+        ripple = Coin(name="ripple", market="KRW-XRP")
+        db.session.add_all([bitcoin, ripple])
+        db.session.commit()
+
+        # Rows without a market fall back to the built-in tickers
+        self.assertEqual(bitcoin.ticker, "KRW-BTC")
+        self.assertEqual(ripple.ticker, "KRW-XRP")
+
+
 class UserStrategyModelCase(unittest.TestCase):
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -161,6 +248,247 @@ class UserStrategyModelCase(unittest.TestCase):
         self.assertEqual(retrieved_user_strategy.user.username, "john")
         self.assertEqual(retrieved_user_strategy.strategy.name, "Buy Low, Sell High")
 
+    def test_investment_totals(self):
+        user = User(username="john", email="john@example.com")
+        strategy = Strategy(name="Buy Low, Sell High")
+        user_strategy = UserStrategy(
+            user=user, strategy=strategy, _investing_limit=5000
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+        self.assertEqual(user_strategy.investment, 0)
+
+        user_strategy.active = True
+        db.session.commit()
+        self.assertEqual(user_strategy.investment, 5000)
+        # Without Redis the totals are not kept, and updating them is a no-op
+        self.assertFalse(set_investment(None, user_strategy.id, 5000))
+        # Without Redis the landing page counts the totals from the database
+        response = self.app.test_client().get("/")
+        self.assertIn("5,000원", response.get_data(as_text=True))
+
+    def test_fractional_investment(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        self.app.config["REDIS_URL"] = "redis://localhost:6379/15"
+        self.app.extensions["redis"] = redis_client
+        user = User(
+            username="john",
+            email="john@example.com",
+            membership_type=MembershipType.MOTORCYCLE,
+        )
+        user_strategy = UserStrategy(
+            user=user,
+            strategy=Strategy(name="Volatility Breakout"),
+            target_currency=Coin(name="bitcoin", market="KRW-BTC"),
+            _investing_limit=1_000_000,
+            holding_position=True,
+            active=True,
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+        user.update_available()
+        rebuild_site_stats(redis_client, 1, [(user_strategy.id, 1_000_000)])
+
+        # The proceeds of a sell become the investing limit, in fractions of a won
+        user_strategy.apply_fill(
+            "ask",
+            {
+                "uuid": "order-1",
+                "market": "KRW-BTC",
+                "side": "ask",
+                "executed_volume": "0.02",
+                "paid_fee": "491.0114",
+                "created_at": "2024-01-01T09:00:00+09:00",
+                "trades": [
+                    {
+                        "uuid": "trade-1",
+                        "price": "49102290.6",
+                        "volume": "0.02",
+                        "funds": "982045.812",
+                        "created_at": "2024-01-01T09:00:00+09:00",
+                    }
+                ],
+            },
+        )
+        db.session.commit()
+        self.assertNotEqual(user_strategy.investing_limit % 1, 0)
+        self.assertTrue(
+            set_investment(redis_client, user_strategy.id, user_strategy.investment)
+        )
+        self.assertEqual(get_site_stats(redis_client)["total_investment"], 981555)
+        # Later changes still apply, and the landing page reads the totals
+        user_strategy.deactivate()
+        self.assertEqual(get_site_stats(redis_client)["total_investment"], 0)
+        response = self.app.test_client().get("/")
+        self.assertEqual(response.status_code, 200)
+
+        # A float left by the rebuild before whole won were kept is drift, not an error
+        redis_client.hset("site:investment", user_strategy.id, "981554.8006")
+        redis_client.hset("site:stats", "total_investment", "981554.8006")
+        self.assertEqual(get_site_stats(redis_client)["total_investment"], 981555)
+        self.assertFalse(set_investment(redis_client, user_strategy.id, 0))
+        self.assertIsNotNone(redis_client.hget("site:investment", user_strategy.id))
+        stats = rebuild_site_stats(redis_client, 1, [(user_strategy.id, 981554.8006)])
+        self.assertEqual(stats["total_investment"], 981555)
+        self.assertEqual(get_site_stats(redis_client), stats)
+
+    def test_apply_fill(self):
+        user_strategy = UserStrategy(
+            user=User(username="john", email="john@example.com"),
+            strategy=Strategy(name="Volatility Breakout"),
+            target_currency=Coin(name="bitcoin", market="KRW-BTC"),
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+        order = {
+            "uuid": "order-1",
+            "market": "KRW-BTC",
+            "side": "bid",
+            "executed_volume": "2",
+            "paid_fee": "50",
+            "created_at": "2024-01-01T09:00:00+09:00",
+            "trades": [
+                {
+                    "uuid": "trade-1",
+                    "price": "50000",
+                    "volume": "2",
+                    "funds": "100000",
+                    "created_at": "2024-01-01T09:00:00+09:00",
+                }
+            ],
+        }
+        self.assertTrue(user_strategy.apply_fill("bid", order))
+        db.session.commit()
+        self.assertTrue(user_strategy.holding_position)
+        self.assertEqual(user_strategy.sell_needed, 2)
+        # The outcome of the same order reported twice is applied once
+        self.assertFalse(user_strategy.apply_fill("bid", order))
+        self.assertEqual(user_strategy.pnl.order_count, 1)
+
+    def test_fill_wait(self):
+        exchange = Exchange(initial_krw=1_000_000, fill_delay=3600, days=1)
+        exchange.prices["KRW-BTC"] = 50_000_000
+        broker = ReplayBroker(exchange, "replay")
+        order = broker.buy_market_order("KRW-BTC", 100_000)
+        fill_wait_timeout = models.FILL_WAIT_TIMEOUT
+        models.FILL_WAIT_TIMEOUT = 0
+        try:
+            # An unfilled order ends the execution instead of outliving its lock
+            with self.assertRaises(TimeoutError):
+                wait_for_fill(broker, order["uuid"])
+            exchange.fill_delay = 0
+            self.assertTrue(wait_for_fill(broker, order["uuid"])["trades"])
+        finally:
+            models.FILL_WAIT_TIMEOUT = fill_wait_timeout
+
+    def add_crossover_strategy(self, now, exchange):
+        """A user on exchange, with a strategy whose condition at now is "buy"."""
+        user = User(username="john", email="john@example.com")
+        user_strategy = UserStrategy(
+            user=user,
+            strategy=Strategy(
+                name="Moving_Average_Crossover", base_param1=5, base_param2=20
+            ),
+            target_currency=Coin(name="bitcoin", market="KRW-BTC"),
+            execution_time=now.time(),
+            param1=5,
+            param2=20,
+            _investing_limit=500_000,
+            active=True,
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+        user_strategy.target_currency.save_historical_data(
+            make_candles("KRW-BTC", 60, 1, end=now)
+        )
+        exchange.prices["KRW-BTC"] = 50_000_000
+        user.create_upbit_client = lambda: ReplayBroker(exchange, "replay")
+        # The user is returned so it stays in the session with its client
+        return user, user_strategy
+
+    def test_late_fill(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        self.app.config["REDIS_URL"] = "redis://localhost:6379/15"
+        self.app.extensions["redis"] = redis_client
+        celery = RecordingCelery()
+        self.app.extensions["celery"] = celery
+        now = datetime(2024, 6, 1, 0, 9)
+        exchange = Exchange(initial_krw=1_000_000, fill_delay=3600, days=60)
+        user, user_strategy = self.add_crossover_strategy(now, exchange)
+
+        fill_wait_timeout = models.FILL_WAIT_TIMEOUT
+        models.FILL_WAIT_TIMEOUT = 0
+        try:
+            with frozen_at(now.replace(tzinfo=timezone.utc)):
+                user_strategy.execute()
+                # The accepted order blocks another one until its fill is applied
+                user_strategy.execute()
+        finally:
+            models.FILL_WAIT_TIMEOUT = fill_wait_timeout
+        self.assertEqual(len(exchange.orders), 1)
+        (order_uuid,) = exchange.orders
+        self.assertFalse(user_strategy.holding_position)
+        self.assertEqual(
+            celery.sent,
+            [("app.tasks.reconcile_order_fill", [user_strategy.id, order_uuid, "bid"])],
+        )
+        self.assertEqual(
+            redis_client.get(f"order:pending:{user_strategy.id}"), order_uuid.encode()
+        )
+
+    def test_stale_balance(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        self.app.config["REDIS_URL"] = "redis://localhost:6379/15"
+        self.app.extensions["redis"] = redis_client
+        now = datetime(2024, 6, 1, 0, 9)
+        exchange = Exchange(initial_krw=60_000, fill_delay=0, days=60)
+        user, user_strategy = self.add_crossover_strategy(now, exchange)
+        # Prefetched before most of the KRW was spent elsewhere
+        cache_balances(
+            redis_client,
+            {
+                user.id: [
+                    {"currency": "KRW", "unit_currency": "KRW", "balance": "1000000"}
+                ]
+            },
+        )
+
+        # The order resized from the live balance is checked against the minimum too
+        with frozen_at(now.replace(tzinfo=timezone.utc)):
+            with self.assertRaisesRegex(ValueError, "최소 주문 금액"):
+                user_strategy.execute()
+        self.assertEqual(exchange.orders, {})
+
+    def test_execution_without_redis(self):
+        # Executes a buy against the simulated exchange with no REDIS_URL set
+        now = datetime(2024, 6, 1, 0, 9)
+        coin = Coin(name="bitcoin", market="KRW-BTC")
+        strategy = Strategy(
+            name="Moving_Average_Crossover", base_param1=5, base_param2=20
+        )
+        user = User(username="john", email="john@example.com")
+        user_strategy = UserStrategy(
+            user=user,
+            strategy=strategy,
+            target_currency=coin,
+            execution_time=now.time(),
+            param1=5,
+            param2=20,
+            _investing_limit=500_000,
+            active=True,
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+        coin.save_historical_data(make_candles("KRW-BTC", 60, 1, end=now))
+        exchange = Exchange(initial_krw=1_000_000, fill_delay=0, days=60)
+        exchange.prices["KRW-BTC"] = 50_000_000
+        user.create_upbit_client = lambda: ReplayBroker(exchange, "replay")
+
+        with frozen_at(now.replace(tzinfo=timezone.utc)):
+            user_strategy.execute()
+        self.assertTrue(user_strategy.holding_position)
+        self.assertEqual(user_strategy.pnl.order_count, 1)
+
     def test_user_strategy_execution(self):
         user = User(username="john", email="john@example.com")
         strategy = Strategy(
@@ -182,6 +510,638 @@ class UserStrategyModelCase(unittest.TestCase):
                 "Executing logic of Momentum Trading for user john", log.output[0]
             )
 
+    def test_order_ledger(self):
+        user = User(username="john", email="john@example.com")
+        strategy = Strategy(name="Volatility Breakout")
+        coin = Coin(name="bitcoin", market="KRW-BTC")
+        db.session.add_all([user, strategy, coin])
+        db.session.commit()
+        user_strategy = UserStrategy(
+            user_id=user.id, strategy_id=strategy.id, coin_id=coin.id
+        )
+        db.session.add(user_strategy)
+        db.session.commit()
+
+        def order(side, volume, funds, fee):
+            return {
+                "uuid": f"order-{side}",
+                "market": "KRW-BTC",
+                "side": side,
+                "executed_volume": str(volume),
+                "paid_fee": str(fee),
+                "created_at": "2024-01-01T09:00:00+09:00",
+                "trades": [
+                    {
+                        "uuid": f"trade-{side}-{i}",
+                        "price": str(funds / volume),
+                        "volume": str(volume / 2),
+                        "funds": str(funds / 2),
+                        "created_at": "2024-01-01T09:00:00+09:00",
+                    }
+                    for i in range(2)
+                ],
+            }
+
+        bought = Order.record(user_strategy, order("bid", 2, 100_000, 50))
+        self.assertEqual(bought.created_at, datetime(2024, 1, 1))
+        self.assertAlmostEqual(bought.price, 50_025)
+        self.assertAlmostEqual(
+            user_strategy.pnl.unrealized_pnl(60_000), 120_000 - 100_050
+        )
+        Order.record(user_strategy, order("ask", 2, 120_000, 60))
+        db.session.commit()
+
+        pnl = db.session.get(StrategyPnL, user_strategy.id)
+        self.assertAlmostEqual(pnl.realized_pnl, 120_000 - 60 - 100_050)
+        self.assertAlmostEqual(pnl.position_volume, 0)
+        self.assertEqual(pnl.order_count, 2)
+        self.assertEqual(len(bought.fills), 2)
+
+    def test_pnl_report(self):
+        redis_client = fakeredis.FakeStrictRedis()
+        self.app.config["REDIS_URL"] = "redis://localhost:6379/15"
+        self.app.extensions["redis"] = redis_client
+        user = User(username="john", email="john@example.com")
+        strategy = Strategy(name="Volatility Breakout")
+        coins = {
+            market: Coin(name=market.lower(), market=market)
+            for market in ("KRW-BTC", "KRW-ETH", "KRW-XRP")
+        }
+        user_strategies = {
+            market: UserStrategy(user=user, strategy=strategy, target_currency=coin)
+            for market, coin in coins.items()
+        }
+        db.session.add_all(user_strategies.values())
+        db.session.commit()
+        for market in ("KRW-ETH", "KRW-XRP"):
+            Order.record(
+                user_strategies[market],
+                {
+                    "uuid": f"order-{market}",
+                    "market": market,
+                    "side": "bid",
+                    "executed_volume": "2",
+                    "paid_fee": "50",
+                    "created_at": "2024-01-01T09:00:00+09:00",
+                    "trades": [
+                        {
+                            "uuid": f"trade-{market}",
+                            "price": "50000",
+                            "volume": "2",
+                            "funds": "100000",
+                            "created_at": "2024-01-01T09:00:00+09:00",
+                        }
+                    ],
+                },
+            )
+        db.session.commit()
+        # Only XRP has streamed a price
+        redis_client.hset("prices:latest", "KRW-XRP", 60_000)
+
+        client = self.app.test_client()
+        # Sent to the login page when logged out (in its own app context, as
+        # the current user is kept on g)
+        with self.app.app_context():
+            self.assertEqual(client.get("/my/pnl").status_code, 302)
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+        report = client.get("/my/pnl").get_json()
+        by_coin = {strategy["coin"]: strategy for strategy in report["strategies"]}
+        # No fills yet: no PnL row
+        self.assertEqual(by_coin["krw-btc"]["realized_pnl"], 0.0)
+        self.assertEqual(by_coin["krw-btc"]["position_volume"], 0.0)
+        self.assertIsNone(by_coin["krw-btc"]["unrealized_pnl"])
+        # A position without a price
+        self.assertEqual(by_coin["krw-eth"]["position_volume"], 2)
+        self.assertIsNone(by_coin["krw-eth"]["price"])
+        self.assertIsNone(by_coin["krw-eth"]["unrealized_pnl"])
+        # A position valued at the latest price
+        self.assertEqual(by_coin["krw-xrp"]["price"], 60_000)
+        self.assertAlmostEqual(by_coin["krw-xrp"]["unrealized_pnl"], 120_000 - 100_050)
+        self.assertAlmostEqual(report["unrealized_pnl"], 120_000 - 100_050)
+        self.assertEqual(report["realized_pnl"], 0)
+
+
+class RecordingCelery:
+    """Keeps the tasks sent by the app instead of queueing them."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, args=None, kwargs=None, **options):
+        self.sent.append((name, args))
+
+
+class CandleAggregatorCase(unittest.TestCase):
+    def test_minute_bars(self):
+        aggregator = CandleAggregator()
+        minute = 1_700_000_040_000  # a minute boundary in epoch ms
+        aggregator.add_trade("KRW-BTC", 100.0, 1.0, minute + 1_000)
+        aggregator.add_trade("KRW-BTC", 105.0, 2.0, minute + 20_000)
+        aggregator.add_trade("KRW-BTC", 95.0, 1.0, minute + 59_999)
+        aggregator.add_trade("KRW-BTC", 101.0, 0.5, minute + 60_000)
+        # A late trade for the closed minute is ignored
+        aggregator.add_trade("KRW-BTC", 1.0, 100.0, minute + 30_000)
+
+        first, second = aggregator.drain()
+        self.assertEqual(first["time_utc"], "2023-11-14T22:14:00")
+        self.assertEqual(
+            (first["open"], first["high"], first["low"], first["close"]),
+            (100.0, 105.0, 95.0, 95.0),
+        )
+        self.assertEqual(first["volume_market"], 4.0)
+        self.assertEqual(first["volume_krw"], 100.0 + 210.0 + 95.0)
+        self.assertEqual(second["open"], 101.0)
+        self.assertEqual(aggregator.drain(), [])
+
+
+class MemoryRedis:
+    """The hash, set and key calls of the schedule index, kept in memory."""
+
+    def __init__(self):
+        self.data = {}
+
+    @staticmethod
+    def encode(value) -> bytes:
+        # Read back as bytes, like from Redis
+        return str(value).encode()
+
+    def pipeline(self, transaction=True):
+        return MemoryPipeline(self)
+
+    def exists(self, *keys):
+        return sum(key in self.data for key in keys)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def set(self, key, value):
+        self.data[key] = self.encode(value)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(self.encode(field))
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = dict(mapping or {})
+        if field is not None:
+            fields[field] = value
+        self.data.setdefault(key, {}).update(
+            {self.encode(f): self.encode(v) for f, v in fields.items()}
+        )
+
+    def hdel(self, key, field):
+        self.data.get(key, {}).pop(self.encode(field), None)
+
+    def sadd(self, key, *members):
+        self.data.setdefault(key, set()).update(map(self.encode, members))
+
+    def srem(self, key, *members):
+        self.data.get(key, set()).difference_update(map(self.encode, members))
+
+    def smembers(self, key):
+        return set(self.data.get(key, set()))
+
+
+class MemoryPipeline:
+    """Queues calls on a MemoryRedis and runs them on execute."""
+
+    def __init__(self, redis_client):
+        self.redis_client = redis_client
+        self.calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((getattr(self.redis_client, name), args, kwargs))
+
+        return queue
+
+    def execute(self):
+        return [call(*args, **kwargs) for call, args, kwargs in self.calls]
+
+
+class ScheduleIndexCase(unittest.TestCase):
+    def test_schedule(self):
+        redis_client = MemoryRedis()
+        # Not built yet: callers fall back to the database
+        self.assertIsNone(get_scheduled_ids(redis_client, dt_time(9, 0)))
+
+        schedule = rebuild_schedule(
+            redis_client, [(1, dt_time(9, 0)), (2, dt_time(9, 0)), (3, None)]
+        )
+        self.assertEqual(schedule, {540: [1, 2]})
+        # Looked up by minute, whatever the seconds
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 0, 42)), [1, 2])
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 1)), [])
+
+        # Adding an id with a new time moves it
+        add_to_schedule(redis_client, 2, dt_time(9, 1))
+        add_to_schedule(redis_client, 4, dt_time(9, 0))
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 0)), [1, 4])
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 1)), [2])
+
+        remove_from_schedule(redis_client, 1)
+        remove_from_schedule(redis_client, 5)
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 0)), [4])
+        self.assertIsNone(redis_client.hget(SCHEDULE_MEMBERSHIP_KEY, 1))
+
+        # A rebuild replaces everything added since
+        rebuild_schedule(redis_client, [(1, dt_time(23, 59))])
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 0)), [])
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(9, 1)), [])
+        self.assertEqual(get_scheduled_ids(redis_client, dt_time(23, 59)), [1])
+
+
+class WebsocketShardCase(unittest.TestCase):
+    def test_assign_shards(self):
+        codes = [f"KRW-C{i:03d}" for i in range(120)]
+        assignment = assign_shards({}, codes)
+        shards = group_shards(assignment)
+        self.assertEqual([len(shards[i]) for i in range(3)], [50, 50, 20])
+
+        # A new market joins the shard with room; the others stay connected
+        added = group_shards(assign_shards(assignment, codes + ["KRW-A"]))
+        self.assertEqual([i for i in shards if added[i] != shards[i]], [2])
+        self.assertIn("KRW-A", added[2])
+
+        # A removed market's place is taken by the next new one
+        changed = assign_shards(assignment, codes[1:] + ["KRW-A"])
+        self.assertEqual(changed["KRW-A"], 0)
+        self.assertEqual(
+            {code: changed[code] for code in codes[1:]},
+            {code: assignment[code] for code in codes[1:]},
+        )
+        tickets = {get_ticket(codes) for codes in shards.values()}
+        self.assertEqual(len(tickets), 3)
+
+
+class PriceStreamCase(unittest.TestCase):
+    def test_slot_streams(self):
+        for slots in (1, 3, 8):
+            streams = [
+                stream
+                for slot in range(slots)
+                for stream in get_slot_streams(slot, slots)
+            ]
+            # Every partition is read by exactly one listener slot
+            self.assertEqual(sorted(streams), sorted(get_price_streams()))
+
+
+class TickCodecCase(unittest.TestCase):
+    def test_frame_round_trip(self):
+        ticks = [
+            Tick(1, 95_000_000.0, 0.01, 1_700_000_040_000, 1),
+            Tick(7, 3_100.5, 120.0, 1_700_000_040_123, 42),
+        ]
+        frame = encode_frame(ticks, published_ms=1_700_000_040_200)
+        self.assertEqual(decode_frame(frame), (1_700_000_040_200, ticks))
+        with self.assertRaises(ValueError):
+            decode_frame(frame[:-1])
+
+    def test_sequence_gaps(self):
+        tracker = SequenceTracker()
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 5)), 0)
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 6)), 0)
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 9)), 2)
+        # Redelivered and restarted sequences are not counted as drops
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 8)), 0)
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 1)), 0)
+        self.assertEqual(tracker.dropped, 2)
+        # After a takeover the first tick seen is the new baseline
+        tracker.reset()
+        self.assertEqual(tracker.check(Tick(1, 1.0, 1.0, 0, 50)), 0)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_token(self):
+        client = self.app.test_client()
+        self.app.config["METRICS_TOKEN"] = None
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        self.app.config["METRICS_TOKEN"] = "secret"
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        response = client.get("/metrics", headers={"Authorization": "Bearer wrong"})
+        self.assertEqual(response.status_code, 404)
+        response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_request_metrics(self):
+        self.app.config["METRICS_TOKEN"] = "secret"
+        client = self.app.test_client()
+        self.assertEqual(client.get("/index").status_code, 200)
+        body = client.get(
+            "/metrics", headers={"Authorization": "Bearer secret"}
+        ).get_data(as_text=True)
+        self.assertIn(
+            'offbit_request_latency_seconds_count{endpoint="main.index",method="GET",status="200"}',
+            body,
+        )
+        self.assertIn('offbit_request_db_queries_count{endpoint="main.index"}', body)
+        self.assertNotIn('endpoint="metrics.metrics"', body)
+
+
+class ChartUtilsCase(unittest.TestCase):
+    def test_chart_frame(self):
+        times = ["2024-01-01T00:00:00", "2024-01-02T00:00:00", "2024-01-03T00:00:00"]
+        series = {
+            "strategy": normalize([2.0, 3.0, 1.0]),
+            "close": normalize([50.0, 25.0, 75.0]),
+        }
+        self.assertEqual(series["strategy"].dtype, np.float32)
+        times = epoch_ms(times)
+        self.assertEqual(times[0], 1704067200000)
+        header, decoded_times, decoded = decode_chart(
+            encode_chart({"range": "all"}, times, series)
+        )
+        self.assertEqual(header["range"], "all")
+        self.assertEqual(decoded_times.tolist(), times.tolist())
+        self.assertEqual(decoded["strategy"].tolist(), [100.0, 150.0, 50.0])
+        self.assertEqual(decoded["close"].tolist(), [100.0, 50.0, 150.0])
+
+    def test_downsample(self):
+        x = np.arange(1000)
+        y = np.zeros(1000)
+        y[500] = 10  # A spike an even stride would step over
+        indices = lttb(x, y, 10)
+        self.assertEqual(len(indices), 10)
+        self.assertEqual([indices[0], indices[-1]], [0, 999])
+        self.assertIn(500, indices)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        self.assertEqual(lttb(x[:5], y[:5], 10).tolist(), [0, 1, 2, 3, 4])
+
+        indices = downsample(x, {"a": y, "b": -y}, 20)
+        self.assertLessEqual(len(indices), 20)
+        self.assertIn(500, indices)
+
+
+class PushChannelCase(unittest.TestCase):
+    def test_push_token(self):
+        token = make_push_token("secret", 42)
+        self.assertEqual(load_push_token("secret", token), 42)
+        self.assertIsNone(load_push_token("other secret", token))
+        self.assertIsNone(load_push_token("secret", token[:-2]))
+
+
+class UpbitSimulatorCase(unittest.TestCase):
+    def test_market_orders(self):
+        exchange = Exchange(initial_krw=1_000_000, fill_delay=0, days=1)
+        client = create_simulator_app(exchange, RateLimiter(RATE_LIMITS)).test_client()
+        headers = {"Authorization": f"Bearer {jwt.encode({'access_key': 'a'}, 's')}"}
+        response = client.post(
+            "/v1/orders",
+            json={
+                "market": "KRW-BTC",
+                "side": "bid",
+                "price": "100000",
+                "ord_type": "price",
+            },
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("Remaining-Req", response.headers)
+        order = client.get(
+            f"/v1/order?uuid={response.json['uuid']}", headers=headers
+        ).json
+        self.assertEqual(float(order["trades"][0]["funds"]), 100_000)
+        balances = {
+            b["currency"]: float(b["balance"])
+            for b in client.get("/v1/accounts", headers=headers).json
+        }
+        self.assertAlmostEqual(balances["KRW"], 1_000_000 - 100_000 * 1.0005)
+        self.assertAlmostEqual(balances["BTC"], float(order["executed_volume"]))
+        # Selling more than is held is rejected like on Upbit
+        response = client.post(
+            "/v1/orders",
+            json={
+                "market": "KRW-BTC",
+                "side": "ask",
+                "volume": "1",
+                "ord_type": "market",
+            },
+            headers=headers,
+        )
+        self.assertEqual(response.json["error"]["name"], "insufficient_funds_ask")
+
+    def test_order_identifier(self):
+        exchange = Exchange(initial_krw=1_000_000, fill_delay=0, days=1)
+        client = create_simulator_app(exchange, RateLimiter(RATE_LIMITS)).test_client()
+        headers = {"Authorization": f"Bearer {jwt.encode({'access_key': 'a'}, 's')}"}
+        order = {
+            "market": "KRW-BTC",
+            "side": "bid",
+            "price": "100000",
+            "ord_type": "price",
+            "identifier": "intent-1",
+        }
+        placed = client.post("/v1/orders", json=order, headers=headers).json
+        # A retried order is refused, and found by its identifier instead
+        response = client.post("/v1/orders", json=order, headers=headers)
+        self.assertEqual(response.json["error"]["name"], "duplicate_identifier")
+        found = client.get("/v1/order?identifier=intent-1", headers=headers).json
+        self.assertEqual(found["uuid"], placed["uuid"])
+
+
+class MemoryOrderStream:
+    """The Redis calls of the order gateway, on one in-memory stream and group."""
+
+    def __init__(self):
+        self.entries = []
+        self.delivered = 0
+        self.pending = {}
+        self.group = False
+
+    async def xgroup_create(self, stream, group, id, mkstream):
+        if self.group:
+            raise redis.exceptions.ResponseError("BUSYGROUP")
+        self.group = True
+
+    async def xadd(self, stream, fields, **kwargs):
+        entry_id = f"{len(self.entries) + 1}-0".encode()
+        # Read back as bytes, like from Redis
+        self.entries.append(
+            (entry_id, {key.encode(): value.encode() for key, value in fields.items()})
+        )
+        return entry_id
+
+    async def xreadgroup(self, group, consumer, streams, count, block):
+        last_id = streams[ORDER_STREAM]
+        if last_id == ">":
+            entries = self.entries[self.delivered : self.delivered + count]
+            self.delivered += len(entries)
+            self.pending.update(entries)
+        else:
+            # Entries delivered before and not yet acknowledged, after last_id
+            entries = [
+                (entry_id, fields)
+                for entry_id, fields in self.pending.items()
+                if self.sequence(entry_id) > self.sequence(last_id)
+            ][:count]
+        if not entries:
+            await asyncio.sleep(0.01)
+            return []
+        return [[ORDER_STREAM.encode(), entries]]
+
+    async def xack(self, stream, group, entry_id):
+        self.pending.pop(entry_id, None)
+
+    @staticmethod
+    def sequence(entry_id) -> int:
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode()
+        return int(entry_id.split("-")[0])
+
+    async def expire(self, key, seconds):
+        pass
+
+
+class LossyBroker(ReplayBroker):
+    """A client whose first order request is placed but its response lost."""
+
+    def __init__(self, exchange, access_key):
+        super().__init__(exchange, access_key)
+        self.access = access_key
+        self.lost = 0
+
+    def buy_market_order(self, ticker, price, identifier=None):
+        order = super().buy_market_order(ticker, price, identifier)
+        if not self.lost:
+            self.lost += 1
+            raise requests.ConnectionError("Connection reset")
+        return order
+
+
+class RecordingGateway(OrderGateway):
+    """The order gateway, with its outcomes recorded instead of sent to Celery."""
+
+    def __init__(self, redis_client, client):
+        super().__init__(redis_client)
+        self.client = client
+        self.reports = []
+
+    def get_client(self, user_id):
+        return self.client
+
+    def report(self, intent, result):
+        self.reports.append((intent, result))
+
+
+class OrderGatewayCase(unittest.TestCase):
+    def setUp(self):
+        self.exchange = Exchange(initial_krw=1_000_000, fill_delay=0, days=1)
+        self.exchange.prices["KRW-BTC"] = 50_000_000
+        self.client = LossyBroker(self.exchange, "a")
+        self.stream = MemoryOrderStream()
+
+    def intent(self, identifier):
+        return {
+            "identifier": identifier,
+            "user_strategy_id": 1,
+            "user_id": 1,
+            "market": "KRW-BTC",
+            "side": "bid",
+            "amount": 100_000,
+            "trigger": "schedule",
+            "triggered_at": time.time(),
+            "queued_at": time.time(),
+        }
+
+    def run_gateway(self, gateway, reports):
+        async def main():
+            stop_event = threading.Event()
+            running = asyncio.create_task(gateway.run(stop_event))
+            while len(gateway.reports) < reports:
+                await asyncio.sleep(0.01)
+            stop_event.set()
+            await running
+            gateway.executor.shutdown()
+
+        asyncio.run(asyncio.wait_for(main(), timeout=10))
+
+    def test_submit_once(self):
+        gateway = RecordingGateway(self.stream, self.client)
+        # The lost response is retried by looking the order up, not placing it again
+        order = asyncio.run(gateway.submit(self.client, self.intent("intent-1")))
+        gateway.executor.shutdown()
+        self.assertEqual(order["identifier"], "intent-1")
+        self.assertEqual(len(self.exchange.orders), 1)
+
+    def test_restart(self):
+        async def queue():
+            await self.stream.xgroup_create(ORDER_STREAM, "group", "$", True)
+            for identifier in ("intent-1", "intent-2"):
+                await self.stream.xadd(
+                    ORDER_STREAM, {"intent": json.dumps(self.intent(identifier))}
+                )
+            # A gateway read both and stopped before placing them
+            await self.stream.xreadgroup(
+                "group", "gateway", {ORDER_STREAM: ">"}, 100, 0
+            )
+            await self.stream.xadd(
+                ORDER_STREAM, {"intent": json.dumps(self.intent("intent-3"))}
+            )
+
+        asyncio.run(queue())
+        gateway = RecordingGateway(self.stream, self.client)
+        self.run_gateway(gateway, 3)
+        self.assertEqual(
+            sorted(intent["identifier"] for intent, _ in gateway.reports),
+            ["intent-1", "intent-2", "intent-3"],
+        )
+        self.assertTrue(all(result["order"]["trades"] for _, result in gateway.reports))
+        self.assertEqual(len(self.exchange.orders), 3)
+        self.assertEqual(self.stream.pending, {})
+
+    def test_fill_timeout(self):
+        self.exchange.fill_delay = 3600
+        gateway = RecordingGateway(self.stream, self.client)
+        fill_timeout = order_gateway.FILL_TIMEOUT
+        order_gateway.FILL_TIMEOUT = 0
+        try:
+
+            async def queue():
+                await self.stream.xadd(
+                    ORDER_STREAM, {"intent": json.dumps(self.intent("intent-1"))}
+                )
+                await self.stream.xreadgroup(
+                    "group", "gateway", {ORDER_STREAM: ">"}, 100, 0
+                )
+
+            asyncio.run(queue())
+            # Unfilled in time: queued again as a check of the order, not reported
+            asyncio.run(gateway.place(b"1-0", self.intent("intent-1")))
+            self.assertEqual(gateway.reports, [])
+            check = json.loads(self.stream.entries[-1][1][b"intent"])
+            self.assertEqual(check["fill_checks"], 1)
+
+            self.exchange.fill_delay = 0
+            self.run_gateway(gateway, 1)
+        finally:
+            order_gateway.FILL_TIMEOUT = fill_timeout
+        ((intent, result),) = gateway.reports
+        self.assertTrue(result["order"]["trades"])
+        self.assertEqual(len(self.exchange.orders), 1)
+
+
+class ReplayCase(unittest.TestCase):
+    def test_steps(self):
+        start = datetime(2024, 1, 1, 23, 0)
+        steps = list(
+            get_steps(start, start + timedelta(hours=3), 60, {9, 24 * 60 - 30})
+        )
+        self.assertEqual(
+            [step.strftime("%H:%M") for step in steps],
+            ["23:00", "23:30", "00:00", "00:09", "01:00", "02:00"],
+        )
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
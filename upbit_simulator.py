@@ -0,0 +1,616 @@
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+import uuid
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import jwt
+import pandas as pd
+import websockets
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+from app.utils.synthetic_candles import make_candles
+from app.utils.upbit_client import DEFAULT_WEBSOCKET_URL, UpbitClient, UpbitError
+
+# A local stand-in for the Upbit API, for load and latency tests without real keys
+# or exchange rate limits:
+#   python upbit_simulator.py serve --ticks ticks.jsonl --speed 10
+#   python upbit_simulator.py record --markets KRW-BTC KRW-ETH --output ticks.jsonl
+#   python upbit_simulator.py load --users 10000 --concurrency 200
+# Point Offbit at it with UPBIT_API_URL=http://localhost:8900 and
+# UPBIT_WEBSOCKET_URL=ws://localhost:8901. Any access/secret key pair is accepted;
+# each access key gets its own account.
+
+FEE_RATE = 0.0005
+# Requests allowed per account and second, by group (see Upbit's Remaining-Req header)
+RATE_LIMITS = {"order": 8, "default": 30, "candles": 10}
+CANDLE_UNITS = (1, 3, 5, 10, 15, 30, 60, 240)
+MAX_CANDLE_COUNT = 200
+# Synthetic candles are generated this far ahead and revealed as the clock passes them
+CANDLE_HORIZON = timedelta(days=1)
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def error_response(status: int, name: str, message: str):
+    return jsonify({"error": {"name": name, "message": message}}), status
+
+
+class RateLimiter:
+    """Fixed one-second windows per account and request group."""
+
+    def __init__(self, limits: dict[str, int]):
+        self.limits = limits
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def hit(self, account: str, group: str) -> int | None:
+        """Count a request and return the remaining requests, or None when limited."""
+        second = int(time.time())
+        key = (account, group)
+        with self.lock:
+            window, used = self.windows.get(key, (second, 0))
+            if window != second:
+                window, used = second, 0
+            if used >= self.limits[group]:
+                return None
+            self.windows[key] = (window, used + 1)
+            return self.limits[group] - used - 1
+
+
+class Exchange:
+    """Accounts, orders and prices of the simulated exchange."""
+
+    def __init__(self, initial_krw: float, fill_delay: float, days: int):
+        self.initial_krw = initial_krw
+        self.fill_delay = fill_delay
+        self.days = days
+        self.accounts = {}
+        self.orders = {}
+        # Order uuids by (access key, identifier)
+        self.identifiers = {}
+        self.candles = {}
+        # Latest traded price per market, from the websocket replay
+        self.prices = {}
+        self.lock = threading.Lock()
+
+    def get_account(self, access_key: str) -> dict:
+        with self.lock:
+            if access_key not in self.accounts:
+                self.accounts[access_key] = {"KRW": self.initial_krw}
+            return self.accounts[access_key]
+
+    def get_candles(self, market: str, unit: int) -> pd.DataFrame:
+        """Candles of market in unit minutes, newest last, including future ones."""
+        key = (market, unit)
+        if key not in self.candles:
+            if (market, 1) not in self.candles:
+                end = utc_now().replace(second=0, microsecond=0) + CANDLE_HORIZON
+                df = make_candles(market, self.days, zlib.crc32(market.encode()), end)
+                self.candles[(market, 1)] = df.set_index("time_utc")
+            if unit != 1:
+                df = self.candles[(market, 1)]
+                self.candles[key] = (
+                    df.resample(f"{unit}min")
+                    .agg(
+                        {
+                            "market": "first",
+                            "open": "first",
+                            "high": "max",
+                            "low": "min",
+                            "close": "last",
+                            "volume_krw": "sum",
+                            "volume_market": "sum",
+                        }
+                    )
+                    .dropna()
+                )
+        return self.candles[key]
+
+    def get_price(self, market: str) -> float:
+        """The last replayed trade price, or the close of the current minute."""
+        if market in self.prices:
+            return self.prices[market]
+        df = self.get_candles(market, 1)
+        return float(df["close"].iloc[df.index.searchsorted(utc_now()) - 1])
+
+    def place_order(self, access_key: str, order: dict) -> dict:
+        market = order["market"]
+        currency = market.split("-")[1]
+        account = self.get_account(access_key)
+        identifier = order.get("identifier")
+        with self.lock:
+            if identifier and (access_key, identifier) in self.identifiers:
+                raise UpbitError(
+                    400, "duplicate_identifier", "이미 사용된 identifier 입니다."
+                )
+            if order["side"] == "bid":
+                funds = float(order["price"])
+                if account.get("KRW", 0) < funds * (1 + FEE_RATE):
+                    raise UpbitError(
+                        400, "insufficient_funds_bid", "주문가능한 금액이 부족합니다."
+                    )
+                account["KRW"] -= funds * (1 + FEE_RATE)
+            else:
+                volume = float(order["volume"])
+                if account.get(currency, 0) < volume:
+                    raise UpbitError(
+                        400, "insufficient_funds_ask", "주문가능한 금액이 부족합니다."
+                    )
+                account[currency] -= volume
+            placed = {
+                "uuid": str(uuid.uuid4()),
+                "side": order["side"],
+                "ord_type": order["ord_type"],
+                "price": order.get("price"),
+                "volume": order.get("volume"),
+                "state": "wait",
+                "market": market,
+                "identifier": identifier,
+                "created_at": utc_now().isoformat(),
+                "reserved_fee": (
+                    str(float(order["price"]) * FEE_RATE)
+                    if order["side"] == "bid"
+                    else "0"
+                ),
+                "paid_fee": "0",
+                "executed_volume": "0",
+                "trades_count": 0,
+                "trades": [],
+                "access_key": access_key,
+                "placed_at": time.monotonic(),
+            }
+            self.orders[placed["uuid"]] = placed
+            if identifier:
+                self.identifiers[(access_key, identifier)] = placed["uuid"]
+        return placed
+
+    def get_order(
+        self, access_key: str, order_uuid: str, identifier: str | None = None
+    ) -> dict | None:
+        """An order of the account, filled once the fill delay has passed."""
+        if identifier:
+            order_uuid = self.identifiers.get((access_key, identifier))
+        order = self.orders.get(order_uuid)
+        if order is None or order["access_key"] != access_key:
+            return None
+        if (
+            order["state"] == "wait"
+            and time.monotonic() - order["placed_at"] >= self.fill_delay
+        ):
+            self.fill(order, self.get_price(order["market"]))
+        return order
+
+    def fill(self, order: dict, price: float):
+        """Fill the whole order in one trade at price."""
+        currency = order["market"].split("-")[1]
+        account = self.accounts[order["access_key"]]
+        with self.lock:
+            if order["state"] != "wait":
+                return
+            if order["side"] == "bid":
+                funds = float(order["price"])
+                volume = funds / price
+                fee = funds * FEE_RATE
+                account[currency] = account.get(currency, 0) + volume
+            else:
+                volume = float(order["volume"])
+                funds = volume * price
+                fee = funds * FEE_RATE
+                account["KRW"] = account.get("KRW", 0) + funds - fee
+            order.update(
+                # Upbit cancels the unspent remainder of a market buy
+                state="done" if order["side"] == "ask" else "cancel",
+                executed_volume=str(volume),
+                paid_fee=str(fee),
+                trades_count=1,
+                trades=[
+                    {
+                        "market": order["market"],
+                        "uuid": str(uuid.uuid4()),
+                        "price": str(price),
+                        "volume": str(volume),
+                        "funds": str(funds),
+                        "side": order["side"],
+                        "created_at": utc_now().isoformat(),
+                    }
+                ],
+            )
+
+
+def public_order(order: dict) -> dict:
+    return {
+        key: value
+        for key, value in order.items()
+        if key not in ("access_key", "placed_at")
+    }
+
+
+def create_simulator_app(exchange: Exchange, limiter: RateLimiter) -> Flask:
+    app = Flask(__name__)
+
+    def authenticate() -> str | None:
+        """The access key of the request. Signatures are not checked."""
+        header = request.headers.get("Authorization", "")
+        if not header.startswith("Bearer "):
+            return None
+        try:
+            payload = jwt.decode(header[7:], options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            return None
+        return payload.get("access_key")
+
+    def limit(account: str, group: str):
+        remaining = limiter.hit(account, group)
+        request.environ["simulator.remaining"] = (
+            f"group={group}; min=1800; sec={remaining or 0}"
+        )
+        if remaining is None:
+            return error_response(429, "too_many_requests", "Too many API requests.")
+        return None
+
+    @app.after_request
+    def add_remaining_req(response):
+        remaining = request.environ.get("simulator.remaining")
+        if remaining:
+            response.headers["Remaining-Req"] = remaining
+        return response
+
+    @app.errorhandler(UpbitError)
+    def handle_upbit_error(e):
+        return error_response(e.status, e.name, e.message)
+
+    @app.route("/v1/candles/minutes/<int:unit>")
+    def candles(unit):
+        if unit not in CANDLE_UNITS:
+            return error_response(400, "invalid_parameter", f"Unsupported unit {unit}.")
+        limited = limit(request.remote_addr, "candles")
+        if limited:
+            return limited
+        market = request.args.get("market", "")
+        if not market.startswith("KRW-"):
+            return error_response(404, "Code not found", "market does not exist")
+        count = min(int(request.args.get("count", 1)), MAX_CANDLE_COUNT)
+        to = pd.Timestamp(request.args.get("to") or utc_now())
+        if to.tzinfo is not None:
+            to = to.tz_convert("UTC").tz_localize(None)
+        df = exchange.get_candles(market, unit)
+        # Candles strictly before to, and never ones that haven't happened yet
+        end = df.index.searchsorted(min(to, pd.Timestamp(utc_now())))
+        selected = df.iloc[max(end - count, 0) : end]
+        return jsonify(
+            [
+                {
+                    "market": market,
+                    "candle_date_time_utc": t.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "candle_date_time_kst": (t + timedelta(hours=9)).strftime(
+                        "%Y-%m-%dT%H:%M:%S"
+                    ),
+                    "opening_price": row.open,
+                    "high_price": row.high,
+                    "low_price": row.low,
+                    "trade_price": row.close,
+                    "timestamp": int(t.timestamp() * 1000),
+                    "candle_acc_trade_price": row.volume_krw,
+                    "candle_acc_trade_volume": row.volume_market,
+                    "unit": unit,
+                }
+                for t, row in zip(reversed(selected.index), selected[::-1].itertuples())
+            ]
+        )
+
+    @app.route("/v1/accounts")
+    def accounts():
+        access_key = authenticate()
+        if access_key is None:
+            return error_response(401, "invalid_access_key", "잘못된 엑세스 키입니다.")
+        limited = limit(access_key, "default")
+        if limited:
+            return limited
+        balances = dict(exchange.get_account(access_key))
+        return jsonify(
+            [
+                {
+                    "currency": currency,
+                    "balance": str(balance),
+                    "locked": "0",
+                    "avg_buy_price": "0",
+                    "avg_buy_price_modified": False,
+                    "unit_currency": "KRW",
+                }
+                for currency, balance in balances.items()
+            ]
+        )
+
+    @app.route("/v1/orders", methods=["POST"])
+    def orders():
+        access_key = authenticate()
+        if access_key is None:
+            return error_response(401, "invalid_access_key", "잘못된 엑세스 키입니다.")
+        limited = limit(access_key, "order")
+        if limited:
+            return limited
+        order = request.get_json(silent=True) or {}
+        if (order.get("side"), order.get("ord_type")) not in (
+            ("bid", "price"),
+            ("ask", "market"),
+        ):
+            return error_response(
+                400, "invalid_parameter", "Only market orders are simulated."
+            )
+        return jsonify(public_order(exchange.place_order(access_key, order))), 201
+
+    @app.route("/v1/order")
+    def order():
+        access_key = authenticate()
+        if access_key is None:
+            return error_response(401, "invalid_access_key", "잘못된 엑세스 키입니다.")
+        limited = limit(access_key, "default")
+        if limited:
+            return limited
+        order = exchange.get_order(
+            access_key, request.args.get("uuid", ""), request.args.get("identifier")
+        )
+        if order is None:
+            return error_response(404, "order_not_found", "주문을 찾지 못했습니다.")
+        return jsonify(public_order(order))
+
+    return app
+
+
+def load_ticks(path: str) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def send_tick(websocket, exchange: Exchange, tick: dict):
+    # Orders fill at the last price sent on any connection
+    exchange.prices[tick["cd"]] = tick["tp"]
+    await websocket.send(json.dumps(tick).encode())
+
+
+async def replay_ticks(
+    websocket, exchange: Exchange, codes: set[str], ticks: list[dict], speed: float
+):
+    """Send the recorded ticks of codes, spaced as recorded and divided by speed."""
+    ticks = [tick for tick in ticks if tick["cd"] in codes]
+    if not ticks:
+        return
+    while True:
+        started = time.monotonic()
+        first_ms = ticks[0]["ttms"]
+        for tick in ticks:
+            delay = (tick["ttms"] - first_ms) / 1000 / speed
+            wait = started + delay - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            # Stamp with the replay time so latency measurements stay meaningful
+            await send_tick(
+                websocket, exchange, {**tick, "ttms": int(time.time() * 1000)}
+            )
+
+
+async def synthesize_ticks(websocket, codes: set[str], exchange: Exchange, rate: float):
+    """Send trades around the current synthetic candle close, rate per second per code."""
+    codes = sorted(codes)
+    while True:
+        for code in codes:
+            price = exchange.get_price(code) * (1 + random.gauss(0, 0.0002))
+            await send_tick(
+                websocket,
+                exchange,
+                {
+                    "ty": "trade",
+                    "cd": code,
+                    "tp": price,
+                    "tv": random.expovariate(50),
+                    "ttms": int(time.time() * 1000),
+                    "ab": random.choice(("ASK", "BID")),
+                    "st": "SNAPSHOT",
+                },
+            )
+        await asyncio.sleep(1 / rate)
+
+
+async def serve_websocket(exchange: Exchange, host: str, port: int, args):
+    ticks = load_ticks(args.ticks) if args.ticks else None
+
+    async def handle(websocket):
+        subscription = json.loads(await websocket.recv())
+        codes = {
+            code
+            for part in subscription
+            if part.get("type") == "trade"
+            for code in part.get("codes", [])
+        }
+        try:
+            if ticks is not None:
+                await replay_ticks(websocket, exchange, codes, ticks, args.speed)
+                await websocket.wait_closed()
+            else:
+                await synthesize_ticks(websocket, codes, exchange, args.tick_rate)
+        except websockets.ConnectionClosed:
+            pass
+
+    async with websockets.serve(handle, host, port, max_queue=None):
+        await asyncio.Future()
+
+
+def serve(args):
+    exchange = Exchange(args.initial_krw, args.fill_delay, args.days)
+    limiter = RateLimiter(
+        {
+            "order": args.order_rate_limit,
+            "default": args.rate_limit,
+            "candles": args.candle_rate_limit,
+        }
+    )
+    rest_server = make_server(
+        args.host,
+        args.port,
+        create_simulator_app(exchange, limiter),
+        threaded=True,
+    )
+    threading.Thread(target=rest_server.serve_forever, daemon=True).start()
+    print(f"REST API on http://{args.host}:{args.port}")
+    print(f"Websocket on ws://{args.host}:{args.websocket_port}")
+    try:
+        asyncio.run(serve_websocket(exchange, args.host, args.websocket_port, args))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rest_server.shutdown()
+
+
+async def record_ticks(markets: list[str], output: str, duration: float | None):
+    """Append real Upbit trades of markets to output, in the SIMPLE format."""
+    deadline = time.monotonic() + duration if duration else None
+    async with websockets.connect(DEFAULT_WEBSOCKET_URL) as websocket:
+        await websocket.send(
+            json.dumps(
+                [
+                    {"ticket": "offbit-recorder"},
+                    {"type": "trade", "codes": markets},
+                    {"format": "SIMPLE"},
+                ]
+            )
+        )
+        with open(output, "a") as f:
+            recorded = 0
+            while deadline is None or time.monotonic() < deadline:
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=5)
+                except asyncio.TimeoutError:
+                    continue
+                f.write(json.dumps(json.loads(message)) + "\n")
+                recorded += 1
+                if recorded % 1000 == 0:
+                    print(f"{recorded} ticks recorded")
+
+
+def run_user(base_url: str, user: int, market: str, krw: float) -> dict:
+    """One simulated user: check the balance, buy, wait for the fill and sell."""
+    client = UpbitClient(f"load-{user}", "secret", base_url=base_url)
+    timings = {}
+
+    def timed(name, fn, *args):
+        started = time.perf_counter()
+        while True:
+            try:
+                result = fn(*args)
+                break
+            except UpbitError as e:
+                if e.name != "too_many_requests":
+                    raise
+                time.sleep(0.1)
+        timings[name] = time.perf_counter() - started
+        return result
+
+    timed("get_balance", client.get_balance)
+    buy = timed("buy_market_order", client.buy_market_order, market, krw)
+    order = timed("get_order", client.get_order, buy["uuid"])
+    while not order["trades"]:
+        time.sleep(0.1)
+        order = client.get_order(buy["uuid"])
+    timed(
+        "sell_market_order", client.sell_market_order, market, order["executed_volume"]
+    )
+    return timings
+
+
+def load(args):
+    """Run args.users simulated users against the simulator and report latencies."""
+    timings = defaultdict(list)
+    failures = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [
+            executor.submit(run_user, args.url, user, args.market, args.order_krw)
+            for user in range(args.users)
+        ]
+        for future in futures:
+            try:
+                for name, seconds in future.result().items():
+                    timings[name].append(seconds)
+            except (UpbitError, OSError) as e:
+                failures += 1
+                print(f"User failed: {e}")
+    elapsed = time.perf_counter() - started
+    print(f"{args.users} users in {elapsed:.1f}s, {failures} failed")
+    for name, values in timings.items():
+        values.sort()
+        p99 = values[min(int(len(values) * 0.99), len(values) - 1)]
+        print(
+            f"{name:<20} median {statistics.median(values) * 1000:>8.1f} ms"
+            f"  p99 {p99 * 1000:>8.1f} ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the Upbit API locally.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the simulated exchange")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8900)
+    serve_parser.add_argument("--websocket-port", type=int, default=8901)
+    serve_parser.add_argument("--ticks", help="JSONL file of recorded ticks to replay")
+    serve_parser.add_argument(
+        "--speed", type=float, default=1.0, help="replay speed multiplier"
+    )
+    serve_parser.add_argument(
+        "--tick-rate",
+        type=float,
+        default=5.0,
+        help="synthetic ticks per second per market, without --ticks",
+    )
+    serve_parser.add_argument(
+        "--fill-delay", type=float, default=0.2, help="seconds until orders fill"
+    )
+    serve_parser.add_argument("--initial-krw", type=float, default=10_000_000)
+    serve_parser.add_argument(
+        "--days", type=int, default=7, help="days of candle history"
+    )
+    serve_parser.add_argument(
+        "--order-rate-limit", type=int, default=RATE_LIMITS["order"]
+    )
+    serve_parser.add_argument("--rate-limit", type=int, default=RATE_LIMITS["default"])
+    serve_parser.add_argument(
+        "--candle-rate-limit", type=int, default=RATE_LIMITS["candles"]
+    )
+    serve_parser.set_defaults(func=serve)
+
+    record_parser = subparsers.add_parser("record", help="record real Upbit ticks")
+    record_parser.add_argument("--markets", nargs="+", required=True)
+    record_parser.add_argument("--output", default="ticks.jsonl")
+    record_parser.add_argument("--duration", type=float, help="seconds to record")
+    record_parser.set_defaults(
+        func=lambda args: asyncio.run(
+            record_ticks(args.markets, args.output, args.duration)
+        )
+    )
+
+    load_parser = subparsers.add_parser("load", help="simulate many users ordering")
+    load_parser.add_argument("--url", default="http://127.0.0.1:8900")
+    load_parser.add_argument("--users", type=int, default=10_000)
+    load_parser.add_argument("--concurrency", type=int, default=100)
+    load_parser.add_argument("--market", default="KRW-BTC")
+    load_parser.add_argument("--order-krw", type=float, default=100_000)
+    load_parser.set_defaults(func=load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()